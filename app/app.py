@@ -1,82 +1,270 @@
+import hmac
+import logging
+import os
+import time
 from typing import Annotated
 
-from starlette.responses import RedirectResponse
+from startup_profiler import STARTUP
 
-from form_helper import explode_ingredient_list, get_tags, upload_recipe_img
-import password_validator
+from starlette.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
+
+from form_helper import explode_ingredient_list, get_tags, read_recipe_fields, upload_recipe_img
+from upload_handler import UploadRejected, parse_recipe_form
+from recipe_import import RequestRejected, parse_if_match, parse_ids, read_import, read_patch, to_recipes, version_etag
+from password_validator import HASHING_SERVICE, HashingQueueFull, hashing_queue_full_handler
+from image_pipeline import IMAGE_PIPELINE, srcset
+from image_gc import IMAGE_GC, recipe_images
+from image_storage import IMAGE_STORAGE, image_path, import_flat_images, storage_key
+import fragment_cache
+from fragment_cache import render_recipe
+from static_assets import ASSETS, StaticAssets, static_url
+from compression import COMPRESSION_STATS, CompressionMiddleware
+from rate_limiter import create_limiter
+from metrics import METRICS_ENABLED, METRICS_TOKEN, REGISTRY, MetricsMiddleware
+from rendering import StreamingTemplates, create_templates
+from query_profiler import QUERY_PROFILER, QueryProfilerMiddleware, query_budget
+from logging_config import setup_logging
+import async_database_handler
+import auth_handler
 import database_handler
-from auth_handler import create_access_token, verify_access_token
+from auth_handler import CurrentUser, create_access_token, verify_access_token
 from models import User, Recipe
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, Form, HTTPException, Response, File, UploadFile
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
+from fastapi import APIRouter, FastAPI, Request, Form, HTTPException, Response, Query
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.encoders import jsonable_encoder
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
+from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
 
+STARTUP.lap("imports")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    database_handler.startup()
+    with STARTUP.step("database"):
+        async_database_handler.startup()
+    with STARTUP.step("static_assets"):
+        ASSETS.build()
+        renamed = database_handler.legacy_images()
+        import_flat_images("static/recipe_images", IMAGE_STORAGE, renamed)
+        database_handler.forget_legacy_images(list(renamed))
+    with STARTUP.step("workers"):
+        HASHING_SERVICE.start()
+        IMAGE_PIPELINE.start()
+        IMAGE_GC.start()
+    with STARTUP.step("warm_up"):
+        warm_up()
+    if METRICS_ENABLED:
+        REGISTRY.start()
+    STARTUP.ready()
     yield
+    limiter.flush()
+    IMAGE_GC.shutdown()
+    IMAGE_PIPELINE.shutdown()
+    HASHING_SERVICE.shutdown()
+    async_database_handler.shutdown()
+    REGISTRY.stop()
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
-limiter = Limiter(key_func=get_remote_address)
+limiter = create_limiter()
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", "10"))
 
-app = FastAPI(lifespan=lifespan,
-              title="Recipe App",
-              version="1.0.0",
-              description="A simple recipe database API with user authentication and rate limiting. For Web Engineering 2",
-              docs_url=None,
-              redoc_url=None,
-              openapi_url=None
-              )
+router = APIRouter()
 
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
 
-@app.get("/recipes/index.html")
-@app.get("/recipes/content.php")
-@app.get("/recipes/login.php")
-@app.get("/recipes/register.php")
-async def render_home(request: Request):
+def create_app() -> FastAPI:
+    """Creates the application with its middleware and routes.
+
+    `app:app` is created on first access, see `__getattr__`. Servers that call a factory can
+    use this function instead, e.g. `uvicorn --factory app:create_app`.
+
+    Returns:
+        FastAPI: The application.
+    """
+    with STARTUP.step("create_app"):
+        app = FastAPI(lifespan=lifespan,
+                      title="Recipe App",
+                      version="1.0.0",
+                      description="A simple recipe database API with user authentication and rate limiting. For Web Engineering 2",
+                      docs_url=None,
+                      redoc_url=None,
+                      openapi_url=None
+                      )
+
+        app.state.limiter = limiter
+        app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+        app.add_exception_handler(HashingQueueFull, hashing_queue_full_handler)
+        app.mount("/static", StaticAssets(ASSETS), name="static")
+        if QUERY_PROFILER:
+            app.add_middleware(QueryProfilerMiddleware)
+        app.add_middleware(CompressionMiddleware)
+        if METRICS_ENABLED:
+            app.add_middleware(MetricsMiddleware)
+        app.include_router(router)
+    return app
+
+
+def __getattr__(name: str):
+    """Creates `app` when it is first accessed, e.g. by `uvicorn app:app`, so importing this
+    module or serving `create_app` does not create an application that is never used."""
+    if name == "app":
+        app = create_app()
+        globals()["app"] = app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+templates = create_templates()
+templates.env.filters["srcset"] = srcset
+templates.env.globals["static_url"] = static_url
+# the long pages are streamed while they are rendered
+pages = StreamingTemplates(templates)
+
+
+def warm_up():
+    """Compiles the templates, opens the database connections and fills the recipe cache.
+
+    Runs during the lifespan startup, which uvicorn completes before it accepts connections.
+    """
+    started = time.perf_counter()
+    pages.precompile()
+    database = database_handler.warm_up()
+    logger.info("Warm-up took %.0f ms", (time.perf_counter() - started) * 1000, extra=database)
+
+
+def collect_metrics():
+    """Reports the counters the caches and worker pools keep themselves to `/metrics`."""
+    caches = {
+        "recipe": database_handler.RECIPE_CACHE,
+        "user_id": database_handler.USER_ID_CACHE,
+        "fragment": fragment_cache.FRAGMENT_CACHE,
+        "token": auth_handler.TOKEN_CACHE,
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        yield "cache_hits_total", "counter", "Cache hits by cache.", {"cache": name}, stats["hits"]
+        yield "cache_misses_total", "counter", "Cache misses by cache.", {"cache": name}, stats["misses"]
+        yield "cache_entries", "gauge", "Entries held by each cache.", {"cache": name}, stats["size"]
+    yield "hashing_queue_depth", "gauge", "Password hashing operations queued or running.", {}, HASHING_SERVICE.queue_depth
+    yield "image_queue_depth", "gauge", "Uploaded images queued or being processed.", {}, IMAGE_PIPELINE.queue_depth
+    images = IMAGE_GC.stats()
+    yield "image_files", "gauge", "Files in the recipe image directory as of the last sweep.", {}, images["files"]
+    yield "image_bytes", "gauge", "Bytes used by the recipe images as of the last sweep.", {}, images["bytes"]
+    yield "image_orphans", "gauge", "Images no recipe refers to found by the last sweep.", {}, images["orphans"]
+    yield "image_deleted_files_total", "counter", "Unreferenced image files deleted.", {}, images["deleted_files"]
+    yield "image_freed_bytes_total", "counter", "Bytes freed by deleting unreferenced images.", {}, images["freed_bytes"]
+    if images["free_bytes"] is not None:
+        yield "image_disk_free_bytes", "gauge", "Free space on the volume of the local image storage.", {}, images["free_bytes"]
+    for route, stats in COMPRESSION_STATS.stats().items():
+        yield "compression_bytes_in_total", "counter", "Response bytes before compression by route.", {"route": route}, stats["bytes_in"]
+        yield "compression_bytes_out_total", "counter", "Response bytes after compression by route.", {"route": route}, stats["bytes_out"]
+
+
+REGISTRY.register_collector(collect_metrics)
+
+
+@router.get("/recipes/index.html")
+@router.get("/recipes/content.php")
+@router.get("/recipes/login.php")
+@router.get("/recipes/register.php")
+async def render_home(request: Request, user: CurrentUser):
     """
     Handles POST requests to the home page.
 
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
 
     Returns:
         TemplateResponse: Renders the home page if the user is authenticated.
             If the user is not authenticated, it redirects to the login page.
     """
-    payload = verify_access_token(request)
-
-    if not payload:
+    if user is None:
         return templates.TemplateResponse("login.jinja2", {"request": request})
 
-    username = payload["sub"]
-    return templates.TemplateResponse("home.jinja2", {"request": request, "username": username})
+    return templates.TemplateResponse("home.jinja2", {"request": request, "username": user.username})
 
-@app.post("/")
-@app.get("/")
-async def home(request: Request):
-    payload = verify_access_token(request)
-
-    if not payload:
+@router.post("/")
+@router.get("/")
+@query_budget(2)
+async def home(request: Request, user: CurrentUser):
+    if user is None:
         return RedirectResponse(url="/forbidden")
 
-    username = payload["sub"]
-    recipes = database_handler.get_recipes()
-    return templates.TemplateResponse("home.jinja2", {"request": request, "username": username, "recipes": recipes})
+    username = user.username
+    recipes, next_cursor = await async_database_handler.get_recipe_page(username, amount=FEED_PAGE_SIZE)
+    return pages.response("home.jinja2", {"request": request, "username": username, "recipes": recipes, "next_cursor": next_cursor})
+
 
+@router.get("/api/recipes/feed")
+@query_budget(2)
+async def recipe_feed(request: Request, user: CurrentUser, cursor: str):
+    """
+    Returns the next page of the home feed for infinite scrolling.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        cursor (str): The cursor of the page to fetch, as returned with the previous page.
 
-@app.get("/forbidden")
+    Returns:
+        TemplateResponse: Renders the recipe cards of the page. The cursor of the following page
+            is sent in the `X-Next-Cursor` header, which is missing on the last page.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+        JSONResponse: Returns a 400 Bad Request response if the cursor is malformed.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    try:
+        recipes, next_cursor = await async_database_handler.get_recipe_page(user.username, cursor, FEED_PAGE_SIZE)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid cursor"})
+    response = templates.TemplateResponse("recipeCards.jinja2", {"request": request, "recipes": recipes})
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@router.get("/api/recipes/search")
+@query_budget(2)
+async def search_recipes(request: Request,
+                         user: CurrentUser,
+                         tag: Annotated[list[str], Query(max_length=100)] = [],
+                         ingredient: Annotated[list[str], Query(max_length=100)] = [],
+                         q: Annotated[str, Query(max_length=200)] = "",
+                         cursor: str | None = None):
+    """
+    Searches the recipes visible to the user.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        tag (list[str]): Tags the recipes must have, may be given several times.
+        ingredient (list[str]): Ingredients the recipes must contain, may be given several times.
+        q (str): Words that must occur in the title or description.
+        cursor (str | None): The cursor of the page to fetch, as returned with the previous page.
+
+    Returns:
+        JSONResponse: The matching recipes, newest first, and the cursor of the next page.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+        JSONResponse: Returns a 400 Bad Request response if the cursor is malformed or too many terms are given.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    if len(tag) + len(ingredient) > 10:
+        return JSONResponse(status_code=400, content={"error": "Too many search terms"})
+    try:
+        recipes, next_cursor = await async_database_handler.search_recipes(user.username, tag, ingredient, q, cursor)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid cursor"})
+    return JSONResponse(status_code=200, content={"recipes": jsonable_encoder(recipes), "next_cursor": next_cursor})
+
+
+@router.get("/forbidden")
 async def forbidden(request: Request):
     """
     Renders a forbidden page when the user is not authenticated.
@@ -87,7 +275,7 @@ async def forbidden(request: Request):
     return templates.TemplateResponse("forbidden.jinja2", {"request": request})
 
 
-@app.get("/teapot")
+@router.get("/teapot")
 async def teapot(request: Request):
     """
     Handles the GET request for the teapot endpoint.
@@ -96,8 +284,9 @@ async def teapot(request: Request):
     """
     return JSONResponse(status_code=418, content={"error": "I'm a teapot"})
 
-@app.post("/login")
+@router.post("/login")
 @limiter.limit("50/minute")
+@query_budget(2)
 async def login(request: Request, response: Response, user: Annotated[User, Form()]):
     """Handles user login by verifying credentials and generating an access token.
 
@@ -115,23 +304,24 @@ async def login(request: Request, response: Response, user: Annotated[User, Form
     if user.password == "" or user.username == "":
         errors.append("Username or password cannot be empty")
         return templates.TemplateResponse(name="login.jinja2", context={"success": False, "errors": errors, 'request': request})
-    verification_user = database_handler.get_user(user.username)
+    verification_user = await async_database_handler.get_user(user.username)
     if verification_user is None:
         errors.append("User does not exist")
         return templates.TemplateResponse(name="login.jinja2", context={"success": False, "errors": errors, 'request': request})
-    if password_validator.Hasher.verify_password(user.password, verification_user.password):
-        token = create_access_token({"sub": user.username})
+    verified, new_hash = await HASHING_SERVICE.verify_and_update(user.password, verification_user.password)
+    if verified:
+        if new_hash:
+            await async_database_handler.update_user_password(verification_user.id, new_hash)
+        token = create_access_token({"sub": user.username, "user_id": verification_user.id})
         response = RedirectResponse(url="/")
         response.set_cookie(key="access_token", value=token, httponly=True)
         return response
-    elif database_handler.get_user(user.username) is None:
-        errors.append("User does not exist")
     else:
         errors.append("Invalid credentials")
 
     return templates.TemplateResponse(name="login.jinja2", context={"success": False, "errors": errors, 'request': request})
 
-@app.get("/login", response_class=HTMLResponse)
+@router.get("/login", response_class=HTMLResponse)
 @limiter.limit("5/minute")
 async def root(request: Request):
     """
@@ -147,7 +337,7 @@ async def root(request: Request):
         request=request, name="login.jinja2"
     )
 
-@app.get("/logout")
+@router.get("/logout")
 @limiter.limit("5/minute")
 async def logout(request: Request):
     """
@@ -162,7 +352,7 @@ async def logout(request: Request):
     return response
 
 
-@app.get("/get_login_state")
+@router.get("/get_login_state")
 @limiter.limit("5/minute")
 async def get_login_state(request: Request):
     """
@@ -183,8 +373,83 @@ async def get_login_state(request: Request):
     except Exception:
         return {"success": False, "message": "An unexpected error occurred"}
 
-@app.post("/register")
+@router.get("/api/stats")
+async def get_stats(request: Request, user: CurrentUser):
+    """
+    Reports runtime statistics of the app for monitoring.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+
+    Returns:
+        dict: The statistics of the app's subsystems.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    return {
+        "hashing": {
+            "workers": HASHING_SERVICE.workers,
+            "queue_depth": HASHING_SERVICE.queue_depth,
+            "queue_size": HASHING_SERVICE.queue_size,
+        },
+        "image_pipeline": {
+            "workers": IMAGE_PIPELINE.workers,
+            "queue_depth": IMAGE_PIPELINE.queue_depth,
+        },
+        "recipe_cache": database_handler.RECIPE_CACHE.stats(),
+        "user_id_cache": database_handler.USER_ID_CACHE.stats(),
+        "fragment_cache": fragment_cache.FRAGMENT_CACHE.stats(),
+        "static_assets": ASSETS.stats(),
+        "images": IMAGE_GC.stats(),
+        "compression": COMPRESSION_STATS.stats(),
+        "token_cache": auth_handler.TOKEN_CACHE.stats(),
+        "rate_limiter": limiter.stats(),
+        "startup": STARTUP.stats(),
+    }
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    """
+    Exposes the metrics of all workers in the Prometheus text format.
+
+    Args:
+        request (Request): The incoming HTTP request, with `METRICS_TOKEN` as bearer token if one is set.
+
+    Returns:
+        PlainTextResponse: The current values of the metrics.
+        JSONResponse: Returns a 401 Unauthorized response if the bearer token is missing or wrong.
+        JSONResponse: Returns a 404 Not Found response if metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "Not found"})
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", "").encode(),
+                                                 f"Bearer {METRICS_TOKEN}".encode()):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"}, headers={"WWW-Authenticate": "Bearer"})
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.api_route("/images/{key}", methods=["GET", "HEAD"], include_in_schema=False)
+@query_budget(0)
+async def get_image(request: Request, key: str):
+    """
+    Serves a recipe image from the image storage, see `image_storage`.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        key (str): The storage key of the image, the `img_path` without `images/`.
+
+    Returns:
+        Response: The image, or the requested byte range of it, with an immutable `Cache-Control`
+            header. A 304 response if `If-None-Match` names its ETag, 404 if it does not exist.
+    """
+    if storage_key(image_path(key)) is None:
+        return Response(status_code=404)
+    return await IMAGE_STORAGE.response(key, request)
+
+@router.post("/register")
 @limiter.limit("5/minute")
+@query_budget(2)
 async def login(request: Request, username: str = Form(...), password: str = Form(...), confirm_password: str = Form(...)):
     errors = []
     if password == "" or username == "" or confirm_password == "":
@@ -196,21 +461,24 @@ async def login(request: Request, username: str = Form(...), password: str = For
     if len(errors) != 0:
         return templates.TemplateResponse(name="login.jinja2", context={"success": False, "errors": errors, 'request': request})
     else:
-        password = password_validator.Hasher.get_password_hash(password)
+        password = await HASHING_SERVICE.get_password_hash(password)
         user = User(username=username, password=password)
-        database_handler.create_user(user)
+        if not await async_database_handler.create_user(user):
+            errors.append("Username already exists")
+            return templates.TemplateResponse(name="login.jinja2", context={"success": False, "errors": errors, 'request': request})
         return templates.TemplateResponse(name="login.jinja2", context={"success": True, 'request': request})
 
 
 
-@app.get("/recipe/add")
+@router.get("/recipe/add")
 @limiter.limit("10/minute")
-async def add_recipe(request: Request):
+async def add_recipe(request: Request, user: CurrentUser):
     """
      Handles the GET request for the recipe creation page.
 
      Args:
          request (Request): The incoming HTTP request.
+         user (AuthenticatedUser | None): The logged in user.
 
      Returns:
          TemplateResponse:
@@ -218,7 +486,7 @@ async def add_recipe(request: Request):
          RedirectResponse:
              - Redirects the forbidden page if the user is not authenticated.
      """
-    if verify_access_token(request):
+    if user is not None:
         return templates.TemplateResponse(
             request=request, name="createRecipe.jinja2"
         )
@@ -226,288 +494,456 @@ async def add_recipe(request: Request):
         return RedirectResponse(url="/forbidden")
 
 
-@app.post("/recipe/add")
+@router.post("/recipe/add")
 @limiter.limit("5/minute")
-async def add_recipe(
-    request: Request,
-    title: str = Form(...),
-    img_path: UploadFile = File(...),
-    portions: int = Form(...),
-    prep_time: int = Form(...),
-    cook_time: int = Form(...),
-    description: str = Form(...),
-    is_public: str = Form(default=""),
-):
+@query_budget(6)
+async def add_recipe(request: Request, user: CurrentUser):
     """
        Handles the POST request for adding a new recipe.
 
+       The multipart form is parsed from the request stream, see `upload_handler.parse_recipe_form`.
+       It contains the fields title, img_path (the image file), portions, prep_time, cook_time,
+       description, is_public and the ingredient and tag lists.
+
        Args:
            request (Request): The incoming HTTP request.
-           title (str): The title of the recipe.
-           img_path (UploadFile): The uploaded image file for the recipe.
-           portions (int): The number of portions the recipe serves.
-           prep_time (int): The preparation time in minutes.
-           cook_time (int): The cooking time in minutes.
-           description (str): A description or instructions for the recipe.
-           is_public (str): Whether the recipe is public or not.
+           user (AuthenticatedUser | None): The logged in user.
 
        Returns:
            TemplateResponse:
                - Renders the recipe page if the recipe is successfully created.
                - Renders the forbidden page if the user is not authenticated.
-               - Renders the recipe creation page with errors if the image upload fails.
+               - Renders the recipe creation page with errors if the form or the image upload is invalid.
 
        """
-    token = verify_access_token(request)
-
-    if token:
-        author = token.get("sub")
-        user_id = database_handler.get_user(author).id
-        form_data = await request.form()
-        # Extract the form data
-        data = {key: value for key, value in form_data.items()}
-        # Extract the ingredient and tag data
-        ingredients = explode_ingredient_list(data)
-        tags = get_tags(data, "tags")
-
-        path = upload_recipe_img(img_path, title)
-
-        if path is None:
-            errors = ["Invalid image file or file exceeds 10MB"]
-            return templates.TemplateResponse("createRecipe.jinja2", {"request": request, "errors": errors})
-        if is_public == "public":
-            is_public = True
-        else:
-            is_public = False
+    if user is not None:
+        author = user.username
+        try:
+            data, upload = await parse_recipe_form(request)
+        except UploadRejected as e:
+            return templates.TemplateResponse("createRecipe.jinja2", {"request": request, "errors": [e.message]}, status_code=e.status_code)
+        try:
+            fields = read_recipe_fields(data)
+            if upload is None:
+                raise ValueError("Please upload an image")
+        except ValueError as e:
+            if upload is not None:
+                upload.discard()
+            return templates.TemplateResponse("createRecipe.jinja2", {"request": request, "errors": [str(e)]}, status_code=400)
+        try:
+            variants = await run_in_threadpool(upload_recipe_img, upload)
+        except ValueError as e:
+            return templates.TemplateResponse("createRecipe.jinja2", {"request": request, "errors": [str(e)]}, status_code=400)
 
         recipe = Recipe(
-            title=title,
-            img_path=path,
-            portions=portions,
-            prep_time=prep_time,
-            cook_time=cook_time,
-            text=description,
-            ingredients=ingredients,
-            tags=tags,
+            title=fields["title"],
+            img_path=variants["full"],
+            img_variants=variants,
+            portions=fields["portions"],
+            prep_time=fields["prep_time"],
+            cook_time=fields["cook_time"],
+            text=fields["text"],
+            ingredients=explode_ingredient_list(data),
+            tags=get_tags(data, "tags"),
             author=author,
-            author_id=user_id,
-            is_public=is_public
+            author_id=user.id,
+            is_public=fields["is_public"]
         )
-        print(data)
-        database_handler.create_recipe(recipe)
+        await async_database_handler.create_recipe(recipe)
         return RedirectResponse(url="/")
     else:
         return RedirectResponse(url="/forbidden")
 
 
-@app.get("/recipe/view/{recipe_id}")
+@router.get("/recipe/view/{recipe_id}")
 @limiter.limit("5/minute")
-async def view_recipe(request: Request, recipe_id: int):
+@query_budget(1)
+async def view_recipe(request: Request, user: CurrentUser, recipe_id: int):
     """
     Retrieves and displays a recipe based on its ID.
 
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
         recipe_id (int): The unique identifier of the recipe to retrieve.
 
     Returns:
         TemplateResponse: Renders the recipe page if the recipe is found.
         TemplateResponse: Returns an 404 page if the recipe is not found.
+        Response: Returns an empty 304 response if the client's cached copy is current.
     """
-    token = verify_access_token(request)
-    author = token.get("sub")
-    recipe = database_handler.get_recipe(recipe_id)
-    if not token:
+    if user is None:
         return RedirectResponse(url="/forbidden")
+    author = user.username
+    recipe = await async_database_handler.get_recipe(recipe_id)
     if recipe is None:
         return templates.TemplateResponse("404.jinja2", {"request": request, "error": "Recipe not found"})
     if recipe.is_public is False and recipe.author != author:
         return RedirectResponse(url="/forbidden")
-    return templates.TemplateResponse("recipe.jinja2", {"request": request, "recipe": recipe})
+    return render_recipe(templates, request, "recipe.jinja2", recipe, recipe.author == author, pages=pages)
 
-@app.get("/api/recipe/get-partial/{recipe_id}")
-@limiter.limit("10/minute")
+@router.get("/api/recipe/get-partial/{recipe_id}")
 @limiter.limit("10/minute")
-async def recipe_partial(request: Request, recipe_id: int):
+@query_budget(1)
+async def recipe_partial(request: Request, user: CurrentUser, recipe_id: int):
     """
     Retrieves a partial view of a recipe based on its ID.
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
         recipe_id (int): The unique identifier of the recipe to retrieve.
     Returns:
-        TemplateResponse: Renders a partial view of the recipe if the user is authenticated and authorized.
+        HTMLResponse: Renders a partial view of the recipe if the user is authenticated and authorized.
+        Response: Returns an empty 304 response if the client's cached copy is current.
         JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
         JSONResponse: Returns a 404 Not Found response if the recipe does not exist.
     """
-    token = verify_access_token(request)
-    if not token:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    user = token.get("sub")
-    recipe = database_handler.get_recipe(recipe_id)
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    username = user.username
+    recipe = await async_database_handler.get_recipe(recipe_id)
     # maybe here it should just return an error, instead of 404 or 401 to keep data secret from unauthorized users.
     # But I decided to keep it like this for now
     if recipe is None:
-        return JSONResponse(status_code=404, content={"Recipe not found"})
-    if recipe.is_public is False and recipe.author != user:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    return templates.TemplateResponse("recipePartial.jinja2", {"request": request, "recipe": recipe, "user": user})
-
-@app.get("/api/recipe/get/{recipe_id}")
-async def get_recipe(request: Request, recipe_id: int):
+        return JSONResponse(status_code=404, content={"error": "Recipe not found"})
+    if recipe.is_public is False and recipe.author != username:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    is_author = recipe.author == username
+    return render_recipe(templates, request, "recipePartial.jinja2", recipe, is_author, {"user": username if is_author else None})
+
+@router.get("/api/recipe/get/{recipe_id}")
+@query_budget(1)
+async def get_recipe(request: Request, user: CurrentUser, recipe_id: int):
     """
     Retrieves a recipe by its ID and returns it in JSON format.
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
         recipe_id (int): The unique identifier of the recipe to retrieve.
     Returns:
         JSONResponse: Returns the recipe in JSON format if the user is authenticated and authorized.
         JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
         JSONResponse: Returns a 404 Not Found response if the recipe does not exist.
     """
-    token = verify_access_token(request)
-    if not token:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    user = token.get("sub")
-    recipe = database_handler.get_recipe(recipe_id)
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    recipe = await async_database_handler.get_recipe(recipe_id)
     if recipe is None:
-        return JSONResponse(status_code=404, content={"Recipe not found"})
-    if recipe.is_public is False and recipe.author != user:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    return JSONResponse(status_code=200, content={"recipe": jsonable_encoder(recipe)})
+        return JSONResponse(status_code=404, content={"error": "Recipe not found"})
+    if recipe.is_public is False and recipe.author != user.username:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    return JSONResponse(status_code=200, content={"recipe": jsonable_encoder(recipe)}, headers={"ETag": version_etag(recipe)})
 
-@app.delete("/api/recipe/delete/{recipe_id}")
-@limiter.limit("5/minute")
-async def delete_recipe(request: Request, recipe_id: int):
-    token = verify_access_token(request)
-    if not token:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    user = token.get("sub")
-    recipe = database_handler.get_recipe(recipe_id)
+@router.patch("/api/recipe/{recipe_id}")
+@limiter.limit("10/minute")
+@query_budget(6)
+async def patch_recipe(request: Request, user: CurrentUser, recipe_id: int):
+    """
+    Changes some fields of a recipe.
+
+    The body is a JSON object with the fields to change, see `recipe_import.RecipePatch`. The
+    `If-Match` header must carry the ETag of the recipe version the change is based on, as
+    returned by `/api/recipe/get/{recipe_id}` or a previous PATCH, so concurrent changes do not
+    overwrite each other.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        recipe_id (int): The unique identifier of the recipe to change.
+
+    Returns:
+        JSONResponse: The changed recipe with its new ETag.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated or not the author.
+        JSONResponse: Returns a 404 Not Found response if the recipe does not exist.
+        JSONResponse: Returns a 428 Precondition Required response without `If-Match`.
+        JSONResponse: Returns a 412 Precondition Failed response with the current ETag if the
+            recipe was changed in the meantime.
+        JSONResponse: Returns a 413 or 422 response if the body is too large or invalid.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    recipe = await async_database_handler.get_recipe(recipe_id)
     if recipe is None:
-        return JSONResponse(status_code=404, content={"Recipe not found"})
-    if recipe.author != user:
-        return JSONResponse(status_code=401, content={"Unauthorized"})
-    database_handler.delete_recipe(recipe_id)
-    return {200, "Recipe deleted successfully"}
+        return JSONResponse(status_code=404, content={"error": "Recipe not found"})
+    if recipe.author != user.username:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    if_match = request.headers.get("if-match")
+    if if_match is None:
+        return JSONResponse(status_code=428, content={"error": "If-Match header required"})
+    version = parse_if_match(if_match, recipe_id)
+    try:
+        changes = await read_patch(request)
+    except RequestRejected as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
+    try:
+        if version is None:
+            raise database_handler.VersionConflict(recipe)
+        patched = await async_database_handler.patch_recipe(recipe_id, version, changes)
+    except database_handler.VersionConflict as e:
+        return JSONResponse(status_code=412, content={"error": "Recipe was changed", "version": e.recipe.version},
+                            headers={"ETag": version_etag(e.recipe)})
+    if patched is None:
+        return JSONResponse(status_code=404, content={"error": "Recipe not found"})
+    IMAGE_GC.release(*recipe_images(recipe) - recipe_images(patched))
+    return JSONResponse(status_code=200, content={"recipe": jsonable_encoder(patched)}, headers={"ETag": version_etag(patched)})
+
+@router.get("/api/recipes")
+@query_budget(1)
+async def get_recipe_batch(request: Request, user: CurrentUser, ids: Annotated[str, Query(max_length=10000)]):
+    """
+    Retrieves several recipes at once.
 
-@app.get("/recipe/edit/{recipe_id}")
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        ids (str): The comma separated IDs of the recipes, e.g. `1,2,3`.
+
+    Returns:
+        JSONResponse: One result per ID in the given order, with the status the single recipe
+            route would answer with and the recipe if it is visible to the user.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+        JSONResponse: Returns a 400 or 413 response if the IDs are malformed or too many.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    try:
+        recipe_ids = parse_ids(ids)
+    except RequestRejected as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
+    recipes = await async_database_handler.get_recipes_by_ids(recipe_ids)
+    results = []
+    for recipe_id in recipe_ids:
+        recipe = recipes.get(recipe_id)
+        if recipe is None:
+            results.append({"id": recipe_id, "status": 404, "error": "Recipe not found"})
+        elif recipe.is_public is False and recipe.author != user.username:
+            results.append({"id": recipe_id, "status": 401, "error": "Unauthorized"})
+        else:
+            results.append({"id": recipe_id, "status": 200, "recipe": jsonable_encoder(recipe)})
+    return JSONResponse(status_code=200, content={"results": results})
+
+@router.post("/api/recipes/import")
 @limiter.limit("5/minute")
-async def edit_recipe(request: Request, recipe_id: int):
-    token = verify_access_token(request)
-    if not token:
+@query_budget(3)
+async def import_recipes(request: Request, user: CurrentUser):
+    """
+    Creates several recipes of the user in one transaction.
+
+    The body is a JSON array of recipes or, with the content type `application/x-ndjson`, one
+    recipe per line, in the format `/api/recipe/get/{id}` returns. See `recipe_import`.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+
+    Returns:
+        JSONResponse: One result per recipe in the given order, with status 201 and the ID of
+            the created recipe or status 422 and the reason the recipe was refused.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+        JSONResponse: Returns a 400 or 413 response if the body is malformed or too large.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    try:
+        entries = await read_import(request)
+    except RequestRejected as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
+    results, recipes = await run_in_threadpool(to_recipes, entries, user.username, user.id)
+    if recipes:
+        recipe_ids = iter(await async_database_handler.create_recipes(recipes))
+        for result in results:
+            if result["status"] == 201:
+                result["id"] = next(recipe_ids)
+    return JSONResponse(status_code=200, content={"created": len(recipes), "results": results})
+
+@router.delete("/api/recipes")
+@limiter.limit("5/minute")
+@query_budget(4)
+async def delete_recipe_batch(request: Request, user: CurrentUser, ids: Annotated[str, Query(max_length=10000)]):
+    """
+    Deletes several recipes of the user in one transaction.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        ids (str): The comma separated IDs of the recipes, e.g. `1,2,3`.
+
+    Returns:
+        JSONResponse: One result per ID in the given order, with status 200 if the recipe was
+            deleted, 404 if it does not exist or 401 if it belongs to another user.
+        JSONResponse: Returns a 401 Unauthorized response if the user is not authenticated.
+        JSONResponse: Returns a 400 or 413 response if the IDs are malformed or too many.
+    """
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    try:
+        recipe_ids = parse_ids(ids)
+    except RequestRejected as e:
+        return JSONResponse(status_code=e.status_code, content={"error": e.message})
+    recipes = await async_database_handler.get_recipes_by_ids(recipe_ids)
+    results = []
+    owned = []
+    for recipe_id in recipe_ids:
+        recipe = recipes.get(recipe_id)
+        if recipe is None:
+            results.append({"id": recipe_id, "status": 404, "error": "Recipe not found"})
+        elif recipe.author != user.username:
+            results.append({"id": recipe_id, "status": 401, "error": "Unauthorized"})
+        else:
+            owned.append(recipe_id)
+            results.append({"id": recipe_id, "status": 200})
+    if owned and not await async_database_handler.delete_recipes(owned, user.username):
+        for result in results:
+            if result["status"] == 200:
+                result.update(status=500, error="Deleting the recipe failed")
+    elif owned:
+        for recipe_id in owned:
+            IMAGE_GC.release(*recipe_images(recipes[recipe_id]))
+    return JSONResponse(status_code=200, content={"results": results})
+
+@router.delete("/api/recipe/delete/{recipe_id}")
+@limiter.limit("5/minute")
+@query_budget(5)
+async def delete_recipe(request: Request, user: CurrentUser, recipe_id: int):
+    if user is None:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    recipe = await async_database_handler.get_recipe(recipe_id)
+    if recipe is None:
+        return JSONResponse(status_code=404, content={"error": "Recipe not found"})
+    if recipe.author != user.username:
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    if await async_database_handler.delete_recipe(recipe_id):
+        IMAGE_GC.release(*recipe_images(recipe))
+    return JSONResponse(status_code=200, content={"message": "Recipe deleted successfully"})
+
+@router.get("/recipe/edit/{recipe_id}")
+@limiter.limit("5/minute")
+@query_budget(1)
+async def edit_recipe(request: Request, user: CurrentUser, recipe_id: int):
+    if user is None:
         return RedirectResponse(url="/forbidden")
 
-    recipe = database_handler.get_recipe(recipe_id)
+    recipe = await async_database_handler.get_recipe(recipe_id)
     if not recipe:
         return {"Error": "Recipe not found"}
-    if recipe.author != token.get("sub"):
+    if recipe.author != user.username:
         return RedirectResponse(url="/forbidden")
 
     return templates.TemplateResponse("editRecipe.jinja2", {"request": request, "recipe": recipe})
 
-@app.post("/recipe/edit/{recipe_id}")
+@router.post("/recipe/edit/{recipe_id}")
 @limiter.limit("10/minute")
-async def edit_recipe(request: Request,
-                      recipe_id: int,
-                      title: str = Form(...),
-                      img_path: UploadFile = File(...),
-                      portions: int = Form(...),
-                      prep_time: int = Form(...),
-                      cook_time: int = Form(...),
-                      description: str = Form(...),
-                      is_public: str = Form(default="")):
-    token = verify_access_token(request)
-
-    if token:
-        user = token.get("sub")
-        user_id = database_handler.get_user(user).id
-        form_data = await request.form()
-        # Extract the form data
-        data = {key: value for key, value in form_data.items()}
-        # Extract the ingredient and tag data
-        ingredients = explode_ingredient_list(data)
-        tags = get_tags(data, "tags")
-
-        path = upload_recipe_img(img_path, title)
-        original_recipe = database_handler.get_recipe(recipe_id)
+@query_budget(7)
+async def edit_recipe(request: Request, user: CurrentUser, recipe_id: int):
+    """
+    Handles the POST request for editing a recipe.
+
+    The form has the same fields as the one of `add_recipe`, the image is optional and the
+    previous image is kept if none is sent.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
+        recipe_id (int): The unique identifier of the recipe to edit.
+
+    Returns:
+        RedirectResponse: Redirects to the home page after the recipe was updated, or to the
+            forbidden page if the user is not authenticated.
+        TemplateResponse: Renders an error page if the recipe does not exist, belongs to another
+            user or the form is invalid.
+    """
+    if user is not None:
+        original_recipe = await async_database_handler.get_recipe(recipe_id)
         if original_recipe is None:
             return templates.TemplateResponse("404.jinja2", {"request": request, "error": "Recipe not found"})
-        if original_recipe.author != user:
+        if original_recipe.author != user.username:
             return templates.TemplateResponse("forbidden.jinja2", {"request": request, "error": "You are not allowed to edit this recipe"})
-        if path is None:
-            path = original_recipe.img_path
-
-        if is_public == "public":
-            is_public = True
+        try:
+            data, upload = await parse_recipe_form(request)
+        except UploadRejected as e:
+            return templates.TemplateResponse("editRecipe.jinja2", {"request": request, "recipe": original_recipe, "errors": [e.message]}, status_code=e.status_code)
+        try:
+            fields = read_recipe_fields(data)
+        except ValueError as e:
+            if upload is not None:
+                upload.discard()
+            return templates.TemplateResponse("editRecipe.jinja2", {"request": request, "recipe": original_recipe, "errors": [str(e)]}, status_code=400)
+        if upload is None:
+            path, variants = original_recipe.img_path, original_recipe.img_variants
         else:
-            is_public = False
+            try:
+                variants = await run_in_threadpool(upload_recipe_img, upload)
+            except ValueError as e:
+                return templates.TemplateResponse("editRecipe.jinja2", {"request": request, "recipe": original_recipe, "errors": [str(e)]}, status_code=400)
+            path = variants["full"]
+
         # Create a new recipe object with the updated data
         recipe = Recipe(
-            title=title,
+            title=fields["title"],
             img_path=path,
-            portions=portions,
-            prep_time=prep_time,
-            cook_time=cook_time,
-            text=description,
-            ingredients=ingredients,
-            tags=tags,
-            author=user,
-            author_id=user_id,
-            is_public=is_public,
+            img_variants=variants,
+            portions=fields["portions"],
+            prep_time=fields["prep_time"],
+            cook_time=fields["cook_time"],
+            text=fields["text"],
+            ingredients=explode_ingredient_list(data),
+            tags=get_tags(data, "tags"),
+            author=user.username,
+            author_id=user.id,
+            is_public=fields["is_public"],
             id = original_recipe.id,
         )
-
-
-
-        print(data)
-        database_handler.update_recipe(recipe)
+        if await async_database_handler.update_recipe(recipe):
+            IMAGE_GC.release(*recipe_images(original_recipe) - recipe_images(recipe))
         return RedirectResponse(url="/")
     else:
         return RedirectResponse(url="/forbidden")
 
 # add security layer to doc and redoc endpoints
-@app.get("/docs", include_in_schema=False)
-async def get_docs(request: Request):
+@router.get("/docs", include_in_schema=False)
+async def get_docs(request: Request, user: CurrentUser):
     """
     Redirects to the Swagger UI documentation page.
 
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
 
     Returns:
         RedirectResponse: Redirects to the Swagger UI documentation page.
     """
-    if not verify_access_token(request):
+    if user is None:
         return RedirectResponse(url="/forbidden")
     return get_swagger_ui_html(openapi_url="/openapi.json", title="docs")
-@app.get("/redoc", include_in_schema=False)
-async def get_redoc(request: Request):
+@router.get("/redoc", include_in_schema=False)
+async def get_redoc(request: Request, user: CurrentUser):
     """
     Redirects to the ReDoc documentation page.
 
     Args:
         request (Request): The incoming HTTP request.
+        user (AuthenticatedUser | None): The logged in user.
 
     Returns:
         RedirectResponse: Redirects to the ReDoc documentation page.
     """
-    if not verify_access_token(request):
+    if user is None:
         return RedirectResponse(url="/forbidden")
     return get_redoc_html(openapi_url="/openapi.json", title="docs")
 
-@app.get("/openapi.json", include_in_schema=False)
-def get_openapi_json(request: Request):
+@router.get("/openapi.json", include_in_schema=False)
+def get_openapi_json(request: Request, user: CurrentUser):
     """
     Generates the OpenAPI schema for the application.
 
     Returns:
         dict: The OpenAPI schema as a dictionary.
     """
-    if not verify_access_token(request):
+    if user is None:
         return RedirectResponse(url="/forbidden")
     return get_openapi(
-        title=app.title,
-        version=app.version,
-        description=app.description,
-        routes=app.routes,
+        title=request.app.title,
+        version=request.app.version,
+        description=request.app.description,
+        routes=request.app.routes,
     )
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+This module exposes the database operations of `database_handler` as coroutines.
+
+Each call runs on a bounded thread pool, so a slow query only occupies one worker thread
+instead of stalling the event loop of the uvicorn worker.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import database_handler
+from models import User, Recipe
+
+DB_THREADS = int(os.environ.get("DB_THREADS", "8"))
+EXECUTOR: ThreadPoolExecutor | None = None
+
+
+def startup():
+    """Initializes the database and starts the thread pool used for database access and the
+    background work of the recipe cache."""
+    global EXECUTOR
+    database_handler.startup()
+    database_handler.RECIPE_CACHE.start()
+    EXECUTOR = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+def shutdown():
+    """Waits for running database calls to finish and stops the thread pool and the recipe cache."""
+    global EXECUTOR
+    if EXECUTOR is not None:
+        EXECUTOR.shutdown(wait=True)
+        EXECUTOR = None
+    database_handler.RECIPE_CACHE.shutdown()
+
+
+async def _run(func, *args, **kwargs):
+    """Runs a blocking database function on the database thread pool.
+
+    The function runs in a copy of the caller's context, so context variables of the request,
+    e.g. the one of `query_profiler`, are visible to it.
+
+    Args:
+        func (Callable): The blocking function to call.
+        *args: Positional arguments for `func`.
+        **kwargs: Keyword arguments for `func`.
+
+    Returns:
+        Any: The return value of `func`.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(EXECUTOR, functools.partial(context.run, func, *args, **kwargs))
+
+
+# region user
+async def get_user(username: str) -> User | None:
+    """Fetches a user from the database by username. See `database_handler.get_user`."""
+    return await _run(database_handler.get_user, username)
+
+
+async def get_user_id(username: str) -> int | None:
+    """Fetches the ID of a user by username. See `database_handler.get_user_id`."""
+    return await _run(database_handler.get_user_id, username)
+
+
+async def create_user(user_to_create: User) -> bool:
+    """Creates a new user in the database. See `database_handler.create_user`."""
+    return await _run(database_handler.create_user, user_to_create)
+
+
+async def does_username_exist(username: str) -> bool:
+    """Checks if a username exists in the database. See `database_handler.does_username_exist`."""
+    return await _run(database_handler.does_username_exist, username)
+
+
+async def update_user_password(user_id: int, password_hash: str) -> bool:
+    """Replaces the stored password hash of a user. See `database_handler.update_user_password`."""
+    return await _run(database_handler.update_user_password, user_id, password_hash)
+
+
+# endregion user
+
+# region recipe
+async def create_recipe(recipe_to_create: Recipe):
+    """Creates a new recipe in the database. See `database_handler.create_recipe`."""
+    return await _run(database_handler.create_recipe, recipe_to_create)
+
+
+async def create_recipes(recipes: list[Recipe]) -> list[int]:
+    """Creates several recipes in one transaction. See `database_handler.create_recipes`."""
+    return await _run(database_handler.create_recipes, recipes)
+
+
+async def get_recipe(recipe_id: int) -> Recipe | None:
+    """Fetches a recipe from the database by its ID. See `database_handler.get_recipe`.
+
+    Cached recipes are returned directly, without handing the call to a database thread.
+    """
+    cached_recipe = database_handler.RECIPE_CACHE.get(recipe_id)
+    if cached_recipe is not None:
+        return cached_recipe
+    return await _run(database_handler.get_recipe, recipe_id, read_cache=False)
+
+
+async def get_recipes_by_ids(recipe_ids: list[int]) -> dict[int, Recipe]:
+    """Fetches several recipes by their IDs with one query. See `database_handler.get_recipes_by_ids`."""
+    return await _run(database_handler.get_recipes_by_ids, recipe_ids)
+
+
+async def get_recipes(viewer: str, cursor: str | None = None, amount=10) -> list[Recipe]:
+    """Fetches the recipes visible to a user with keyset pagination. See `database_handler.get_recipes`."""
+    return await _run(database_handler.get_recipes, viewer, cursor, amount)
+
+
+async def get_recipe_page(viewer: str, cursor: str | None = None, amount=10) -> tuple[list[Recipe], str | None]:
+    """Fetches one page of the feed and the next cursor. See `database_handler.get_recipe_page`."""
+    return await _run(database_handler.get_recipe_page, viewer, cursor, amount)
+
+
+async def search_recipes(viewer: str, tags: list[str] | None = None, ingredients: list[str] | None = None,
+                         query: str | None = None, cursor: str | None = None, amount=20) -> tuple[list[Recipe], str | None]:
+    """Searches the recipes visible to a user. See `database_handler.search_recipes`."""
+    return await _run(database_handler.search_recipes, viewer, tags, ingredients, query, cursor, amount)
+
+
+async def delete_recipe(recipe_id: int) -> bool:
+    """Deletes a recipe from the database by its ID. See `database_handler.delete_recipe`."""
+    return await _run(database_handler.delete_recipe, recipe_id)
+
+
+async def patch_recipe(recipe_id: int, version: int, changes: dict) -> Recipe | None:
+    """Changes some columns of a recipe at the expected version. See `database_handler.patch_recipe`."""
+    return await _run(database_handler.patch_recipe, recipe_id, version, changes)
+
+
+async def delete_recipes(recipe_ids: list[int], author: str) -> bool:
+    """Deletes several recipes of an author in one transaction. See `database_handler.delete_recipes`."""
+    return await _run(database_handler.delete_recipes, recipe_ids, author)
+
+
+async def update_recipe(recipe: Recipe) -> bool:
+    """Updates an existing recipe in the database. See `database_handler.update_recipe`."""
+    return await _run(database_handler.update_recipe, recipe)
+
+
+# endregion recipe
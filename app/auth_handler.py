@@ -1,13 +1,59 @@
+import os
+import time
+from typing import Annotated
+
 import jwt
 from datetime import datetime, timedelta
-from fastapi import Request
+from fastapi import Depends, Request
+
+import async_database_handler
+from cache import CacheBackend, LRUCache
+
+SECRET_KEY = os.environ.get("JWT_SECRET", "your_secret_key")
+# "kid:secret" pairs separated by commas. The first key signs new tokens, all keys are accepted,
+# so a new key can be put in front and the old one removed once its tokens have expired.
+JWT_SECRETS = os.environ.get("JWT_SECRETS", "")
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "4096"))
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+
+
+def parse_secrets(value: str) -> dict[str, str]:
+    """Parses the JWT_SECRETS setting.
+    args:
+        value (str): Comma separated "kid:secret" pairs, the signing key first.
+    returns:
+        dict[str, str]: The secrets keyed by key ID, in the order given. Contains only
+            SECRET_KEY under the key ID "default" if `value` is empty.
+    """
+    secrets = {}
+    for entry in value.split(","):
+        kid, _, secret = entry.strip().partition(":")
+        if kid and secret:
+            secrets[kid] = secret
+    return secrets or {"default": SECRET_KEY}
+
+
+SECRETS = parse_secrets(JWT_SECRETS)
+TOKEN_CACHE: CacheBackend = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+
+class AuthenticatedUser():
+    """
+    The user a request was authenticated as.
+
+    Attributes:
+        username (str): The username from the `sub` claim.
+        id (int): The user ID from the `user_id` claim.
+    """
+    def __init__(self, username: str, id: int):
+        self.username = username
+        self.id = id
 
-SECRET_KEY = "your_secret_key"
 
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(hours=1)):
-    """Creates a JWT access token with an expiration time.
+    """Creates a JWT access token with an expiration time, signed with the first key of SECRETS.
     args:
-        data (dict): The data to encode in the token.
+        data (dict): The data to encode in the token, i.e. `sub` and `user_id`.
         expires_delta (timedelta): The duration after which the token expires.
     returns:
         str: The encoded JWT token.
@@ -15,7 +61,57 @@ def create_access_token(data: dict, expires_delta: timedelta = timedelta(hours=1
     to_encode = data.copy()
     expire = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm="HS256")
+    kid, secret = next(iter(SECRETS.items()))
+    return jwt.encode(to_encode, secret, algorithm="HS256", headers={"kid": kid})
+
+
+def _decode(token: str) -> dict | None:
+    """Verifies a token with the key named in its header, or with every key for tokens without one."""
+    try:
+        kid = jwt.get_unverified_header(token).get("kid")
+    except jwt.InvalidTokenError:
+        return None
+    if kid is None:
+        secrets = list(SECRETS.values())
+    elif kid in SECRETS:
+        secrets = [SECRETS[kid]]
+    else:
+        return None
+    for secret in secrets:
+        try:
+            return jwt.decode(token, secret, algorithms=["HS256"])
+        except jwt.InvalidSignatureError:
+            continue
+        except jwt.InvalidTokenError:
+            return None
+    return None
+
+
+def decode_access_token(token: str | None) -> dict | None:
+    """
+    Verifies a JWT access token, decoding each distinct token at most once per TOKEN_CACHE_TTL.
+
+    The expiry is still checked on every call. A key removed from JWT_SECRETS is accepted
+    for at most TOKEN_CACHE_TTL seconds for tokens that were cached before.
+    args:
+        token (str | None): The encoded token.
+    returns:
+        dict or None: The decoded token payload if valid, None if invalid or expired.
+    """
+    if not token:
+        return None
+    payload = TOKEN_CACHE.get(token)
+    if payload is None:
+        # invalid tokens are cached as well, as False
+        payload = _decode(token) or False
+        TOKEN_CACHE.set(token, payload)
+    if not payload:
+        return None
+    expires = payload.get("exp")
+    if expires is not None and expires <= time.time():
+        return None
+    return payload
+
 
 def verify_access_token(request: Request):
     """
@@ -25,12 +121,29 @@ def verify_access_token(request: Request):
     returns:
         dict or None: The decoded token payload if valid, None if invalid or expired.
     """
-    token = request.cookies.get("access_token")
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        return payload
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
+    return decode_access_token(request.cookies.get("access_token"))
+
+
+async def get_current_user(request: Request) -> AuthenticatedUser | None:
+    """
+    FastAPI dependency returning the user of the access token cookie.
+
+    Tokens issued before the `user_id` claim existed are resolved through the cached
+    username lookup.
+    args:
+        request (Request): The FastAPI request object containing cookies.
+    returns:
+        AuthenticatedUser or None: The user, None if the request carries no valid token.
+    """
+    payload = verify_access_token(request)
+    if payload is None:
         return None
+    user_id = payload.get("user_id")
+    if user_id is None:
+        user_id = await async_database_handler.get_user_id(payload["sub"])
+        if user_id is None:
+            return None
+    return AuthenticatedUser(payload["sub"], user_id)
+
 
+CurrentUser = Annotated[AuthenticatedUser | None, Depends(get_current_user)]
@@ -0,0 +1,219 @@
+"""
+This module provides the caches used by the application.
+
+`CacheBackend` is the interface every cache implements. `LRUCache` keeps the entries in the
+memory of the current process. `RedisInvalidatedCache` keeps them in process as well, but
+publishes every deletion on a Redis channel, so all workers drop an entry once one of them
+changed the data behind it. Reads never leave the process, so a cache hit costs no round trip
+and is safe on the event loop.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+# imported by the Redis backend only, the redis package is an optional extra
+redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend():
+    """
+    Interface for key-value caches with hit and miss accounting.
+    """
+    def get(self, key: Hashable) -> Any | None:
+        """Returns the cached value for `key`, or None if it is not cached."""
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any):
+        """Stores `value` under `key`."""
+        raise NotImplementedError
+
+    def delete(self, key: Hashable):
+        """Removes `key` from the cache if present."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Returns the hit, miss and size counters of the cache."""
+        raise NotImplementedError
+
+    def start(self):
+        """Starts the background work of the cache. Called in every worker process."""
+
+    def shutdown(self):
+        """Stops the background work of the cache."""
+
+
+class LRUCache(CacheBackend):
+    """
+    A thread-safe in-process cache that evicts the least recently used entry once `maxsize`
+    entries are stored. Entries expire `ttl` seconds after they were set, a `ttl` of 0
+    disables expiry.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires and expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+
+def _import_redis():
+    """Imports redis for the Redis backed caches."""
+    global redis
+    if redis is not None:
+        return
+    try:
+        import redis as redis_module
+    except ImportError as e:
+        raise RuntimeError("A Redis backed cache needs the redis package, install the redis extra") from e
+    redis = redis_module
+
+
+class RedisInvalidatedCache(LRUCache):
+    """
+    An `LRUCache` whose deletions reach the caches of all processes subscribed to the same
+    Redis channel.
+
+    `delete` and `clear` publish the key on `channel`, and a thread of every process drops the
+    key from its own entries. Entries that were deleted while a process was not subscribed,
+    e.g. while Redis was unreachable, are caught by clearing the cache on every resubscription.
+    If a deletion cannot be published, the other processes keep the entry until it expires.
+    """
+    def __init__(self, url: str, channel: str, maxsize: int = 1024, ttl: float = 0):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        _import_redis()
+        self.channel = channel
+        self._redis = redis.Redis.from_url(url, socket_connect_timeout=1, socket_timeout=1)
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+
+    def delete(self, key: Hashable):
+        super().delete(key)
+        self._publish(key)
+
+    def clear(self):
+        super().clear()
+        # null clears the whole cache
+        self._publish(None)
+
+    def _publish(self, key: Hashable | None):
+        try:
+            self._redis.publish(self.channel, json.dumps(key))
+        except redis.RedisError as e:
+            self.errors += 1
+            logger.warning("Could not publish the invalidation of %s on %s: %s", key, self.channel, e)
+            return
+        self.published += 1
+
+    def _apply(self, data: bytes):
+        """Drops the key of a received invalidation from the entries of this process."""
+        key = json.loads(data)
+        self.received += 1
+        if key is None:
+            LRUCache.clear(self)
+        else:
+            # JSON has no tuples, keys of several parts arrive as lists
+            LRUCache.delete(self, tuple(key) if isinstance(key, list) else key)
+
+    def start(self):
+        """Subscribes to the channel on a background thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        """Stops listening for invalidations."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        subscribed = False
+        while not self._stopped.is_set():
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                if subscribed:
+                    # invalidations sent while the subscription was down were missed
+                    LRUCache.clear(self)
+                subscribed = True
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self._apply(message["data"])
+            except (redis.RedisError, ValueError) as e:
+                self.errors += 1
+                logger.warning("Listening for invalidations on %s failed: %s", self.channel, e)
+                self._stopped.wait(1.0)
+            finally:
+                pubsub.close()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update(invalidations_published=self.published, invalidations_received=self.received,
+                     invalidation_errors=self.errors)
+        return stats
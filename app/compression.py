@@ -0,0 +1,287 @@
+"""
+This module reduces the size of the responses sent by the application.
+
+`CompressionMiddleware` compresses responses with the best content coding the client accepts:
+brotli and zstd if the optional `brotli` and `zstandard` packages are installed, gzip
+otherwise. Small responses are sent as they are. Streamed responses are compressed chunk by
+chunk, so they are never buffered as a whole. The bytes saved are counted per route. A strong
+`ETag` stays strong: the coding is appended to it, see `encoded_etag`.
+
+`MinifyingLoader` removes the indentation and blank lines from the templates once when they
+are loaded, so the rendered HTML is smaller without any cost per request.
+"""
+import os
+import re
+import threading
+import zlib
+
+from jinja2 import Environment, FileSystemLoader
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "500"))
+MINIFY_HTML = os.environ.get("MINIFY_HTML", "true").lower() in ("1", "true", "yes")
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# content codings in order of preference, restricted to the installed libraries
+CODINGS = tuple(coding for coding, available in (("br", brotli), ("zstd", zstandard), ("gzip", zlib)) if available)
+# every coding an ETag may have been encoded for, including those of other installations
+ETAG_CODINGS = ("br", "zstd", "gzip")
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    """Parses an `Accept-Encoding` header.
+
+    Args:
+        accept_encoding (str): The value of the header.
+
+    Returns:
+        set[str]: The content codings the client accepts, codings with `q=0` are left out.
+    """
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        _, _, quality = params.partition("q=")
+        try:
+            if quality and float(quality) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def encoded_etag(etag: str, coding: str) -> str:
+    """Returns the ETag of a body encoded with `coding`, e.g. `"3-1-br"` for `"3-1"`.
+
+    The encoded body differs from the original one, so it needs a strong ETag of its own.
+
+    Args:
+        etag (str): The quoted ETag of the unencoded body.
+        coding (str): The content coding.
+
+    Returns:
+        str: The ETag of the encoded body.
+    """
+    return f'{etag[:-1]}-{coding}"'
+
+
+def decoded_etag(etag: str) -> str:
+    """Returns the ETag of the unencoded body for an ETag built by `encoded_etag`, other ETags
+    unchanged."""
+    for coding in ETAG_CODINGS:
+        suffix = f'-{coding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+class StreamCompressor():
+    """
+    Compresses a response body that arrives in chunks.
+
+    Every chunk is flushed, so the client can process the data as soon as it arrives.
+    """
+    def __init__(self, coding: str):
+        self.coding = coding
+        if coding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        elif coding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk and flushes it."""
+        if self.coding == "br":
+            return self._compressor.process(data) + self._compressor.flush()
+        if self.coding == "zstd":
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        """Compresses the last chunk and ends the stream."""
+        if self.coding == "br":
+            return self._compressor.process(data) + self._compressor.finish()
+        if self.coding == "zstd":
+            return self._compressor.compress(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class CompressionStats():
+    """
+    Counts the compressed responses and their sizes per route.
+    """
+    def __init__(self):
+        self._routes: dict[str, dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, bytes_in: int, bytes_out: int):
+        """Adds a compressed response of `route` with its original and compressed size."""
+        with self._lock:
+            counters = self._routes.setdefault(route, {"responses": 0, "bytes_in": 0, "bytes_out": 0})
+            counters["responses"] += 1
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+
+    def stats(self) -> dict:
+        """Returns the counters and the bytes saved per route."""
+        with self._lock:
+            return {
+                route: dict(counters, bytes_saved=counters["bytes_in"] - counters["bytes_out"])
+                for route, counters in self._routes.items()
+            }
+
+
+COMPRESSION_STATS = CompressionStats()
+
+
+class CompressionMiddleware():
+    """
+    ASGI middleware compressing responses with gzip, brotli or zstd.
+
+    Responses that already have a `Content-Encoding`, are not text, or are smaller than
+    `minimum_size` are passed through unchanged.
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE, stats: CompressionStats = COMPRESSION_STATS):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.stats = stats
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        accepted = accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+        coding = next((coding for coding in CODINGS if coding in accepted), None)
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressingResponder(self, scope, send, coding).run(receive)
+
+
+class _CompressingResponder():
+    """Compresses the body of a single response. The start message is held back until the
+    first body chunk shows whether the response is worth compressing."""
+    def __init__(self, middleware: CompressionMiddleware, scope: Scope, send: Send, coding: str):
+        self.middleware = middleware
+        self.scope = scope
+        self.send = send
+        self.coding = coding
+        self.start: Message | None = None
+        self.compressor: StreamCompressor | None = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def run(self, receive: Receive):
+        await self.middleware.app(self.scope, receive, self.send_wrapper)
+
+    def _should_compress(self, body: bytes, more_body: bool) -> bool:
+        headers = Headers(raw=self.start["headers"])
+        if self.start["status"] in (204, 304) or "content-encoding" in headers:
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+        return more_body or len(body) >= self.middleware.minimum_size
+
+    async def send_wrapper(self, message: Message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] == "http.response.pathsend" and not self.passthrough:
+            # the server sends the file itself, e.g. a recipe image
+            self.passthrough = True
+            await self.send(self.start)
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            if not self._should_compress(body, more_body):
+                if self.start["status"] == 304:
+                    self._not_modified_etag()
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send(message)
+                return
+            self.compressor = StreamCompressor(self.coding)
+            headers = MutableHeaders(raw=self.start["headers"])
+            headers["Content-Encoding"] = self.coding
+            headers.add_vary_header("Accept-Encoding")
+            if headers.get("etag", "").endswith('"'):
+                headers["ETag"] = encoded_etag(headers["etag"], self.coding)
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                compressed = self.compressor.finish(body)
+                headers["Content-Length"] = str(len(compressed))
+                await self.send(self.start)
+                await self.send({"type": "http.response.body", "body": compressed})
+                self._record(len(body), len(compressed))
+                return
+            await self.send(self.start)
+        compressed = self.compressor.compress(body) if more_body else self.compressor.finish(body)
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        if not more_body:
+            self._record(self.bytes_in, self.bytes_out)
+
+    def _not_modified_etag(self):
+        """Answers a 304 with the ETag of the encoded body if the client holds the encoded copy,
+        as a 200 response would have carried it."""
+        headers = MutableHeaders(raw=self.start["headers"])
+        etag = headers.get("etag", "")
+        if not etag.endswith('"'):
+            return
+        encoded = encoded_etag(etag, self.coding)
+        if_none_match = Headers(scope=self.scope).get("if-none-match", "")
+        if encoded in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            headers["ETag"] = encoded
+
+    def _record(self, bytes_in: int, bytes_out: int):
+        route = self.scope.get("route")
+        self.middleware.stats.record(getattr(route, "path", "other"), bytes_in, bytes_out)
+
+
+_PRESERVED_BLOCKS = re.compile(r"(<pre\b.*?</pre>|<textarea\b.*?</textarea>)", re.DOTALL | re.IGNORECASE)
+_INDENTATION = re.compile(r"[ \t]*\n\s*")
+
+
+def minify_html(source: str) -> str:
+    """Removes indentation and blank lines from HTML, leaving `pre` and `textarea` content untouched.
+
+    Every removed whitespace run contained a line break and is replaced by one, so the
+    rendered page and inline scripts behave the same.
+
+    Args:
+        source (str): The HTML or template source.
+
+    Returns:
+        str: The minified source.
+    """
+    parts = _PRESERVED_BLOCKS.split(source)
+    return "".join(part if i % 2 else _INDENTATION.sub("\n", part) for i, part in enumerate(parts))
+
+
+class MinifyingLoader(FileSystemLoader):
+    """
+    Template loader that minifies the templates with `minify_html` when they are loaded.
+    """
+    def get_source(self, environment: Environment, template: str):
+        source, filename, uptodate = super().get_source(environment, template)
+        return minify_html(source), filename, uptodate
@@ -1,9 +1,7 @@
-import os
-
-from fastapi import UploadFile
-import uuid
-from PIL import Image
-from pathlib import Path
+from image_gc import keep_images
+from image_pipeline import IMAGE_PIPELINE, IMAGE_VARIANTS, verify_image
+from image_storage import image_path
+from upload_handler import StoredUpload
 
 
 
@@ -38,36 +36,64 @@ def get_tags(data: dict, key: str) -> list:
 	"""
 	exploded_list = []
 	for i in range(0, 10):
-		print( f"{key}[{i}]")
 		if f"{key}[{i}]" in data:
 			exploded_list.append(data[f"{key}[{i}]"])
 	return exploded_list
 
-def upload_recipe_img(img_path: UploadFile, recipe_name: str) -> str | None:
-	"""Uploads a recipe image to the server.
+def read_recipe_fields(data: dict) -> dict:
+	"""Reads and validates the scalar fields of a recipe form.
 
 	Args:
-		img_path (UploadFile): The image file to upload.
-		recipe_name (str): The name of the recipe.
+		data (dict): The form data.
 
 	Returns:
-		str: The file path of the uploaded image.
+		dict: The title, portions, prep_time, cook_time, text and is_public values of the recipe.
+
+	Raises:
+		ValueError: If a required field is missing or a number is invalid.
+	"""
+	fields = {}
+	for key in ("title", "description"):
+		if not data.get(key):
+			raise ValueError(f"Missing field {key}")
+	fields["title"] = data["title"]
+	fields["text"] = data["description"]
+	for key in ("portions", "prep_time", "cook_time"):
+		try:
+			fields[key] = int(data[key])
+		except (KeyError, ValueError):
+			raise ValueError(f"Field {key} must be a whole number")
+	fields["is_public"] = data.get("is_public") == "public"
+	return fields
+
+def upload_recipe_img(upload: StoredUpload) -> dict[str, str]:
+	"""Queues a stored recipe image for processing.
+
+	The variants are named after the SHA-256 digest of the uploaded file, so their URLs never
+	change content and identical uploads share their files. The image is checked before it is
+	queued, so a broken upload is rejected with the form. If the variants of an identical
+	upload exist already, they are kept from the image garbage collector and the upload is
+	discarded instead of being processed again. Otherwise
+	`IMAGE_PIPELINE` stores the resized variants in the background. Blocks on the image
+	storage, call it on a worker thread.
+
+	Args:
+		upload (StoredUpload): The image stored by `upload_handler.parse_recipe_form`.
+
+	Returns:
+		dict[str, str]: The image paths of the variants, keyed by variant name.
+
+	Raises:
+		ValueError: If the upload is not a complete image. The upload is discarded.
 	"""
-	try:
-		img_path.filename = img_path.filename.replace(" ", "_")
-		file_location = f"static/recipe_images/{recipe_name}-{uuid.uuid4()}.webp"
-		folder = os.path.dirname(file_location)
-		if not os.path.exists(folder):
-			os.makedirs(folder, exist_ok=True)
-		if not img_path.content_type.startswith("image/"):
-			return None
-		if img_path.size > 10 * 1024 * 1024:  # Check if file size exceeds 10MB
-			return None
-		image = Image.open(img_path.file)
-		image = image.convert("RGB")
-		image.save(file_location, "webp", optimize=True, quality=10)
-
-		return file_location
-	except Exception as e:
-		print(f"Error uploading image: {e}")
-		return None
\ No newline at end of file
+	name = upload.sha256[:32]
+	keys = {variant: f"{name}-{variant}.webp" for variant in IMAGE_VARIANTS}
+	variants = {variant: image_path(key) for variant, key in keys.items()}
+	if keep_images(variants.values()):
+		upload.discard()
+		return variants
+	if not verify_image(upload.path):
+		upload.discard()
+		raise ValueError("Invalid image file")
+	IMAGE_PIPELINE.submit(upload.path, keys)
+	return variants
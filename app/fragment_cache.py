@@ -0,0 +1,144 @@
+"""
+This module caches rendered recipe HTML and answers conditional requests for it.
+
+A rendered recipe only depends on the template, the recipe version and whether the viewer is
+its author. The HTML is cached under that key and sent with a strong ETag and a
+`Last-Modified` header, so a browser that already has the current version gets a 304 without
+the template being rendered again.
+"""
+import datetime
+import hashlib
+import os
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from cache import CacheBackend, LRUCache
+from compression import decoded_etag
+from models import Recipe
+from rendering import StreamingTemplates
+from static_assets import ASSETS
+
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "512"))
+FRAGMENT_CACHE: CacheBackend = LRUCache(maxsize=FRAGMENT_CACHE_SIZE)
+
+# template name -> short hash of its source, part of the ETag so a changed template is re-sent
+_template_hashes: dict[str, str] = {}
+
+
+def set_fragment_cache(backend: CacheBackend):
+    """Replaces the cache used for rendered recipes, e.g. with a backend shared between workers.
+
+    Args:
+        backend (CacheBackend): The cache to use for rendered HTML.
+    """
+    global FRAGMENT_CACHE
+    FRAGMENT_CACHE = backend
+
+
+def _template_hash(templates: Jinja2Templates, template_name: str) -> str:
+    """Returns a short hash of the source of a template."""
+    if template_name not in _template_hashes:
+        source, _, _ = templates.env.loader.get_source(templates.env, template_name)
+        _template_hashes[template_name] = hashlib.sha256(source.encode()).hexdigest()[:8]
+    return _template_hashes[template_name]
+
+
+def recipe_etag(templates: Jinja2Templates, template_name: str, recipe: Recipe, is_author: bool) -> str:
+    """Builds the strong ETag of a rendered recipe.
+
+    Besides the recipe version it covers the template source and the static asset fingerprints,
+    so a deployment that changes either invalidates the copies held by browsers.
+
+    Args:
+        templates (Jinja2Templates): The templates the recipe is rendered with.
+        template_name (str): The name of the template.
+        recipe (Recipe): The recipe to render.
+        is_author (bool): Whether the viewer is the author of the recipe.
+
+    Returns:
+        str: The quoted ETag.
+    """
+    viewer = "a" if is_author else "v"
+    return f'"{recipe.id}-{recipe.version}-{viewer}-{_template_hash(templates, template_name)}{ASSETS.version}"'
+
+
+def last_modified(recipe: Recipe) -> datetime.datetime:
+    """Returns the time of the last change of a recipe in UTC, truncated to whole seconds."""
+    changed = recipe.updated or recipe.created
+    # timestamps are stored as naive local time
+    return changed.astimezone(datetime.timezone.utc).replace(microsecond=0)
+
+
+def is_not_modified(request: Request, etag: str, modified: datetime.datetime) -> bool:
+    """Evaluates the conditional request headers.
+
+    `If-None-Match` takes precedence over `If-Modified-Since`, as required by RFC 9110.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        etag (str): The current ETag of the resource.
+        modified (datetime.datetime): The time of the last change of the resource in UTC.
+
+    Returns:
+        bool: True if the client's copy is current and a 304 can be sent.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # a compressed copy has the ETag of its encoding, see `compression.encoded_etag`
+        tags = [decoded_etag(tag.strip().removeprefix("W/")) for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        return False
+    return modified <= since
+
+
+def render_recipe(templates: Jinja2Templates, request: Request, template_name: str, recipe: Recipe,
+                  is_author: bool, context: dict | None = None, pages: StreamingTemplates | None = None) -> Response:
+    """Renders a recipe through the fragment cache, or answers with 304 if the client's copy is current.
+
+    The caller has to check that the viewer may see the recipe before calling this function.
+
+    Args:
+        templates (Jinja2Templates): The templates to render with.
+        request (Request): The incoming HTTP request.
+        template_name (str): The name of the template, it receives `request`, `recipe` and `context`.
+        recipe (Recipe): The recipe to render.
+        is_author (bool): Whether the viewer is the author of the recipe.
+        context (dict | None): Additional template variables. They must not depend on the viewer
+            other than through `is_author`.
+        pages (StreamingTemplates | None): Streams a page that is not cached yet instead of
+            rendering it as a whole; it is cached once it was rendered completely.
+
+    Returns:
+        Response: The rendered HTML, or an empty 304 response.
+    """
+    etag = recipe_etag(templates, template_name, recipe, is_author)
+    modified = last_modified(recipe)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(modified, usegmt=True),
+        # the page depends on the logged in user, so only the browser may keep it and has to revalidate
+        "Cache-Control": "private, no-cache",
+        "Vary": "Cookie",
+    }
+    if is_not_modified(request, etag, modified):
+        return Response(status_code=304, headers=headers)
+    key = (template_name, recipe.id, recipe.version, is_author)
+    html = FRAGMENT_CACHE.get(key)
+    if html is None:
+        context = {**(context or {}), "request": request, "recipe": recipe}
+        if pages is not None:
+            return pages.response(template_name, context, headers=headers, on_complete=lambda html: FRAGMENT_CACHE.set(key, html))
+        html = templates.get_template(template_name).render(context)
+        FRAGMENT_CACHE.set(key, html)
+    return HTMLResponse(html, headers=headers)
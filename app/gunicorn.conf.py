@@ -0,0 +1,75 @@
+"""
+gunicorn configuration for serving the app with several uvicorn worker processes.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The master applies the database migrations once and then forks `WEB_CONCURRENCY` workers, by
+default one per CPU if the rate limit counters are shared through `RATE_LIMIT_STORAGE_URL` and a
+single one otherwise.
+Every worker creates its own database engine and process pools in the lifespan startup and
+warms up before it accepts connections. On SIGTERM the workers stop accepting connections,
+finish the open requests within `GRACEFUL_TIMEOUT` seconds and run the lifespan shutdown.
+"""
+import glob
+import os
+import sys
+import tempfile
+
+from uvicorn_worker import UvicornWorker
+
+CPUS = os.cpu_count() or 1
+# seconds of the graceful timeout kept for the lifespan shutdown after the open requests
+SHUTDOWN_RESERVE = 5
+# seconds a worker may serve a recipe changed through another worker from its cache
+SHARED_RECIPE_CACHE_TTL = 5
+# counters in memory are per process, each worker would allow a client the whole limit
+SHARED_LIMITS = not (os.environ.get("RATE_LIMIT_STORAGE_URL") or "memory://").partition("://")[0].endswith("memory")
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", str(CPUS if SHARED_LIMITS else 1)))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-"
+
+# the process pools of every worker share the CPUs with the other workers
+os.environ.setdefault("HASH_WORKERS", str(max(1, CPUS // workers)))
+os.environ.setdefault("IMAGE_WORKERS", str(max(1, CPUS // workers)))
+if workers > 1 and not os.environ.get("RECIPE_CACHE_URL"):
+    # without RECIPE_CACHE_URL only the worker that changed a recipe drops it from its cache
+    os.environ.setdefault("RECIPE_CACHE_TTL", str(SHARED_RECIPE_CACHE_TTL))
+# the workers write their metrics here, so `/metrics` reports all of them
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "recipe-app-metrics"))
+
+
+class GracefulUvicornWorker(UvicornWorker):
+    """
+    Uvicorn worker that stops waiting for open requests before gunicorn kills it, so the
+    lifespan shutdown still runs.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - SHUTDOWN_RESERVE)
+
+
+worker_class = GracefulUvicornWorker
+
+
+def on_starting(server):
+    """Applies the migrations in the master, so the workers do not race each other doing so."""
+    import database_handler
+    version = database_handler.run_migrations()
+    server.log.info("Database schema version %s", version)
+    if server.cfg.workers > 1 and not SHARED_LIMITS:
+        server.log.warning("The rate limits are counted per worker, set RATE_LIMIT_STORAGE_URL to share them")
+    # inherited by the forked workers, which only check the schema version
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "false"
+    # counters of a previous run would be added to the new ones
+    for snapshot in glob.glob(os.path.join(os.environ["METRICS_DIR"], "*.json")):
+        os.remove(snapshot)
+
+
+def post_fork(server, worker):
+    """Drops pooled connections inherited from the master, e.g. with `--preload`."""
+    database_handler = sys.modules.get("database_handler")
+    if database_handler is not None and database_handler.ENGINE is not None:
+        database_handler.ENGINE.dispose(close=False)
@@ -0,0 +1,327 @@
+"""
+This module deletes recipe images that no recipe refers to anymore.
+
+Identical uploads share their files, so the files of an image may only be deleted once no recipe
+uses it. Deleting a recipe or replacing its image hands the old image to `IMAGE_GC`, which checks
+and deletes it on a background thread shortly after. In addition, every `IMAGE_GC_INTERVAL`
+seconds the image storage is listed in batches of `IMAGE_GC_BATCH` images, each batch looked up
+with one query through the index on `recipe.img_path`. The sweep also catches files orphaned
+before this module existed or by a crash, removes abandoned uploads from the incoming directory
+and counts the files and bytes stored.
+
+Files modified within the last `IMAGE_GC_GRACE` seconds are never deleted: an upload is stored
+before its recipe is committed, and reusing an existing image touches its files, see
+`keep_images`. The touch and the check that the files exist hold a shared lock, the collector
+checks the age of an image and deletes it under an exclusive one, so an image is either kept
+or reported missing to the recipe reusing it. With several worker processes on one host only
+the one holding the lock file sweeps.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import database_handler
+from image_pipeline import IMAGE_VARIANTS
+from image_storage import IMAGE_STORAGE, ImageStorage, image_path, storage_key
+from upload_handler import INCOMING_DIR
+
+IMAGE_GC_INTERVAL = float(os.environ.get("IMAGE_GC_INTERVAL", "3600"))
+IMAGE_GC_GRACE = float(os.environ.get("IMAGE_GC_GRACE", "3600"))
+IMAGE_GC_BATCH = int(os.environ.get("IMAGE_GC_BATCH", "500"))
+
+# files of the image pipeline, named after the content hash of the upload
+_VARIANT_NAME = re.compile(r"([0-9a-f]{32})-(\w+)\.webp")
+
+logger = logging.getLogger(__name__)
+
+# serializes the threads if there is no file locking
+_images_lock = threading.Lock()
+
+
+def owner_path(key: str) -> str:
+    """Returns the `img_path` a recipe using the stored file refers to.
+
+    The variants of a processed image belong to the path of its "full" variant, any other file
+    only to its own path.
+    """
+    match = _VARIANT_NAME.fullmatch(key)
+    if match and match.group(2) in IMAGE_VARIANTS:
+        return image_path(f"{match.group(1)}-full.webp")
+    return image_path(key)
+
+
+def image_files(img_path: str) -> list[str]:
+    """Returns the storage keys of the files belonging to an `img_path`, none for paths
+    outside the image storage."""
+    key = storage_key(img_path)
+    if key is None:
+        return []
+    match = _VARIANT_NAME.fullmatch(key)
+    if match:
+        return [f"{match.group(1)}-{variant}.webp" for variant in IMAGE_VARIANTS]
+    return [key]
+
+
+def image_variants(img_path: str) -> dict[str, str] | None:
+    """Returns the variant paths of a processed image keyed by variant name, None for other
+    images."""
+    match = _VARIANT_NAME.fullmatch(storage_key(img_path) or "")
+    if not match or owner_path(match.group(0)) != img_path:
+        return None
+    return {variant: image_path(f"{match.group(1)}-{variant}.webp") for variant in IMAGE_VARIANTS}
+
+
+def recipe_images(recipe) -> set[str]:
+    """Returns the image path and the variant paths a recipe refers to."""
+    return {recipe.img_path, *(recipe.img_variants or {}).values()}
+
+
+@contextmanager
+def images_locked(exclusive: bool):
+    """Holds the lock between reusing images and deleting them, across the processes of one host.
+
+    Args:
+        exclusive (bool): Take the lock of the collector, which excludes all other holders,
+            instead of a shared one.
+    """
+    if fcntl is None:
+        with _images_lock:
+            yield
+        return
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    with open(os.path.join(INCOMING_DIR, ".images.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def keep_images(paths) -> bool:
+    """Marks existing images as in use, so the collector leaves them alone for `IMAGE_GC_GRACE`.
+
+    Called before a new recipe refers to images that exist already. The files are touched first
+    and checked afterwards, both under the lock the collector deletes images with.
+
+    Args:
+        paths (Iterable[str]): The image paths.
+
+    Returns:
+        bool: Whether all images exist. Otherwise the recipe must not refer to them.
+    """
+    keys = [storage_key(path) for path in paths]
+    if None in keys:
+        return False
+    if not keys:
+        return True
+    with images_locked(exclusive=False):
+        IMAGE_STORAGE.touch(keys)
+        return all(IMAGE_STORAGE.exists(key) for key in keys)
+
+
+class ImageCollector():
+    """
+    Deletes unreferenced recipe images on a background thread.
+    """
+    def __init__(self, storage: ImageStorage = IMAGE_STORAGE, interval: float = IMAGE_GC_INTERVAL,
+                 grace: float = IMAGE_GC_GRACE, batch_size: int = IMAGE_GC_BATCH, incoming_dir: str = INCOMING_DIR):
+        self.storage = storage
+        self.incoming_dir = incoming_dir
+        self.interval = interval
+        self.grace = grace
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._released: set[str] = set()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.files = 0
+        self.bytes = 0
+        self.orphans = 0
+        self.deleted_files = 0
+        self.freed_bytes = 0
+        self.sweeps = 0
+        self.last_sweep_seconds = 0.0
+        self.errors = 0
+
+    def start(self):
+        """Starts the collector thread. An interval of 0 only handles released images."""
+        if self._thread is not None:
+            return
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="image-gc", daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        """Stops the collector thread after handling the released images."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def release(self, *paths: str | None):
+        """Hands the images of a deleted recipe or a replaced image to the collector.
+
+        The files are only deleted if no other recipe uses the image. A variant path releases
+        the image it belongs to.
+
+        Args:
+            *paths (str | None): The `img_path` and the variant paths the recipe referred to.
+        """
+        keys = [key for key in map(storage_key, filter(None, paths)) if key is not None]
+        if not keys:
+            return
+        with self._lock:
+            self._released.update(map(owner_path, keys))
+        self._wake.set()
+
+    def _run(self):
+        next_sweep = time.monotonic() + min(60.0, self.interval)
+        while not self._stopped.is_set():
+            timeout = max(0.0, next_sweep - time.monotonic()) if self.interval else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+            try:
+                self.collect_released()
+                if self.interval and time.monotonic() >= next_sweep and not self._stopped.is_set():
+                    self.sweep()
+                    next_sweep = time.monotonic() + self.interval
+            except Exception:
+                self.errors += 1
+                logger.exception("Image garbage collection failed")
+
+    def collect_released(self):
+        """Deletes the released images no recipe refers to."""
+        with self._lock:
+            released, self._released = list(self._released), set()
+        for start in range(0, len(released), self.batch_size):
+            batch = released[start:start + self.batch_size]
+            self._delete_unreferenced({key: image_files(key) for key in batch})
+
+    def sweep(self):
+        """Lists the image storage in batches and deletes the files no recipe refers to.
+
+        Skipped if another process holds the lock file.
+        """
+        lock_file = self._acquire_lock()
+        if lock_file is False:
+            return
+        started = time.perf_counter()
+        files = total_bytes = orphans = deleted_files = freed_bytes = 0
+        try:
+            for batch, batch_files, batch_bytes in self._batches():
+                files += batch_files
+                total_bytes += batch_bytes
+                batch_orphans, batch_deleted, batch_freed = self._delete_unreferenced(batch)
+                orphans += batch_orphans
+                deleted_files += batch_deleted
+                freed_bytes += batch_freed
+            self._delete_abandoned_uploads()
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        self.files = files - deleted_files
+        self.bytes = total_bytes - freed_bytes
+        self.orphans = orphans
+        self.sweeps += 1
+        self.last_sweep_seconds = time.perf_counter() - started
+        logger.info("Image sweep checked %d files in %.1f s, deleted %d files of %d unreferenced images",
+                    files, self.last_sweep_seconds, deleted_files, orphans)
+
+    def _batches(self):
+        """Yields the stored files grouped by `img_path`, `batch_size` images at a time, with
+        the number and total size of the files."""
+        batch: dict[str, list[str]] = {}
+        files = total_bytes = 0
+        for stored in self.storage.list():
+            batch.setdefault(owner_path(stored.key), []).append(stored.key)
+            files += 1
+            total_bytes += stored.size
+            if len(batch) >= self.batch_size:
+                yield batch, files, total_bytes
+                batch = {}
+                files = total_bytes = 0
+        if batch:
+            yield batch, files, total_bytes
+
+    def _delete_unreferenced(self, files: dict[str, list[str]]) -> tuple[int, int, int]:
+        """Deletes the images no recipe refers to whose files are older than the grace period.
+
+        Args:
+            files (dict[str, list[str]]): Maps `img_path` values to the storage keys of the image.
+
+        Returns:
+            tuple[int, int, int]: The number of unreferenced images, including those kept for the
+                grace period, of deleted files and of freed bytes.
+        """
+        referenced = database_handler.referenced_images(list(files))
+        unreferenced = [path for path in files if path not in referenced]
+        deleted_files = 0
+        freed_bytes = 0
+        for path in unreferenced:
+            # an upload of the same image touches the files, see `keep_images`
+            with images_locked(exclusive=True):
+                stored = [item for item in map(self.storage.stat, files[path]) if item is not None]
+                if not stored or any(item.modified > time.time() - self.grace for item in stored):
+                    continue
+                self.storage.delete([item.key for item in stored])
+            deleted_files += len(stored)
+            freed_bytes += sum(item.size for item in stored)
+        self.deleted_files += deleted_files
+        self.freed_bytes += freed_bytes
+        return len(unreferenced), deleted_files, freed_bytes
+
+    def _delete_abandoned_uploads(self):
+        """Removes uploads older than the grace period that were never processed, e.g. because
+        the process crashed."""
+        cutoff = time.time() - self.grace
+        try:
+            entries = list(os.scandir(self.incoming_dir))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+
+    def _acquire_lock(self):
+        """Returns the open lock file, None without file locking support, or False if another process sweeps."""
+        if fcntl is None:
+            return None
+        lock_file = open(os.path.join(self.incoming_dir, ".gc.lock"), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        return lock_file
+
+    def stats(self) -> dict:
+        """Returns the disk usage of the images as of the last sweep and the collector counters."""
+        return {
+            "backend": self.storage.name,
+            "files": self.files,
+            "bytes": self.bytes,
+            "orphans": self.orphans,
+            "deleted_files": self.deleted_files,
+            "freed_bytes": self.freed_bytes,
+            "free_bytes": self.storage.free_bytes(),
+            "sweeps": self.sweeps,
+            "last_sweep_seconds": round(self.last_sweep_seconds, 3),
+            "errors": self.errors,
+        }
+
+
+IMAGE_GC = ImageCollector()
@@ -0,0 +1,165 @@
+"""
+This module renders uploaded recipe images in the background.
+
+Uploads are stored unprocessed and handed to a process pool, which decodes them once and
+stores a WebP file for every entry of `IMAGE_VARIANTS` in the image storage. The request that
+uploaded the image does not wait for the encoding.
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from metrics import IMAGE_PROCESSING
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+
+# variant name -> (maximum width and height in pixels, WebP quality)
+IMAGE_VARIANTS = {
+    "thumb": (320, 60),
+    "medium": (800, 75),
+    "full": (1600, 80),
+}
+
+logger = logging.getLogger(__name__)
+
+
+# formats whose `verify` does not read the image data, so they are decoded to check it
+_DECODED_FORMATS = {"JPEG", "GIF"}
+
+
+def verify_image(source: str) -> bool:
+    """Checks that an upload is a complete image before its recipe is saved.
+
+    The variants are rendered in the background, so a broken upload could not be rejected
+    anymore. JPEG images are decoded at a reduced scale, which is much cheaper than rendering
+    the variants.
+
+    Args:
+        source (str): The path of the unprocessed upload.
+
+    Returns:
+        bool: Whether the image can be decoded.
+    """
+    from PIL import Image
+
+    try:
+        with Image.open(source) as image:
+            image_format = image.format
+            image.verify()
+        if image_format in _DECODED_FORMATS:
+            with Image.open(source) as image:
+                image.draft("RGB", (IMAGE_VARIANTS["thumb"][0],) * 2)
+                image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return False
+    return True
+
+
+def render_variants(source: str, targets: dict[str, str]) -> float:
+    """Decodes an uploaded image and stores one resized WebP file per variant.
+
+    Every file is written next to the upload first and then handed to the image storage, so a
+    variant is either missing or complete. The source file is removed afterwards.
+
+    Args:
+        source (str): The path of the unprocessed upload.
+        targets (dict[str, str]): Maps variant names from `IMAGE_VARIANTS` to their storage keys.
+
+    Returns:
+        float: The seconds spent decoding, resizing and encoding.
+    """
+    from PIL import Image, ImageOps
+
+    from image_storage import IMAGE_STORAGE
+
+    started = time.perf_counter()
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            for name, target in targets.items():
+                size, quality = IMAGE_VARIANTS[name]
+                variant = image.copy()
+                variant.thumbnail((size, size))
+                temporary = f"{source}-{name}.webp"
+                variant.save(temporary, "webp", quality=quality, method=4)
+                IMAGE_STORAGE.put(target, temporary)
+    finally:
+        os.remove(source)
+    return time.perf_counter() - started
+
+
+def srcset(variants: dict[str, str] | None) -> str:
+    """Builds the value of an `srcset` attribute from the variants of a recipe image.
+
+    Args:
+        variants (dict[str, str] | None): Maps variant names to image paths.
+
+    Returns:
+        str: The candidates ordered by width, empty if there are no variants.
+    """
+    if not variants:
+        return ""
+    candidates = sorted(
+        (IMAGE_VARIANTS[name][0], path) for name, path in variants.items() if name in IMAGE_VARIANTS
+    )
+    return ", ".join(f"/{path} {width}w" for width, path in candidates)
+
+
+class ImagePipeline():
+    """
+    Processes recipe images on a pool of worker processes.
+    """
+    def __init__(self, workers: int = IMAGE_WORKERS):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        """int: The number of images that are queued or being processed."""
+        return self._pending
+
+    def start(self):
+        """Starts the worker processes."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self):
+        """Stops the worker processes after the queued images are processed."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def submit(self, source: str, targets: dict[str, str]) -> Future:
+        """Queues an uploaded image for processing. See `render_variants`.
+
+        Args:
+            source (str): The path of the unprocessed upload.
+            targets (dict[str, str]): Maps variant names to their storage keys.
+
+        Returns:
+            Future: Completes when all variants are stored.
+        """
+        if self._pool is None:
+            self.start()
+        with self._lock:
+            self._pending += 1
+        future = self._pool.submit(render_variants, source, targets)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        """Updates the queue depth, records the processing time and reports failed jobs."""
+        with self._lock:
+            self._pending -= 1
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            logger.error("Processing image failed", exc_info=error)
+        elif not future.cancelled():
+            IMAGE_PROCESSING.observe(future.result())
+
+
+IMAGE_PIPELINE = ImagePipeline()
@@ -0,0 +1,466 @@
+"""
+This module stores the recipe images and serves them.
+
+Recipes refer to their images by a path like `images/3f2a...-full.webp`, which is also the URL
+the image is served at. The part after `images/` is the key of the file in the storage backend
+configured by `IMAGE_STORAGE_URL`:
+
+- a directory, e.g. `static/recipe_images`, stores the files on the local filesystem,
+- `s3://bucket/prefix` stores them in an S3-compatible object store. `S3_ENDPOINT_URL` points
+  to a server other than AWS, e.g. MinIO. This needs the `s3` extra (`poetry install --extras s3`).
+
+Both backends spread the files over `IMAGE_SHARD_DEPTH` levels of directories (or key prefixes)
+named after the first hex digits of the content hash in the key, so no directory holds more
+than a few files even with hundreds of thousands of images. The database never contains the
+layout or the backend, so either can be changed by moving the files.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+from typing import Iterator
+
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# imported by the S3 backend only, boto3 takes longer to import than the rest of the app
+boto3 = None
+ClientError = None
+
+IMAGE_STORAGE_URL = os.environ.get("IMAGE_STORAGE_URL", "static/recipe_images")
+IMAGE_SHARD_DEPTH = int(os.environ.get("IMAGE_SHARD_DEPTH", "2"))
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+# the path prefix of `img_path` values and the URL path the images are served at
+IMAGE_URL_PREFIX = "images/"
+IMMUTABLE = "public, max-age=31536000, immutable"
+CHUNK_SIZE = 64 * 1024
+
+_KEY = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]{0,254}")
+_HEX_PREFIX = re.compile(r"[0-9a-f]+")
+
+logger = logging.getLogger(__name__)
+
+
+def image_path(key: str) -> str:
+    """Returns the `img_path` value of a stored image."""
+    return f"{IMAGE_URL_PREFIX}{key}"
+
+
+def storage_key(img_path: str) -> str | None:
+    """Returns the storage key of an `img_path` value.
+
+    Args:
+        img_path (str): The path, e.g. "images/3f2a...-full.webp".
+
+    Returns:
+        str | None: The key, or None if the path does not name a stored image.
+    """
+    if not img_path.startswith(IMAGE_URL_PREFIX):
+        return None
+    key = img_path[len(IMAGE_URL_PREFIX):]
+    return key if _KEY.fullmatch(key) else None
+
+
+def legacy_image_key(name: str) -> str:
+    """Returns the storage key of an image stored by older versions as `static/recipe_images/<name>`.
+
+    Names that are valid keys are kept. The others, named after recipe titles with spaces,
+    umlauts or slashes, get the hash of the name as key. The `legacy_image_keys` migration
+    stored these keys with its own copy of this function and the old URLs redirect to them, so
+    they must never change.
+    """
+    if _KEY.fullmatch(name):
+        return name
+    extension = os.path.splitext(name)[1].lower()
+    if not re.fullmatch(r"\.[a-z0-9]{1,10}", extension):
+        extension = ""
+    return f"{hashlib.sha256(name.encode()).hexdigest()[:32]}{extension}"
+
+
+def image_etag(key: str) -> str:
+    """Returns the strong ETag of an image. The keys name the content, so they never change
+    their content."""
+    return f'"{key.rsplit(".", 1)[0]}"'
+
+
+def _shards(key: str, depth: int) -> list[str]:
+    """Returns the directory names a key is stored under, taken from its content hash."""
+    digest = key[:2 * depth]
+    if len(digest) < 2 * depth or not _HEX_PREFIX.fullmatch(digest):
+        digest = hashlib.sha256(key.encode()).hexdigest()
+    return [digest[2 * level:2 * level + 2] for level in range(depth)]
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    """Returns whether the `If-None-Match` header of the request names the ETag."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag in tags or "*" in tags
+
+
+class StoredImage():
+    """
+    A file in the image storage.
+
+    Attributes:
+        key (str): The storage key.
+        size (int): The size in bytes.
+        modified (float): The time of the last change as a Unix timestamp.
+    """
+    def __init__(self, key: str, size: int, modified: float):
+        self.key = key
+        self.size = size
+        self.modified = modified
+
+
+class ImageStorage():
+    """
+    Interface of the image storage backends. All methods except `response` block and are
+    called from worker threads or processes.
+    """
+    name = ""
+
+    def put(self, key: str, source: str):
+        """Stores a local file under `key` and removes the file.
+
+        The image is either missing or complete under its key, never partly written.
+        """
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        """Returns whether an image is stored under `key`."""
+        raise NotImplementedError
+
+    def stat(self, key: str) -> StoredImage | None:
+        """Returns the size and modification time of an image, or None if it does not exist."""
+        raise NotImplementedError
+
+    def touch(self, keys: list[str]):
+        """Sets the modification time of existing images to now."""
+        raise NotImplementedError
+
+    def delete(self, keys: list[str]):
+        """Deletes the images, keys that do not exist are ignored."""
+        raise NotImplementedError
+
+    def list(self) -> Iterator[StoredImage]:
+        """Yields every stored image, without loading the whole listing at once."""
+        raise NotImplementedError
+
+    def free_bytes(self) -> int | None:
+        """Returns the free space of the storage in bytes, None if it is not limited."""
+        return None
+
+    async def response(self, key: str, request: Request) -> Response:
+        """Returns the response serving an image, honoring `Range`, `If-Range` and `If-None-Match`."""
+        raise NotImplementedError
+
+
+class ImageFileResponse(FileResponse):
+    """
+    File response that lets the server send the file itself if it supports the ASGI
+    `http.response.pathsend` extension, so the body never passes through Python. Other servers,
+    e.g. uvicorn, get the file in chunks read on a thread.
+    """
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if ("http.response.pathsend" not in scope.get("extensions", {}) or scope["method"] != "GET"
+                or "range" in Headers(scope=scope)):
+            await super().__call__(scope, receive, send)
+            return
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        await send({"type": "http.response.pathsend", "path": os.path.abspath(self.path)})
+
+
+class LocalImageStorage(ImageStorage):
+    """
+    Stores the images in sharded directories on the local filesystem, e.g.
+    `static/recipe_images/3f/2a/3f2a...-full.webp`.
+    """
+    name = "local"
+
+    def __init__(self, directory: str, depth: int = IMAGE_SHARD_DEPTH):
+        self.directory = directory
+        self.depth = depth
+
+    def path(self, key: str) -> str:
+        """Returns the file path of a key."""
+        return os.path.join(self.directory, *_shards(key, self.depth), key)
+
+    def put(self, key: str, source: str):
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError:
+            # the source is on another filesystem
+            temporary = f"{target}.tmp"
+            shutil.copyfile(source, temporary)
+            os.replace(temporary, target)
+            os.remove(source)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def stat(self, key: str) -> StoredImage | None:
+        try:
+            stat_result = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return StoredImage(key, stat_result.st_size, stat_result.st_mtime)
+
+    def touch(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.utime(self.path(key))
+            except OSError:
+                pass
+
+    def delete(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def list(self) -> Iterator[StoredImage]:
+        yield from self._list(self.directory, self.depth)
+
+    def _list(self, directory: str, depth: int) -> Iterator[StoredImage]:
+        """Yields the images below one shard directory. Other files and directories, e.g.
+        the incoming uploads, are skipped."""
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if depth:
+                    if len(entry.name) == 2 and _HEX_PREFIX.fullmatch(entry.name) and entry.is_dir(follow_symlinks=False):
+                        yield from self._list(entry.path, depth - 1)
+                elif _KEY.fullmatch(entry.name) and not entry.name.endswith(".tmp") and entry.is_file(follow_symlinks=False):
+                    try:
+                        stat_result = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield StoredImage(entry.name, stat_result.st_size, stat_result.st_mtime)
+
+    def free_bytes(self) -> int | None:
+        try:
+            return shutil.disk_usage(self.directory).free
+        except OSError:
+            return None
+
+    async def response(self, key: str, request: Request) -> Response:
+        etag = image_etag(key)
+        headers = {"Cache-Control": IMMUTABLE, "ETag": etag}
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        path = self.path(key)
+        try:
+            stat_result = await run_in_threadpool(os.stat, path)
+        except FileNotFoundError:
+            return Response(status_code=404)
+        media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        return ImageFileResponse(path, stat_result=stat_result, media_type=media_type, headers=headers)
+
+
+def _import_boto3():
+    """Imports boto3 for the S3 backend."""
+    global boto3, ClientError
+    if boto3 is not None:
+        return
+    try:
+        import boto3 as boto3_module
+        from botocore.exceptions import ClientError as client_error
+    except ImportError as e:
+        raise RuntimeError("The S3 image storage needs the boto3 package, install the s3 extra") from e
+    boto3, ClientError = boto3_module, client_error
+
+
+class S3ImageStorage(ImageStorage):
+    """
+    Stores the images in an S3 bucket, e.g. under `prefix/3f/2a/3f2a...-full.webp`. The client
+    is created per process, so the storage can be used by the image worker processes.
+    """
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str | None = S3_ENDPOINT_URL,
+                 depth: int = IMAGE_SHARD_DEPTH):
+        _import_boto3()
+        self.bucket = bucket
+        self.prefix = f"{prefix.strip('/')}/" if prefix.strip("/") else ""
+        self.endpoint_url = endpoint_url
+        self.depth = depth
+        self._client = None
+        self._pid = None
+
+    @property
+    def client(self):
+        """The boto3 client of the current process."""
+        if self._client is None or self._pid != os.getpid():
+            self._client = boto3.client("s3", endpoint_url=self.endpoint_url)
+            self._pid = os.getpid()
+        return self._client
+
+    def object_key(self, key: str) -> str:
+        """Returns the object key of a storage key."""
+        return "/".join([self.prefix.rstrip("/"), *_shards(key, self.depth), key]).lstrip("/")
+
+    def put(self, key: str, source: str):
+        media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        self.client.upload_file(source, self.bucket, self.object_key(key),
+                                ExtraArgs={"ContentType": media_type, "CacheControl": IMMUTABLE})
+        os.remove(source)
+
+    def exists(self, key: str) -> bool:
+        return self.stat(key) is not None
+
+    def stat(self, key: str) -> StoredImage | None:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return StoredImage(key, head["ContentLength"], head["LastModified"].timestamp())
+
+    def touch(self, keys: list[str]):
+        # objects cannot be touched, copying one onto itself sets its modification time
+        for key in keys:
+            object_key = self.object_key(key)
+            try:
+                self.client.copy_object(Bucket=self.bucket, Key=object_key, MetadataDirective="REPLACE",
+                                        CopySource={"Bucket": self.bucket, "Key": object_key},
+                                        ContentType=mimetypes.guess_type(key)[0] or "application/octet-stream",
+                                        CacheControl=IMMUTABLE)
+            except ClientError:
+                pass
+
+    def delete(self, keys: list[str]):
+        # DeleteObjects takes at most 1000 keys
+        for start in range(0, len(keys), 1000):
+            objects = [{"Key": self.object_key(key)} for key in keys[start:start + 1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": objects, "Quiet": True})
+
+    def list(self) -> Iterator[StoredImage]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                key = item["Key"].rsplit("/", 1)[-1]
+                if _KEY.fullmatch(key) and item["Key"] == self.object_key(key):
+                    yield StoredImage(key, item["Size"], item["LastModified"].timestamp())
+
+    async def response(self, key: str, request: Request) -> Response:
+        etag = image_etag(key)
+        headers = {"Cache-Control": IMMUTABLE, "ETag": etag, "Accept-Ranges": "bytes"}
+        if _not_modified(request, etag):
+            return Response(status_code=304, headers=headers)
+        params = {"Bucket": self.bucket, "Key": self.object_key(key)}
+        http_range = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if http_range is not None and (if_range is None or if_range == etag):
+            # S3 answers single byte ranges itself and ignores lists of ranges
+            params["Range"] = http_range
+        try:
+            if request.method == "HEAD":
+                stored = await run_in_threadpool(self.client.head_object, **params)
+            else:
+                stored = await run_in_threadpool(self.client.get_object, **params)
+        except ClientError as e:
+            code = e.response["Error"]["Code"]
+            if code in ("404", "NoSuchKey", "NotFound"):
+                return Response(status_code=404)
+            if code == "InvalidRange":
+                size = e.response["Error"].get("ActualObjectSize", "*")
+                return Response(status_code=416, headers={"Content-Range": f"*/{size}"})
+            raise
+        headers["Content-Length"] = str(stored["ContentLength"])
+        headers["Last-Modified"] = stored["LastModified"].strftime("%a, %d %b %Y %H:%M:%S GMT")
+        status_code = 200
+        if "ContentRange" in stored:
+            headers["Content-Range"] = stored["ContentRange"]
+            status_code = 206
+        media_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        if request.method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        body = stored["Body"]
+        return StreamingResponse(iterate_in_threadpool(body.iter_chunks(CHUNK_SIZE)), status_code=status_code,
+                                 headers=headers, media_type=media_type, background=BackgroundTask(body.close))
+
+
+def create_storage(url: str = IMAGE_STORAGE_URL) -> ImageStorage:
+    """Creates the image storage backend.
+
+    Args:
+        url (str): A directory, or `s3://bucket/prefix` for an S3 bucket.
+
+    Returns:
+        ImageStorage: The backend.
+    """
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3ImageStorage(bucket, prefix)
+    return LocalImageStorage(url)
+
+
+def import_flat_images(directory: str, storage: ImageStorage, renamed: dict[str, str] | None = None) -> int:
+    """Moves images stored directly in `directory`, as before the images were sharded, into the storage.
+
+    Files whose names are valid keys keep their name. The others were given a new key by the
+    `legacy_image_keys` migration, see `legacy_image_key`, and are only moved if listed in
+    `renamed`; files that cannot be moved are logged.
+
+    Args:
+        directory (str): The former image directory, e.g. "static/recipe_images".
+        storage (ImageStorage): The storage to move the images to.
+        renamed (dict[str, str] | None): Maps the paths of files relative to `directory` to
+            the keys the recipes refer to, see `models.LegacyImage`.
+
+    Returns:
+        int: The number of images moved.
+    """
+    moved = 0
+    root = os.path.abspath(directory)
+    for name, key in (renamed or {}).items():
+        source = os.path.abspath(os.path.join(root, name))
+        if os.path.commonpath([root, source]) != root:
+            logger.warning("Image %s of a recipe is outside of %s and was not moved to %s", name, directory, key)
+            continue
+        try:
+            storage.put(key, source)
+        except FileNotFoundError:
+            # moved by another worker in the meantime
+            if not storage.exists(key):
+                logger.warning("Image %s of a recipe is missing, it should be stored as %s", name, key)
+            continue
+        moved += 1
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        if entry.name.startswith(".") or entry.name.endswith(".tmp") or not entry.is_file(follow_symlinks=False):
+            continue
+        if not _KEY.fullmatch(entry.name):
+            logger.warning("Image %s is no valid storage key and no recipe refers to it, it was not moved", entry.path)
+            continue
+        try:
+            storage.put(entry.name, entry.path)
+        except FileNotFoundError:
+            # moved by another worker in the meantime
+            continue
+        moved += 1
+    if moved:
+        logger.info("Moved %d images from %s to the %s image storage", moved, directory, storage.name)
+    return moved
+
+
+IMAGE_STORAGE = create_storage()
@@ -0,0 +1,369 @@
+"""
+This module collects the metrics of the application and exposes them in the Prometheus text format.
+
+Counters and histograms are kept in the memory of the process and updated where the work
+happens: `MetricsMiddleware` counts the requests and their latency per route, the SQLAlchemy
+event hooks below time every database statement, and `TimedTemplate` times every template
+rendering. Values that other parts of the app already count, e.g. cache hits, are read by
+collector functions when the metrics are rendered.
+
+With several worker processes every process writes a snapshot of its metrics to
+`METRICS_DIR` every `METRICS_SYNC_INTERVAL` seconds, and `/metrics` adds up the snapshots of
+all processes. Without `METRICS_DIR` only the metrics of the answering process are reported.
+
+The metrics reveal the traffic of every route, so they are only collected and served with
+`METRICS_ENABLED`, and with `METRICS_TOKEN` only to requests sending it as bearer token.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+METRICS_SYNC_INTERVAL = float(os.environ.get("METRICS_SYNC_INTERVAL", "5"))
+# upper bounds in seconds, from sub-millisecond queries to slow image uploads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger(__name__)
+
+
+class Metric():
+    """
+    Base class of the metrics, keeps one value per combination of label values.
+
+    Attributes:
+        name (str): The metric name.
+        help (str): The description shown in the exposition.
+        labels (tuple[str, ...]): The label names.
+    """
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self) -> dict:
+        """Returns the metric as a JSON serializable dict, see `merge_snapshots`."""
+        with self._lock:
+            samples = [[list(key), value if isinstance(value, float) else list(value)] for key, value in self._values.items()]
+        return {"type": self.type, "help": self.help, "labels": list(self.labels), "samples": samples}
+
+
+class Counter(Metric):
+    """
+    A value that only increases, e.g. the number of requests.
+    """
+    type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        """Increases the value of the given label values by `amount`."""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+
+class Histogram(Metric):
+    """
+    Counts observations, e.g. durations, in buckets and keeps their sum.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values: str):
+        """Adds an observation for the given label values."""
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            # one count per bucket and for +Inf, followed by the sum of the observations
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict:
+        return dict(super().snapshot(), buckets=list(self.buckets))
+
+
+class MetricsRegistry():
+    """
+    Holds the metrics and collectors of the application and renders them.
+    """
+    def __init__(self, directory: str = METRICS_DIR, sync_interval: float = METRICS_SYNC_INTERVAL):
+        self.directory = directory
+        self.sync_interval = sync_interval
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], Iterable[tuple[str, str, str, dict, float]]]] = []
+        self._writer: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        """Creates and registers a counter."""
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        """Creates and registers a histogram."""
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collector: Callable[[], Iterable[tuple[str, str, str, dict, float]]]):
+        """Registers a function that is called whenever the metrics are rendered.
+
+        Args:
+            collector (Callable): Returns (name, type, help, labels, value) tuples, the type
+                being "counter" or "gauge".
+        """
+        self._collectors.append(collector)
+
+    def snapshot(self) -> dict:
+        """Returns the current metrics of this process, including the collected ones."""
+        snapshot = {name: metric.snapshot() for name, metric in self._metrics.items()}
+        for collector in self._collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                logger.exception("Metrics collector failed")
+                continue
+            for name, metric_type, help, labels, value in samples:
+                entry = snapshot.setdefault(name, {"type": metric_type, "help": help, "labels": list(labels), "samples": []})
+                entry["samples"].append([[str(labels[label]) for label in entry["labels"]], float(value)])
+        return snapshot
+
+    def start(self):
+        """Starts writing snapshots to the metrics directory, if one is configured."""
+        if not self.directory or self._writer is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._stopped.clear()
+        self._writer = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._writer.start()
+
+    def stop(self):
+        """Stops the snapshot writer after writing a last snapshot."""
+        if self._writer is None:
+            return
+        self._stopped.set()
+        self._writer.join()
+        self._writer = None
+        self.write_snapshot()
+
+    def _run(self):
+        while not self._stopped.wait(self.sync_interval):
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Writes the snapshot of this process to the metrics directory."""
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        temporary = f"{path}.tmp"
+        try:
+            with open(temporary, "w") as file:
+                json.dump(self.snapshot(), file)
+            os.replace(temporary, path)
+        except OSError:
+            logger.exception("Could not write the metrics snapshot")
+
+    def collect(self) -> dict:
+        """Returns the metrics of all processes, or of this process without a metrics directory.
+
+        The counters of processes that have exited are kept, so the totals do not drop when a
+        worker is replaced. Their gauges are left out.
+        """
+        if not self.directory or self._writer is None:
+            return self.snapshot()
+        self.write_snapshot()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if not _is_running(int(name.removesuffix(".json"))):
+                snapshot = {key: metric for key, metric in snapshot.items() if metric["type"] != "gauge"}
+            snapshots.append(snapshot)
+        return merge_snapshots(snapshots)
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text exposition format."""
+        return render_snapshot(self.collect())
+
+
+def _is_running(pid: int) -> bool:
+    """Checks whether a process with the given ID exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    """Adds up the snapshots of several processes.
+
+    Counter and gauge values of the same labels are summed, histogram buckets and sums as well.
+
+    Args:
+        snapshots (list[dict]): Snapshots as returned by `MetricsRegistry.snapshot`.
+
+    Returns:
+        dict: One snapshot with the combined values.
+    """
+    merged: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            entry = merged.setdefault(name, dict(metric, samples={}))
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                previous = entry["samples"].get(key)
+                if previous is None:
+                    entry["samples"][key] = value
+                elif isinstance(value, list):
+                    entry["samples"][key] = [a + b for a, b in zip(previous, value)]
+                else:
+                    entry["samples"][key] = previous + value
+    for entry in merged.values():
+        entry["samples"] = [[list(key), value] for key, value in entry["samples"].items()]
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: list[str], values: list[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render_snapshot(snapshot: dict) -> str:
+    """Renders a snapshot in the Prometheus text exposition format, version 0.0.4."""
+    lines = []
+    for name in sorted(snapshot):
+        metric = snapshot[name]
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for labels, value in sorted(metric["samples"]):
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_format_labels(metric['labels'], labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric["buckets"], "+Inf"], value[:-1]):
+                cumulative += count
+                bucket = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_format_labels(metric['labels'], labels, bucket)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(metric['labels'], labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(metric['labels'], labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+HTTP_DURATION = REGISTRY.histogram("http_request_duration_seconds", "HTTP request latency by route.", ("method", "route"))
+DB_QUERIES = REGISTRY.histogram("db_query_duration_seconds", "Database statement duration by statement type.", ("operation",))
+TEMPLATE_RENDER = REGISTRY.histogram("template_render_duration_seconds", "Template rendering time by template.", ("template",))
+IMAGE_PROCESSING = REGISTRY.histogram("image_processing_duration_seconds", "Time to render the variants of an uploaded image.",
+                                      buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+PASSWORD_HASHING = REGISTRY.histogram("password_hashing_duration_seconds",
+                                      "bcrypt time by operation, including the wait for a free worker process.", ("operation",),
+                                      buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+RATE_LIMIT_CHECKS = REGISTRY.histogram("rate_limit_check_duration_seconds", "Time spent checking the rate limits of a request.")
+RATE_LIMIT_REJECTIONS = REGISTRY.counter("rate_limit_rejections_total", "Requests rejected by the rate limiter by route.", ("route",))
+
+
+def route_name(scope: Scope) -> str:
+    """Returns the path template of the route that handled a request, e.g. "/api/recipe/get/{recipe_id}".
+
+    Mounted apps are reported by their mount path, requests that matched no route as "other".
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope.get("endpoint") is not None and scope.get("root_path"):
+        return scope["root_path"]
+    return "other"
+
+
+class MetricsMiddleware():
+    """
+    ASGI middleware counting the requests and measuring their latency per route.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_name(scope)
+            HTTP_REQUESTS.inc(scope["method"], route, str(status))
+            HTTP_DURATION.observe(time.perf_counter() - started, scope["method"], route)
+
+
+class TimedTemplate(Template):
+    """
+    Jinja template class measuring the time each rendering takes. Set it as `template_class`
+    of the environment before the templates are loaded.
+    """
+    def render(self, *args, **kwargs) -> str:
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            TEMPLATE_RENDER.observe(time.perf_counter() - started, self.name or "string")
+
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - connection.info["query_started"].pop()
+    operation = statement.lstrip()[:6].upper()
+    DB_QUERIES.observe(elapsed, operation if operation in _OPERATIONS else "OTHER")
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
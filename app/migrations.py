@@ -0,0 +1,317 @@
+"""
+This module contains the versioned schema migrations of the database.
+
+Every migration is applied once, in order, and recorded in the `schema_version` table.
+Databases created before migrations existed have no `schema_version` table; the migrations
+therefore check for existing tables, columns and indexes so they can be applied to them as well.
+Migrations describe the schema as it was at the time they were written and must not be
+changed afterwards; add a new migration instead.
+"""
+import datetime
+import hashlib
+import logging
+import os
+import re
+from typing import Callable
+
+from sqlalchemy import (JSON, Boolean, Column, DateTime, Index, Integer, MetaData, String, Table,
+                        bindparam, func, inspect, select)
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied", DateTime, nullable=False),
+)
+
+
+def _add_column(connection: Connection, table: str, column: Column):
+    """Adds `column` to `table` unless it already exists."""
+    existing = {c["name"] for c in inspect(connection).get_columns(table)}
+    if column.name in existing:
+        return
+    preparer = connection.dialect.identifier_preparer
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(
+        f"ALTER TABLE {preparer.quote(table)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+    )
+
+
+def _create_index(connection: Connection, table: Table, name: str, *columns: str, unique: bool = False):
+    """Creates an index on `table` unless an index with the same name exists."""
+    Index(name, *(table.c[column] for column in columns), unique=unique).create(connection, checkfirst=True)
+
+
+def _reflect(connection: Connection, name: str) -> Table:
+    """Loads the current definition of a table from the database."""
+    return Table(name, MetaData(), autoload_with=connection)
+
+
+def initial_schema(connection: Connection):
+    """Creates the user and recipe tables."""
+    metadata = MetaData()
+    Table(
+        "user", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("username", String, nullable=False),
+        Column("password", String, nullable=False),
+    )
+    Table(
+        "recipe", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("title", String, nullable=False),
+        Column("portions", Integer, nullable=False),
+        Column("prep_time", Integer, nullable=False),
+        Column("cook_time", Integer, nullable=False),
+        Column("img_path", String, nullable=False),
+        Column("tags", JSON),
+        Column("ingredients", JSON),
+        Column("text", String, nullable=False),
+        Column("author", String, nullable=False),
+        Column("author_id", Integer, nullable=False),
+        Column("is_public", Boolean, nullable=False),
+        Column("created", DateTime),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+def feed_indexes_and_image_variants(connection: Connection):
+    """Adds the image variant column and the keyset pagination indexes of the feed."""
+    _add_column(connection, "recipe", Column("img_variants", JSON))
+    recipe = _reflect(connection, "recipe")
+    _create_index(connection, recipe, "ix_recipe_public_feed", "is_public", "created", "id")
+    _create_index(connection, recipe, "ix_recipe_author_feed", "author", "is_public", "created", "id")
+
+
+def username_index(connection: Connection):
+    """Indexes the username, which every login and recipe change looks up."""
+    _create_index(connection, _reflect(connection, "user"), "ix_user_username", "username")
+
+
+def search_index(connection: Connection):
+    """Creates the tag and ingredient search tables, fills them and adds full-text search.
+
+    SQLite gets an FTS5 table over title and text that triggers keep in sync with the recipe
+    table, PostgreSQL an expression GIN index used by `database_handler.search_recipes`.
+    """
+    metadata = MetaData()
+    recipe_tag = Table(
+        "recipe_tag", metadata,
+        Column("recipe_id", Integer, primary_key=True),
+        Column("tag", String, primary_key=True),
+        Index("ix_recipe_tag_tag", "tag", "recipe_id"),
+    )
+    recipe_ingredient = Table(
+        "recipe_ingredient", metadata,
+        Column("recipe_id", Integer, primary_key=True),
+        Column("name", String, primary_key=True),
+        Index("ix_recipe_ingredient_name", "name", "recipe_id"),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+    def normalize(term: str) -> str:
+        # same as models.normalize_term when this migration was written
+        return " ".join(term.split()).lower()
+
+    recipe = _reflect(connection, "recipe")
+    tags, ingredients = set(), set()
+    for recipe_id, recipe_tags, recipe_ingredients in connection.execute(
+            select(recipe.c.id, recipe.c.tags, recipe.c.ingredients)):
+        tags.update((recipe_id, normalize(tag)) for tag in recipe_tags or [] if tag.strip())
+        ingredients.update((recipe_id, normalize(ingredient["name"]))
+                           for ingredient in recipe_ingredients or [] if ingredient.get("name", "").strip())
+    if tags:
+        connection.execute(recipe_tag.insert(), [{"recipe_id": i, "tag": t} for i, t in tags])
+    if ingredients:
+        connection.execute(recipe_ingredient.insert(), [{"recipe_id": i, "name": n} for i, n in ingredients])
+
+    if connection.dialect.name == "sqlite":
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5(title, text, content='recipe', content_rowid='id')"
+        )
+        connection.exec_driver_sql("""
+            CREATE TRIGGER IF NOT EXISTS recipe_fts_insert AFTER INSERT ON recipe BEGIN
+                INSERT INTO recipe_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
+            END""")
+        connection.exec_driver_sql("""
+            CREATE TRIGGER IF NOT EXISTS recipe_fts_delete AFTER DELETE ON recipe BEGIN
+                INSERT INTO recipe_fts(recipe_fts, rowid, title, text) VALUES ('delete', old.id, old.title, old.text);
+            END""")
+        connection.exec_driver_sql("""
+            CREATE TRIGGER IF NOT EXISTS recipe_fts_update AFTER UPDATE OF title, text ON recipe BEGIN
+                INSERT INTO recipe_fts(recipe_fts, rowid, title, text) VALUES ('delete', old.id, old.title, old.text);
+                INSERT INTO recipe_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
+            END""")
+        connection.exec_driver_sql("INSERT INTO recipe_fts(recipe_fts) VALUES ('rebuild')")
+    elif connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_recipe_fulltext ON recipe "
+            "USING gin (to_tsvector('simple', title || ' ' || text))"
+        )
+
+
+def unique_username(connection: Connection):
+    """Makes the username index unique, so duplicate registrations fail in the database."""
+    user = _reflect(connection, "user")
+    duplicates = connection.execute(
+        select(user.c.username).group_by(user.c.username).having(func.count() > 1)
+    ).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Cannot add a unique username index, duplicate usernames: {', '.join(duplicates)}")
+    if any(index.name == "ix_user_username" for index in user.indexes):
+        Index("ix_user_username", user.c.username).drop(connection)
+    _create_index(connection, user, "ix_user_username", "username", unique=True)
+
+
+def recipe_versions(connection: Connection):
+    """Adds the change timestamp and version counter of recipes, used for ETags."""
+    _add_column(connection, "recipe", Column("updated", DateTime))
+    _add_column(connection, "recipe", Column("version", Integer))
+    recipe = _reflect(connection, "recipe")
+    connection.execute(recipe.update().where(recipe.c.version.is_(None)).values(version=1))
+    connection.execute(recipe.update().where(recipe.c.updated.is_(None)).values(updated=recipe.c.created))
+
+
+def image_path_index(connection: Connection):
+    """Indexes the image path, which the image garbage collector looks up for every file."""
+    _create_index(connection, _reflect(connection, "recipe"), "ix_recipe_img_path", "img_path")
+
+
+def image_storage_paths(connection: Connection):
+    """Replaces the image paths in the static directory, e.g. `static/recipe_images/x.webp`, by
+    the paths of the image storage, e.g. `images/x.webp`. The files are moved at startup."""
+    legacy_prefix = "static/recipe_images/"
+    recipe = _reflect(connection, "recipe")
+    rows = connection.execute(
+        select(recipe.c.id, recipe.c.img_path, recipe.c.img_variants).where(recipe.c.img_path.like(f"{legacy_prefix}%"))
+    ).all()
+
+    def rewrite(path: str) -> str:
+        return f"images/{path[len(legacy_prefix):]}" if path.startswith(legacy_prefix) else path
+
+    updates = [
+        {
+            "recipe_id": row.id,
+            "new_img_path": rewrite(row.img_path),
+            "new_img_variants": {name: rewrite(path) for name, path in row.img_variants.items()} if row.img_variants else row.img_variants,
+        }
+        for row in rows if row.img_path.startswith(legacy_prefix)
+    ]
+    if updates:
+        connection.execute(
+            recipe.update().where(recipe.c.id == bindparam("recipe_id")).values(
+                img_path=bindparam("new_img_path"), img_variants=bindparam("new_img_variants"),
+                version=recipe.c.version + 1,
+            ),
+            updates,
+        )
+
+
+def recipe_insert_sentinel(connection: Connection):
+    """Adds the column that matches the IDs returned by a multi-row INSERT to its rows."""
+    _add_column(connection, "recipe", Column("insert_sentinel", Integer))
+
+
+def legacy_image_keys(connection: Connection):
+    """Gives the images whose file names are no valid storage keys a key derived from the name.
+
+    The images uploaded before the image storage existed were named after the recipe title, so
+    their names may contain spaces, umlauts or slashes. The recipes are changed to refer to the
+    new keys, and the `legacy_image` table lists the files to move to them at startup.
+    """
+    prefix = "images/"
+    # the storage keys as of this migration, see `image_storage._KEY`
+    valid_key = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]{0,254}")
+
+    def legacy_image_key(name: str) -> str:
+        # the same keys as `image_storage.legacy_image_key` at the time of this migration
+        if valid_key.fullmatch(name):
+            return name
+        extension = os.path.splitext(name)[1].lower()
+        if not re.fullmatch(r"\.[a-z0-9]{1,10}", extension):
+            extension = ""
+        return f"{hashlib.sha256(name.encode()).hexdigest()[:32]}{extension}"
+
+    legacy_image = Table(
+        "legacy_image", MetaData(),
+        Column("path", String, primary_key=True),
+        Column("key", String, nullable=False),
+    )
+    legacy_image.create(connection, checkfirst=True)
+    recipe = _reflect(connection, "recipe")
+    renamed: dict[str, str] = {}
+
+    def rekey(path: str) -> str:
+        if not path.startswith(prefix):
+            return path
+        name = path[len(prefix):]
+        key = legacy_image_key(name)
+        if key != name:
+            renamed[name] = key
+        return f"{prefix}{key}"
+
+    updates = []
+    for row in connection.execute(select(recipe.c.id, recipe.c.img_path, recipe.c.img_variants)):
+        img_path = rekey(row.img_path)
+        img_variants = {name: rekey(path) for name, path in row.img_variants.items()} if row.img_variants else row.img_variants
+        if img_path != row.img_path or img_variants != row.img_variants:
+            updates.append({"recipe_id": row.id, "new_img_path": img_path, "new_img_variants": img_variants})
+    if updates:
+        connection.execute(
+            recipe.update().where(recipe.c.id == bindparam("recipe_id")).values(
+                img_path=bindparam("new_img_path"), img_variants=bindparam("new_img_variants"),
+                version=recipe.c.version + 1,
+            ),
+            updates,
+        )
+        connection.execute(legacy_image.insert(), [{"path": path, "key": key} for path, key in renamed.items()])
+        logger.info("Renamed %d images whose file names are no valid storage keys", len(renamed))
+
+
+# (version, description, migration)
+MIGRATIONS: list[tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "initial schema", initial_schema),
+    (2, "feed indexes and image variants", feed_indexes_and_image_variants),
+    (3, "username index", username_index),
+    (4, "tag, ingredient and full-text search index", search_index),
+    (5, "unique username index", unique_username),
+    (6, "recipe versions", recipe_versions),
+    (7, "image path index", image_path_index),
+    (8, "image storage paths", image_storage_paths),
+    (9, "recipe insert sentinel", recipe_insert_sentinel),
+    (10, "legacy image keys", legacy_image_keys),
+]
+
+
+def current_version(connection: Connection) -> int:
+    """Returns the version of the newest applied migration, 0 if none was applied."""
+    SCHEMA_VERSION.create(connection, checkfirst=True)
+    versions = connection.execute(select(SCHEMA_VERSION.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def migrate(engine: Engine) -> int:
+    """Applies all pending migrations, each in its own transaction.
+
+    Args:
+        engine (Engine): The engine of the database to migrate.
+
+    Returns:
+        int: The schema version after migrating.
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+    for migration_version, description, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(SCHEMA_VERSION.insert().values(
+                version=migration_version, description=description, applied=datetime.datetime.now()
+            ))
+        logger.info("Applied migration %s: %s", migration_version, description)
+        version = migration_version
+    return version
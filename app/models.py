@@ -1,5 +1,5 @@
-from sqlalchemy import event
-from sqlmodel import Field, SQLModel, Column, JSON
+from sqlalchemy import event, insert_sentinel
+from sqlmodel import Field, SQLModel, Column, JSON, Index
 import datetime
 
 
@@ -8,11 +8,11 @@ class User(SQLModel, table=True):
     Represents a user in the database.
     Attributes:
         id (int | None): The unique identifier for the user. Primary key.
-        username (str): The username of the user.
+        username (str): The username of the user. Unique.
         password (str): The password of the user.
     """
     id: int | None = Field(default=None, primary_key=True)
-    username: str
+    username: str = Field(index=True, unique=True)
     password: str
 
 class Recipe(SQLModel, table=True):
@@ -26,19 +26,34 @@ class Recipe(SQLModel, table=True):
         cook_time (int): The cooking time in minutes.
         title (str): The title of the recipe.
         img_path (str): The file path to the recipe's image.
+        img_variants (dict[str, str] | None): The file paths of the resized image variants keyed by variant name, stored as JSON.
         tags (list[str] | None): A list of tags associated with the recipe, stored as JSON.
         ingredients (list[str] | None): A list of ingredients for the recipe, stored as JSON.
         text (str): The text description of the recipe. Created by a rich text editor.
         author (str): The name of the recipe's author.
         author_id (int): The unique identifier of the author.
         created (datetime.datetime | None): The timestamp when the recipe was created.
+        updated (datetime.datetime | None): The timestamp of the last change of the recipe.
+        version (int): Counts the changes of the recipe, starting at 1.
     """
+    __table_args__ = (
+        # keyset pagination of the feed, see database_handler.get_recipes
+        Index("ix_recipe_public_feed", "is_public", "created", "id"),
+        Index("ix_recipe_author_feed", "author", "is_public", "created", "id"),
+        # reference lookups of the image garbage collector, see image_gc
+        Index("ix_recipe_img_path", "img_path"),
+        # numbers the rows of a multi-row INSERT, so SQLite returns the IDs in the order of the
+        # rows, see database_handler.create_recipes; not mapped to a field
+        insert_sentinel("insert_sentinel"),
+    )
+
     id: int| None = Field(default=None, primary_key=True)
     title: str
     portions: int
     prep_time: int
     cook_time: int
     img_path: str
+    img_variants: dict[str, str] | None = Field(default=None, sa_column=Column(JSON))
     tags: list[str] | None = Field(default=None, sa_column=Column(JSON))
     ingredients: list[dict[str, str]] | None = Field(default=None, sa_column=Column(JSON))
     text: str
@@ -46,6 +61,68 @@ class Recipe(SQLModel, table=True):
     author_id: int
     is_public: bool = Field(default=False)
     created: None | datetime.datetime
+    updated: None | datetime.datetime = None
+    version: int = Field(default=1)
+
+class RecipeTag(SQLModel, table=True):
+    """
+    Search index entry linking a recipe to one of its tags.
+
+    Maintained by `database_handler` whenever a recipe is created, updated or deleted.
+
+    Attributes:
+        recipe_id (int): The ID of the tagged recipe.
+        tag (str): The normalized tag, see `normalize_term`.
+    """
+    __tablename__ = "recipe_tag"
+    __table_args__ = (Index("ix_recipe_tag_tag", "tag", "recipe_id"),)
+
+    recipe_id: int = Field(primary_key=True)
+    tag: str = Field(primary_key=True)
+
+class RecipeIngredient(SQLModel, table=True):
+    """
+    Search index entry linking a recipe to the name of one of its ingredients.
+
+    Maintained by `database_handler` whenever a recipe is created, updated or deleted.
+
+    Attributes:
+        recipe_id (int): The ID of the recipe.
+        name (str): The normalized ingredient name, see `normalize_term`.
+    """
+    __tablename__ = "recipe_ingredient"
+    __table_args__ = (Index("ix_recipe_ingredient_name", "name", "recipe_id"),)
+
+    recipe_id: int = Field(primary_key=True)
+    name: str = Field(primary_key=True)
+
+class LegacyImage(SQLModel, table=True):
+    """
+    An image uploaded before the image storage existed whose file name is no valid storage key,
+    e.g. because the recipe title in the name has spaces or umlauts.
+
+    The recipes refer to the new key already; the file is moved at startup, see
+    `image_storage.import_flat_images`, and the entry removed.
+
+    Attributes:
+        path (str): The path of the file relative to the former image directory.
+        key (str): The storage key the file is moved to.
+    """
+    __tablename__ = "legacy_image"
+
+    path: str = Field(primary_key=True)
+    key: str
+
+def normalize_term(term: str) -> str:
+    """Normalizes a tag or ingredient name for the search index.
+
+    Args:
+        term (str): The tag or ingredient name as entered by the user.
+
+    Returns:
+        str: The term in lower case with surrounding and repeated whitespace removed.
+    """
+    return " ".join(term.split()).lower()
 
 @event.listens_for(Recipe,'before_insert')
 def update_created_modified_on_create_listener(mapper, connection, target):
@@ -61,3 +138,17 @@ def update_created_modified_on_create_listener(mapper, connection, target):
         target: The `Recipe` instance being inserted.
     """
     target.created = datetime.datetime.now()
+    target.updated = target.created
+    target.version = 1
+
+@event.listens_for(Recipe, 'before_update')
+def update_modified_on_update_listener(mapper, connection, target):
+    """Sets the `updated` timestamp and increments the `version` before updating a `Recipe` record.
+
+    Args:
+        mapper: The SQLAlchemy mapper object.
+        connection: The database connection being used.
+        target: The `Recipe` instance being updated.
+    """
+    target.updated = datetime.datetime.now()
+    target.version = (target.version or 0) + 1
@@ -1,6 +1,32 @@
-from passlib.context import CryptContext
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from metrics import PASSWORD_HASHING
+
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+HASH_WORKERS = int(os.environ.get("HASH_WORKERS", str(os.cpu_count() or 1)))
+HASH_QUEUE_SIZE = int(os.environ.get("HASH_QUEUE_SIZE", str(HASH_WORKERS * 8)))
+
+_pwd_context = None
+
+
+def get_pwd_context():
+    """Returns the passlib context, created on first use.
+
+    Only the worker processes of the `HashingService` hash passwords, so the web workers never
+    import passlib and bcrypt.
+    """
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS)
+    return _pwd_context
 
-pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=12)
 
 class Hasher():
     """
@@ -15,7 +41,7 @@ class Hasher():
         returns:
             bool: True if the plain password matches the hashed password, False otherwise.
         """
-        return pwd_context.verify(plain_password, hashed_password)
+        return get_pwd_context().verify(plain_password, hashed_password)
 
     @staticmethod
     def get_password_hash(password):
@@ -25,4 +51,107 @@ class Hasher():
         Returns:
             str: The hashed password.
         """
-        return pwd_context.hash(password)
\ No newline at end of file
+        return get_pwd_context().hash(password)
+
+    @staticmethod
+    def verify_and_update(plain_password, hashed_password):
+        """Verifies a password and rehashes it if the hash uses an outdated cost.
+        args:
+            plain_password (str): The plain text password to verify.
+            hashed_password (str): The hashed password to compare against.
+        returns:
+            tuple[bool, str | None]: Whether the password matches, and a new hash if the
+                stored one should be replaced.
+        """
+        return get_pwd_context().verify_and_update(plain_password, hashed_password)
+
+
+class HashingQueueFull(Exception):
+    """Raised when the hashing service has no capacity left for another request."""
+
+
+class HashingService():
+    """
+    Runs bcrypt hashing and verification on a process pool, so that the CPU heavy work does
+    not block the event loop.
+
+    At most `queue_size` operations may be pending at the same time. Further requests are
+    rejected with `HashingQueueFull` instead of piling up behind a login burst.
+    """
+    def __init__(self, workers: int = HASH_WORKERS, queue_size: int = HASH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._pool: ProcessPoolExecutor | None = None
+        self._pending = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """int: The number of hashing operations that are queued or running."""
+        return self._pending
+
+    def start(self):
+        """Starts the worker processes."""
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self):
+        """Stops the worker processes after the running operations are finished."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    async def _submit(self, func, *args):
+        """Runs `func` on the process pool unless the queue is saturated.
+
+        Args:
+            func (Callable): A picklable function to run in a worker process.
+            *args: The arguments for `func`.
+
+        Returns:
+            Any: The return value of `func`.
+
+        Raises:
+            HashingQueueFull: If `queue_size` operations are already pending.
+        """
+        if self._pending >= self.queue_size:
+            raise HashingQueueFull()
+        self._pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, func, *args)
+        finally:
+            self._pending -= 1
+            PASSWORD_HASHING.observe(time.perf_counter() - started, func.__name__)
+
+    async def verify_password(self, plain_password: str, hashed_password: str) -> bool:
+        """Verifies a plain password against a hashed password. See `Hasher.verify_password`."""
+        return await self._submit(Hasher.verify_password, plain_password, hashed_password)
+
+    async def get_password_hash(self, password: str) -> str:
+        """Hashes a plain password using bcrypt. See `Hasher.get_password_hash`."""
+        return await self._submit(Hasher.get_password_hash, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        """Verifies a password and rehashes outdated hashes. See `Hasher.verify_and_update`."""
+        return await self._submit(Hasher.verify_and_update, plain_password, hashed_password)
+
+
+HASHING_SERVICE = HashingService()
+
+
+async def hashing_queue_full_handler(request: Request, exc: HashingQueueFull) -> JSONResponse:
+    """Answers requests that could not be queued for hashing with a 503 response.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        exc (HashingQueueFull): The raised exception.
+
+    Returns:
+        JSONResponse: A 503 response asking the client to retry shortly.
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Server is busy, please try again"},
+        headers={"Retry-After": "1"},
+    )
@@ -0,0 +1,179 @@
+"""
+This module records the SQL statements of each request in developer mode.
+
+With `QUERY_PROFILER` turned on, every statement a request runs is recorded with its duration.
+The response carries the number of statements, the repeated ones and the time spent in the
+database in its headers, and requests that exceed the query budget of their route or repeat
+a statement are logged with the statements. With `QUERY_PROFILER_STRICT` such a request is
+answered with a 500 error instead, so tests fail on it.
+
+The statements run on the database thread pool, `async_database_handler._run` passes the
+context of the request on to the thread.
+"""
+import contextvars
+import logging
+import os
+import time
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import route_name
+
+QUERY_PROFILER = os.environ.get("QUERY_PROFILER", "false").lower() in ("1", "true", "yes")
+QUERY_PROFILER_STRICT = os.environ.get("QUERY_PROFILER_STRICT", "false").lower() in ("1", "true", "yes")
+QUERY_BUDGET = int(os.environ.get("QUERY_BUDGET", "10"))
+# a statement run this often with different parameters within one request is likely an N+1 loop
+REPEAT_THRESHOLD = 3
+
+logger = logging.getLogger(__name__)
+
+_profile: contextvars.ContextVar["QueryProfile | None"] = contextvars.ContextVar("query_profile", default=None)
+
+
+class QueryProfile():
+    """
+    The statements run while handling one request.
+    """
+    def __init__(self):
+        self.queries: list[tuple[str, str, float]] = []
+
+    def record(self, statement: str, parameters, seconds: float):
+        self.queries.append((statement, repr(parameters), seconds))
+
+    @property
+    def count(self) -> int:
+        return len(self.queries)
+
+    @property
+    def seconds(self) -> float:
+        return sum(seconds for _, _, seconds in self.queries)
+
+    def duplicates(self) -> int:
+        """Returns how many statements ran again with the same parameters."""
+        return self.count - len({(statement, parameters) for statement, parameters, _ in self.queries})
+
+    def repeated(self) -> dict[str, int]:
+        """Returns the statements run at least `REPEAT_THRESHOLD` times, with their count."""
+        counts = {}
+        for statement, _, _ in self.queries:
+            counts[statement] = counts.get(statement, 0) + 1
+        return {statement: count for statement, count in counts.items() if count >= REPEAT_THRESHOLD}
+
+    def report(self) -> list[dict]:
+        """Returns the statements with their duration in milliseconds, for the log."""
+        return [{"statement": " ".join(statement.split()), "parameters": parameters, "ms": round(seconds * 1000, 3)}
+                for statement, parameters, seconds in self.queries]
+
+
+def query_budget(limit: int) -> Callable:
+    """Sets the maximum number of SQL statements a route may run per request.
+
+    Apply it below the `limiter.limit` decorator, which copies the attribute to its wrapper.
+
+    Args:
+        limit (int): The number of statements.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(func: Callable) -> Callable:
+        func.query_budget = limit
+        return func
+    return decorator
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if _profile.get() is not None:
+        connection.info.setdefault("profiler_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    profile = _profile.get()
+    if profile is not None:
+        profile.record(statement, parameters, time.perf_counter() - connection.info["profiler_started"].pop())
+
+
+def _handle_error(context):
+    started = context.connection.info.get("profiler_started") if context.connection is not None else None
+    if _profile.get() is not None and started:
+        started.pop()
+
+
+class QueryProfilerMiddleware():
+    """
+    ASGI middleware recording the SQL statements of every request. Add it only in developer
+    mode, it registers the engine listeners when it is created.
+    """
+    def __init__(self, app: ASGIApp, strict: bool = QUERY_PROFILER_STRICT, default_budget: int = QUERY_BUDGET):
+        self.app = app
+        self.strict = strict
+        self.default_budget = default_budget
+        if not event.contains(Engine, "after_cursor_execute", _after_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        profile = QueryProfile()
+        token = _profile.set(profile)
+        rejected = False
+
+        async def send_wrapper(message: Message):
+            nonlocal rejected
+            if message["type"] == "http.response.start":
+                rejected = self._check(scope, profile)
+                if rejected:
+                    await self._send_rejection(send, scope, profile)
+                    return
+                headers = list(message.get("headers", []))
+                headers += [
+                    (b"x-query-count", str(profile.count).encode()),
+                    (b"x-query-duplicates", str(profile.duplicates()).encode()),
+                    (b"server-timing", f'db;dur={profile.seconds * 1000:.1f};desc="{profile.count} queries"'.encode()),
+                ]
+                message = dict(message, headers=headers)
+            elif rejected:
+                return
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _profile.reset(token)
+
+    def _budget(self, scope: Scope) -> int:
+        return getattr(scope.get("endpoint"), "query_budget", self.default_budget)
+
+    def _check(self, scope: Scope, profile: QueryProfile) -> bool:
+        """Logs the statements of a request over budget or with repeated statements.
+
+        Returns:
+            bool: Whether the request is to be rejected in strict mode.
+        """
+        budget = self._budget(scope)
+        repeated = profile.repeated()
+        duplicates = profile.duplicates()
+        if profile.count <= budget and not repeated and not duplicates:
+            return False
+        logger.warning(
+            "%s %s ran %d queries (budget %d, %d duplicates, %d repeated)",
+            scope["method"], route_name(scope), profile.count, budget, duplicates, len(repeated),
+            extra={"queries": profile.report()},
+        )
+        return self.strict and (profile.count > budget or bool(repeated))
+
+    async def _send_rejection(self, send: Send, scope: Scope, profile: QueryProfile):
+        lines = [f"{scope['method']} {route_name(scope)} ran {profile.count} queries, budget {self._budget(scope)}:"]
+        lines += [f"{query['ms']} ms  {query['statement']}  {query['parameters']}" for query in profile.report()]
+        body = "\n".join(lines).encode()
+        await send({"type": "http.response.start", "status": 500, "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", str(len(body)).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,291 @@
+"""
+This module configures the rate limiter and the storage of its counters.
+
+By default the counters are kept in the memory of the process, so every uvicorn worker and
+every replica counts on its own and a restart resets them. With `RATE_LIMIT_STORAGE_URL` set
+to a shared store, e.g. `redis://redis:6379`, all processes share one counter per client and
+limit. The default `sliding-window-counter` strategy weighs the previous window by how much of
+it still overlaps the last minute, so a client cannot send twice its budget around a window
+boundary. With Redis every check is a single atomic script call.
+
+A shared store costs a network round trip per limited request, made while the event loop
+waits. Prefixing the URL with `batched+`, e.g. `batched+redis://redis:6379`, counts the hits
+in process instead and sends them to the shared store every `RATE_LIMIT_SYNC_INTERVAL`
+seconds, one increment per key. The shared counts are read at most once per interval. A
+client can therefore exceed its budget by the hits it sends to the other processes within
+one interval.
+"""
+import inspect
+import logging
+import os
+import threading
+import time
+from math import floor
+
+from limits.storage import Storage, SlidingWindowCounterSupport, storage_from_string
+from limits.storage.base import TimestampedSlidingWindow
+from limits.storage.registry import SCHEMES
+from slowapi import Limiter
+from slowapi.errors import RateLimitExceeded
+from starlette.requests import Request
+
+from metrics import RATE_LIMIT_CHECKS, RATE_LIMIT_REJECTIONS, route_name
+
+RATE_LIMIT_ENABLED = os.environ.get("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_STORAGE_URL = os.environ.get("RATE_LIMIT_STORAGE_URL", "memory://")
+RATE_LIMIT_STRATEGY = os.environ.get("RATE_LIMIT_STRATEGY", "sliding-window-counter")
+RATE_LIMIT_SYNC_INTERVAL = float(os.environ.get("RATE_LIMIT_SYNC_INTERVAL", "1"))
+BATCHED_PREFIX = "batched+"
+
+logger = logging.getLogger(__name__)
+
+
+def client_address(request: Request) -> str:
+    """Key function of the limits, the address of the client like `slowapi.util.get_remote_address`."""
+    return request.client.host if request.client else "127.0.0.1"
+
+
+# slowapi inspects the signature of the key function on every check, which costs more than the
+# check itself. inspect.signature returns a precomputed __signature__ as it is.
+client_address.__signature__ = inspect.signature(client_address)
+
+
+class BatchedStorage(Storage, SlidingWindowCounterSupport, TimestampedSlidingWindow):
+    """
+    Rate limit storage that counts hits in process and adds them to a shared storage in batches.
+
+    Registered for every synchronous scheme of the `limits` library prefixed with `batched+`.
+    Supports the fixed window and sliding window counter strategies.
+
+    Attributes:
+        shared (Storage): The storage the counts are sent to.
+        sync_interval (float): The seconds between two flushes, and how long a count read from
+            the shared storage is used.
+    """
+    STORAGE_SCHEME = [f"{BATCHED_PREFIX}{scheme}" for scheme in SCHEMES if not scheme.startswith("async+")]
+
+    def __init__(self, uri: str, wrap_exceptions: bool = False, sync_interval: float = RATE_LIMIT_SYNC_INTERVAL, **options):
+        self.shared = storage_from_string(uri.removeprefix(BATCHED_PREFIX), **options)
+        self.sync_interval = float(sync_interval)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._reset_local()
+        self.flushes = 0
+        self.shared_calls = 0
+        self.errors = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions)
+
+    def _reset_local(self):
+        # key -> [amount, expiry, elastic expiry] of the hits not sent yet
+        self._pending: dict[str, list] = {}
+        # hits that are being sent by the current flush
+        self._in_flight: dict[str, int] = {}
+        # key -> (count in the shared storage, time until which it is used)
+        self._known: dict[str, tuple[int, float]] = {}
+        self._flusher: threading.Thread | None = None
+        self._pid = os.getpid()
+
+    @property
+    def base_exceptions(self):
+        return self.shared.base_exceptions
+
+    def _ensure_flusher(self):
+        """Starts the flush thread, again in a forked worker, as threads do not survive a fork."""
+        if self._pid != os.getpid():
+            with self._lock:
+                self._reset_local()
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, name="ratelimit-flush", daemon=True)
+                    self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            self.flush()
+
+    def flush(self):
+        """Adds the pending hits to the shared storage and remembers the resulting counts.
+
+        Hits that cannot be sent because the shared storage is unreachable are kept for the next flush.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._in_flight = {key: entry[0] for key, entry in pending.items()}
+            for key, (amount, expiry, elastic_expiry) in pending.items():
+                if amount <= 0:
+                    continue
+                try:
+                    count = self.shared.incr(key, expiry, elastic_expiry=elastic_expiry, amount=amount)
+                except self.shared.base_exceptions as error:
+                    self.errors += 1
+                    logger.warning("Rate limit storage unreachable, keeping %s hits of %s: %s", amount, key, error)
+                    with self._lock:
+                        entry = self._pending.setdefault(key, [0, expiry, elastic_expiry])
+                        entry[0] += amount
+                        self._in_flight.pop(key, None)
+                    continue
+                finally:
+                    self.shared_calls += 1
+                with self._lock:
+                    self._known[key] = (count, time.time() + self.sync_interval)
+                    self._in_flight.pop(key, None)
+            now = time.time()
+            with self._lock:
+                self._in_flight = {}
+                self._known = {key: known for key, known in self._known.items() if known[1] > now}
+            self.flushes += 1
+
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        self._ensure_flusher()
+        with self._lock:
+            entry = self._pending.setdefault(key, [0, expiry, elastic_expiry])
+            entry[0] += amount
+            entry[1] = expiry
+        return self.get(key)
+
+    def decr(self, key: str, amount: int = 1) -> int:
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[0] = max(entry[0] - amount, 0)
+        return self.get(key)
+
+    def get(self, key: str) -> int:
+        now = time.time()
+        with self._lock:
+            known = self._known.get(key)
+        if known is None or known[1] <= now:
+            self.shared_calls += 1
+            known = (self.shared.get(key), now + self.sync_interval)
+            with self._lock:
+                self._known[key] = known
+        with self._lock:
+            pending = self._pending.get(key)
+            return known[0] + self._in_flight.get(key, 0) + (pending[0] if pending else 0)
+
+    def get_expiry(self, key: str) -> float:
+        return self.shared.get_expiry(key)
+
+    def check(self) -> bool:
+        return self.shared.check()
+
+    def reset(self) -> int | None:
+        with self._lock:
+            self._pending.clear()
+            self._known.clear()
+        return self.shared.reset()
+
+    def clear(self, key: str):
+        with self._lock:
+            self._pending.pop(key, None)
+            self._known.pop(key, None)
+        self.shared.clear(key)
+
+    def get_sliding_window(self, key: str, expiry: int) -> tuple[int, float, int, float]:
+        now = time.time()
+        previous_key, current_key = self.sliding_window_keys(key, expiry, now)
+        previous_count = self.get(previous_key)
+        current_count = self.get(current_key)
+        previous_ttl = (1 - (((now - expiry) / expiry) % 1)) * expiry if previous_count else 0.0
+        current_ttl = (1 - ((now / expiry) % 1)) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(self, key: str, limit: int, expiry: int, amount: int = 1) -> bool:
+        if amount > limit:
+            return False
+        previous_count, previous_ttl, current_count, _ = self.get_sliding_window(key, expiry)
+        weighted_count = previous_count * previous_ttl / expiry + current_count
+        if floor(weighted_count) + amount > limit:
+            return False
+        _, current_key = self.sliding_window_keys(key, expiry, time.time())
+        # the current window counter lives twice the window, it is the previous one afterwards
+        current_count = self.incr(current_key, 2 * expiry, amount=amount)
+        if floor(previous_count * previous_ttl / expiry + current_count) > limit:
+            # a concurrent request took the last entry
+            self.decr(current_key, amount)
+            return False
+        return True
+
+    def stats(self) -> dict:
+        """Returns the number of flushes and calls to the shared storage."""
+        with self._lock:
+            pending = sum(entry[0] for entry in self._pending.values())
+        return {
+            "sync_interval": self.sync_interval,
+            "pending_hits": pending,
+            "flushes": self.flushes,
+            "shared_calls": self.shared_calls,
+            "errors": self.errors,
+        }
+
+
+class TimedLimiter(Limiter):
+    """
+    `Limiter` that measures the time spent checking the limits of each request.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._timing_lock = threading.Lock()
+        self.checks = 0
+        self.rejected = 0
+        self.check_seconds = 0.0
+        self.max_check_seconds = 0.0
+
+    def _check_request_limit(self, request: Request, endpoint_func, in_middleware: bool = True):
+        started = time.perf_counter()
+        rejected = False
+        try:
+            super()._check_request_limit(request, endpoint_func, in_middleware)
+        except RateLimitExceeded:
+            rejected = True
+            RATE_LIMIT_REJECTIONS.inc(route_name(request.scope))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            RATE_LIMIT_CHECKS.observe(elapsed)
+            with self._timing_lock:
+                self.checks += 1
+                self.rejected += rejected
+                self.check_seconds += elapsed
+                self.max_check_seconds = max(self.max_check_seconds, elapsed)
+
+    def flush(self):
+        """Sends the pending hits of a batched storage to the shared storage."""
+        if isinstance(self._storage, BatchedStorage):
+            self._storage.flush()
+
+    def stats(self) -> dict:
+        """Returns the storage, the number of checks and the time they took."""
+        with self._timing_lock:
+            stats = {
+                "enabled": self.enabled,
+                "storage": type(self._storage).__name__,
+                "strategy": type(self._limiter).__name__,
+                "checks": self.checks,
+                "rejected": self.rejected,
+                "mean_check_us": round(self.check_seconds / self.checks * 1e6, 1) if self.checks else 0.0,
+                "max_check_us": round(self.max_check_seconds * 1e6, 1),
+            }
+        if isinstance(self._storage, BatchedStorage):
+            stats["batched"] = self._storage.stats()
+        return stats
+
+
+def create_limiter(storage_url: str = RATE_LIMIT_STORAGE_URL, strategy: str = RATE_LIMIT_STRATEGY,
+                   enabled: bool = RATE_LIMIT_ENABLED) -> TimedLimiter:
+    """Creates the rate limiter of the application, keyed by the client address.
+
+    Args:
+        storage_url (str): The `limits` storage URL, optionally prefixed with `batched+`.
+        strategy (str): The `limits` strategy, e.g. "sliding-window-counter" or "moving-window".
+        enabled (bool): Whether limits are enforced at all.
+
+    Returns:
+        TimedLimiter: The limiter. If the shared storage fails, it falls back to counting in memory
+            until the storage is reachable again.
+    """
+    return TimedLimiter(key_func=client_address, storage_uri=storage_url, strategy=strategy,
+                        enabled=enabled, in_memory_fallback_enabled=True)
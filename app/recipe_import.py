@@ -0,0 +1,317 @@
+"""
+This module reads the bodies of the JSON recipe API, i.e. the batch routes and PATCH.
+
+Bulk imports are sent as a JSON array or as NDJSON, one recipe per line. The body is read from
+the request stream and refused as soon as it exceeds `BATCH_MAX_BYTES`. Every recipe is
+validated on its own, so one invalid entry only fails that entry.
+"""
+import json
+import os
+
+from fastapi import Request
+from pydantic import BaseModel, Field, ValidationError
+from starlette.concurrency import run_in_threadpool
+
+from compression import decoded_etag
+from image_gc import image_variants, keep_images, owner_path
+from image_storage import IMAGE_STORAGE, storage_key
+from models import Recipe
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(1024 * 1024)))
+# marks an NDJSON line that could not be parsed
+_INVALID_LINE = object()
+
+
+class RequestRejected(Exception):
+    """Raised when a request to the JSON recipe API is refused as a whole.
+
+    Attributes:
+        status_code (int): The HTTP status code to answer with.
+        message (str): A message that can be shown to the user.
+    """
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Ingredient(BaseModel):
+    name: str = Field(min_length=1, max_length=200)
+    amount: str = Field(default="", max_length=200)
+
+
+class RecipeImport(BaseModel):
+    """
+    A recipe of a bulk import, in the format `/api/recipe/get/{id}` returns. The author, ID and
+    timestamps are ignored, imported recipes belong to the importing user.
+
+    The image has to be uploaded already, `img_path` and `img_variants` must be `images/` paths
+    of stored images, the variants those of `img_path`. Without `img_variants` the variants of
+    the image are used, as for `RecipePatch`.
+    """
+    title: str = Field(min_length=1, max_length=200)
+    portions: int = Field(ge=1, le=1000)
+    prep_time: int = Field(ge=0, le=100000)
+    cook_time: int = Field(ge=0, le=100000)
+    text: str = Field(min_length=1, max_length=100000)
+    tags: list[str] = Field(default=[], max_length=10)
+    ingredients: list[Ingredient] = Field(default=[], max_length=100)
+    is_public: bool = False
+    img_path: str
+    img_variants: dict[str, str] | None = None
+
+    def to_recipe(self, author: str, author_id: int) -> Recipe:
+        """Creates the recipe to insert. Blocks on the image storage, call it on a worker thread.
+
+        Raises:
+            ValueError: If one of the images does not exist.
+        """
+        variants = self.img_variants if "img_variants" in self.model_fields_set else image_variants(self.img_path)
+        paths = [self.img_path, *(variants or {}).values()]
+        for path in paths:
+            if not _is_uploaded_image(path):
+                raise ValueError(f"Unknown image {path}")
+        _check_variants(self.img_path, variants)
+        if not keep_images(paths):
+            raise ValueError(f"Unknown image {self.img_path}")
+        return Recipe(
+            title=self.title,
+            portions=self.portions,
+            prep_time=self.prep_time,
+            cook_time=self.cook_time,
+            text=self.text,
+            tags=self.tags,
+            ingredients=[ingredient.model_dump() for ingredient in self.ingredients],
+            is_public=self.is_public,
+            img_path=self.img_path,
+            img_variants=variants,
+            author=author,
+            author_id=author_id,
+        )
+
+
+class RecipePatch(BaseModel):
+    """
+    The fields of a recipe changed by a PATCH request. Fields that are not sent keep their
+    value, an image has to be uploaded already like for `RecipeImport`. The variants can only
+    be changed together with `img_path`; if they are not sent, those of the new image are used.
+    """
+    model_config = {"extra": "forbid"}
+
+    title: str | None = Field(default=None, min_length=1, max_length=200)
+    portions: int | None = Field(default=None, ge=1, le=1000)
+    prep_time: int | None = Field(default=None, ge=0, le=100000)
+    cook_time: int | None = Field(default=None, ge=0, le=100000)
+    text: str | None = Field(default=None, min_length=1, max_length=100000)
+    tags: list[str] | None = Field(default=None, max_length=10)
+    ingredients: list[Ingredient] | None = Field(default=None, max_length=100)
+    is_public: bool | None = None
+    img_path: str | None = None
+    img_variants: dict[str, str] | None = None
+
+    def changes(self) -> dict:
+        """Returns the sent fields as column values. Blocks on the image storage, call it on a
+        worker thread.
+
+        Raises:
+            ValueError: If a field that cannot be empty is null, an image does not exist or the
+                variants do not belong to the image.
+        """
+        changes = self.model_dump(exclude_unset=True)
+        for key, value in changes.items():
+            if value is None and key != "img_variants":
+                raise ValueError(f"{key}: must not be null")
+        if "img_path" in changes:
+            changes.setdefault("img_variants", image_variants(changes["img_path"]))
+        elif "img_variants" in changes:
+            raise ValueError("img_variants: can only be changed together with img_path")
+        paths = [path for path in [changes.get("img_path"), *(changes.get("img_variants") or {}).values()] if path is not None]
+        for path in paths:
+            if not _is_uploaded_image(path):
+                raise ValueError(f"Unknown image {path}")
+        if "img_path" in changes:
+            _check_variants(changes["img_path"], changes["img_variants"])
+        if not keep_images(paths):
+            raise ValueError(f"Unknown image {changes['img_path']}")
+        return changes
+
+
+def _is_uploaded_image(path: str) -> bool:
+    key = storage_key(path)
+    return key is not None and IMAGE_STORAGE.exists(key)
+
+
+def _check_variants(img_path: str, variants: dict[str, str] | None):
+    """Rejects images the collector would delete while the recipe refers to them: it keeps
+    the files of an image only as long as a recipe has the path of its full variant as
+    `img_path`, see `image_gc.owner_path`."""
+    if owner_path(storage_key(img_path)) != img_path:
+        raise ValueError(f"img_path: {img_path} is a variant, use the full image")
+    for name, path in (variants or {}).items():
+        if owner_path(storage_key(path)) != img_path:
+            raise ValueError(f"img_variants: {name} does not belong to {img_path}")
+
+
+def version_etag(recipe: Recipe) -> str:
+    """Returns the strong ETag of the JSON representation of a recipe, naming its version."""
+    return f'"{recipe.id}-{recipe.version}"'
+
+
+def parse_if_match(value: str, recipe_id: int) -> int | None:
+    """Reads the recipe version from an `If-Match` header.
+
+    Args:
+        value (str): The header value, an ETag returned by `version_etag`.
+        recipe_id (int): The ID of the recipe the request changes.
+
+    Returns:
+        int | None: The version, or None if the header does not name a version of the recipe.
+    """
+    # the ETag of a compressed response names the same version, see `compression.encoded_etag`
+    tag = decoded_etag(value.strip())
+    if not (tag.startswith('"') and tag.endswith('"')):
+        return None
+    tag_id, _, version = tag[1:-1].partition("-")
+    if tag_id != str(recipe_id) or not version.isdigit():
+        return None
+    return int(version)
+
+
+def parse_ids(value: str) -> list[int]:
+    """Parses a comma separated list of recipe IDs, dropping repeated IDs.
+
+    Args:
+        value (str): The IDs, e.g. "1,2,3".
+
+    Returns:
+        list[int]: The IDs in the given order.
+
+    Raises:
+        RequestRejected: If an ID is not a number or more than `BATCH_MAX_ITEMS` are given.
+    """
+    try:
+        ids = list(dict.fromkeys(int(part) for part in value.split(",") if part.strip()))
+    except ValueError as e:
+        raise RequestRejected(400, "IDs must be comma separated numbers") from e
+    if not ids:
+        raise RequestRejected(400, "No IDs given")
+    if len(ids) > BATCH_MAX_ITEMS:
+        raise RequestRejected(413, f"At most {BATCH_MAX_ITEMS} IDs per request")
+    return ids
+
+
+async def read_body(request: Request) -> bytes:
+    """Reads the request body, refusing it once it exceeds `BATCH_MAX_BYTES`.
+
+    Raises:
+        RequestRejected: If the body is too large.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > BATCH_MAX_BYTES:
+        raise RequestRejected(413, f"Request body exceeds {BATCH_MAX_BYTES} bytes")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > BATCH_MAX_BYTES:
+            raise RequestRejected(413, f"Request body exceeds {BATCH_MAX_BYTES} bytes")
+    return bytes(body)
+
+
+async def read_patch(request: Request) -> dict:
+    """Reads the changes of a PATCH request, see `RecipePatch`.
+
+    Args:
+        request (Request): The incoming HTTP request.
+
+    Returns:
+        dict: The changed columns and their new values.
+
+    Raises:
+        RequestRejected: If the body is too large, not valid JSON or an invalid change.
+    """
+    body = await read_body(request)
+    try:
+        return await run_in_threadpool(RecipePatch.model_validate_json(body).changes)
+    except ValidationError as e:
+        raise RequestRejected(422, _describe(e)) from e
+    except ValueError as e:
+        raise RequestRejected(422, str(e)) from e
+
+
+def _describe(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, detail['loc'])) or 'recipe'}: {detail['msg']}" for detail in error.errors())
+
+
+async def read_import(request: Request) -> list[RecipeImport | str]:
+    """Reads the recipes of a bulk import.
+
+    A body with the content type `application/x-ndjson` holds one recipe per line, any other
+    body a JSON array of recipes.
+
+    Args:
+        request (Request): The incoming HTTP request.
+
+    Returns:
+        list[RecipeImport | str]: The validated recipes in the order they were sent, or a
+            message for each entry that is invalid.
+
+    Raises:
+        RequestRejected: If the body is too large, not valid JSON or holds too many recipes.
+    """
+    body = await read_body(request)
+    entries = []
+    if request.headers.get("content-type", "").split(";")[0].strip() == "application/x-ndjson":
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                entries.append(_INVALID_LINE)
+    else:
+        try:
+            entries = json.loads(body)
+        except ValueError as e:
+            raise RequestRejected(400, "Body is not valid JSON") from e
+        if not isinstance(entries, list):
+            raise RequestRejected(400, "Expected a JSON array of recipes")
+    if not entries:
+        raise RequestRejected(400, "No recipes given")
+    if len(entries) > BATCH_MAX_ITEMS:
+        raise RequestRejected(413, f"At most {BATCH_MAX_ITEMS} recipes per request")
+    recipes = []
+    for entry in entries:
+        if entry is _INVALID_LINE:
+            recipes.append("Line is not valid JSON")
+            continue
+        try:
+            recipes.append(RecipeImport.model_validate(entry))
+        except ValidationError as e:
+            recipes.append(_describe(e))
+    return recipes
+
+
+def to_recipes(entries: list[RecipeImport | str], author: str, author_id: int) -> tuple[list[dict], list[Recipe]]:
+    """Creates the recipes of a bulk import. Blocks on the image storage, call it on a worker thread.
+
+    Args:
+        entries (list[RecipeImport | str]): The entries returned by `read_import`.
+        author (str): The name of the importing user.
+        author_id (int): The ID of the importing user.
+
+    Returns:
+        tuple[list[dict], list[Recipe]]: One result per entry, with status 201 or status 422 and
+            the reason the entry was refused, and the recipes to insert.
+    """
+    results = []
+    recipes = []
+    for index, entry in enumerate(entries):
+        try:
+            if isinstance(entry, str):
+                raise ValueError(entry)
+            recipes.append(entry.to_recipe(author, author_id))
+            results.append({"index": index, "status": 201})
+        except ValueError as e:
+            results.append({"index": index, "status": 422, "error": str(e)})
+    return results, recipes
@@ -0,0 +1,139 @@
+"""
+This module sets up the Jinja environment and streams rendered pages.
+
+Compiled templates are kept in a `FileSystemBytecodeCache` in `TEMPLATE_CACHE_DIR`, so a new
+worker loads them instead of compiling them again, and all templates are compiled during the
+warm-up. Templates are not checked for changes unless `TEMPLATE_AUTO_RELOAD` is set.
+
+With `TEMPLATE_STREAMING`, `StreamingTemplates` renders pages with an async overlay of the
+environment and sends the HTML in chunks of `STREAM_CHUNK_SIZE` characters as it is rendered,
+so the browser can load the stylesheet while the rest of a long page is still being rendered.
+"""
+import os
+import time
+from typing import AsyncIterator, Callable
+
+from jinja2 import BytecodeCache, Environment, FileSystemBytecodeCache, FileSystemLoader
+from starlette.responses import HTMLResponse, Response, StreamingResponse
+from fastapi.templating import Jinja2Templates
+
+from compression import MINIFY_HTML, MinifyingLoader
+from metrics import TEMPLATE_RENDER, TimedTemplate
+
+TEMPLATE_DIR = "templates"
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "data/templates")
+TEMPLATE_AUTO_RELOAD = os.environ.get("TEMPLATE_AUTO_RELOAD", "false").lower() in ("1", "true", "yes")
+TEMPLATE_STREAMING = os.environ.get("TEMPLATE_STREAMING", "true").lower() in ("1", "true", "yes")
+STREAM_CHUNK_SIZE = 4096
+
+
+def _bytecode_cache(mode: str) -> BytecodeCache | None:
+    """Returns the bytecode cache of an environment. The sync and the async environment
+    compile a template differently, so each gets its own files."""
+    if not TEMPLATE_CACHE_DIR:
+        return None
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR, pattern=f"__jinja2_%s.{mode}.cache")
+
+
+def create_templates(directory: str = TEMPLATE_DIR) -> Jinja2Templates:
+    """Creates the templates of the routes, minified if `MINIFY_HTML` is set and timed for the metrics.
+
+    Args:
+        directory (str): The template directory.
+
+    Returns:
+        Jinja2Templates: The templates.
+    """
+    loader = MinifyingLoader(directory) if MINIFY_HTML else FileSystemLoader(directory)
+    env = Environment(loader=loader, autoescape=True, auto_reload=TEMPLATE_AUTO_RELOAD,
+                      bytecode_cache=_bytecode_cache("sync"))
+    env.template_class = TimedTemplate
+    return Jinja2Templates(env=env)
+
+
+class StreamingTemplates():
+    """
+    Streams pages rendered by an async overlay of the environment of `templates`, which shares
+    its loader, filters and globals. Without `TEMPLATE_STREAMING` pages are rendered as a whole.
+    """
+    def __init__(self, templates: Jinja2Templates, enabled: bool = TEMPLATE_STREAMING,
+                 chunk_size: int = STREAM_CHUNK_SIZE):
+        self.templates = templates
+        self.enabled = enabled
+        self.chunk_size = chunk_size
+        self.env: Environment = templates.env.overlay(enable_async=True, bytecode_cache=_bytecode_cache("async"))
+
+    def precompile(self) -> int:
+        """Loads every template into the environments, compiling those not in the bytecode cache.
+
+        Returns:
+            int: The number of templates.
+        """
+        names = self.templates.env.list_templates()
+        for name in names:
+            self.templates.env.get_template(name)
+            if self.enabled:
+                self.env.get_template(name)
+        return len(names)
+
+    def response(self, template_name: str, context: dict, status_code: int = 200, headers: dict | None = None,
+                 on_complete: Callable[[str], None] | None = None) -> Response:
+        """Returns the response rendering a page.
+
+        Args:
+            template_name (str): The name of the template.
+            context (dict): The template variables, including `request`.
+            status_code (int): The status code of the response.
+            headers (dict | None): Additional response headers.
+            on_complete (Callable[[str], None] | None): Called with the whole HTML once the page
+                is rendered completely, e.g. to cache it. Not called if the client disconnects.
+
+        Returns:
+            Response: The streamed HTML, or the rendered HTML if streaming is disabled.
+        """
+        if not self.enabled:
+            html = self.templates.get_template(template_name).render(context)
+            if on_complete is not None:
+                on_complete(html)
+            return HTMLResponse(html, status_code=status_code, headers=headers)
+        return StreamingResponse(self._chunks(template_name, context, on_complete), status_code=status_code,
+                                 headers=headers, media_type="text/html")
+
+    async def _chunks(self, template_name: str, context: dict,
+                      on_complete: Callable[[str], None] | None) -> AsyncIterator[bytes]:
+        """Renders a template and yields the HTML in chunks of about `chunk_size` characters."""
+        template = self.env.get_template(template_name)
+        generator = template.generate_async(context)
+        parts = [] if on_complete is not None else None
+        buffer = []
+        size = 0
+        # only the time spent rendering, not the time waiting for the client
+        rendering = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    text = await generator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    rendering += time.perf_counter() - started
+                buffer.append(text)
+                size += len(text)
+                if size >= self.chunk_size:
+                    chunk = "".join(buffer)
+                    if parts is not None:
+                        parts.append(chunk)
+                    buffer = []
+                    size = 0
+                    yield chunk.encode()
+        finally:
+            await generator.aclose()
+        chunk = "".join(buffer)
+        if parts is not None:
+            parts.append(chunk)
+        TEMPLATE_RENDER.observe(rendering, template_name)
+        yield chunk.encode()
+        if on_complete is not None:
+            on_complete("".join(parts))
@@ -0,0 +1,164 @@
+"""
+This module measures how long a worker takes until it is ready to accept requests.
+
+`STARTUP` times the import of the app and the steps of the lifespan startup, and `ready` logs
+the time to ready once the lifespan startup is complete. `/api/stats` reports the same numbers.
+The clock starts when this module is imported, which `app.py` does first, so the time the
+interpreter and the server need to start is not included.
+
+With `STARTUP_PROFILE`, every module imported until the app is ready is timed as well, by
+wrapping `builtins.__import__`. The report lists the slowest modules and the import time of each
+package, counting only the time spent in the modules themselves, not in the modules they import.
+"""
+import builtins
+import importlib.util
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "false").lower() in ("1", "true", "yes")
+# modules and packages listed in the report
+REPORT_SIZE = 15
+
+_builtin_import = builtins.__import__
+
+logger = logging.getLogger(__name__)
+
+
+class ImportTimer():
+    """
+    Times the modules imported by the thread that installed it, with and without the time of
+    the modules they import in turn.
+    """
+    def __init__(self):
+        self.modules: dict[str, tuple[float, float]] = {}
+        self._stack: list[list] = []
+        self._original = None
+        self._hook = self._import
+        self._thread: int | None = None
+
+    def install(self):
+        """Starts timing the imports."""
+        if self._original is not None:
+            return
+        self._original = builtins.__import__
+        self._thread = threading.get_ident()
+        builtins.__import__ = self._hook
+
+    def uninstall(self):
+        """Stops timing the imports."""
+        if self._original is None:
+            return
+        if builtins.__import__ is self._hook:
+            builtins.__import__ = self._original
+        self._original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original or _builtin_import
+        if threading.get_ident() != self._thread:
+            return original(name, globals, locals, fromlist, level)
+        module = name
+        if level:
+            try:
+                module = importlib.util.resolve_name("." * level + name, (globals or {}).get("__package__"))
+            except (ImportError, ValueError):
+                return original(name, globals, locals, fromlist, level)
+        if module in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+        # the time spent in nested imports, subtracted from the time of this module
+        frame = [0.0]
+        self._stack.append(frame)
+        started = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][0] += elapsed
+            if module in sys.modules:
+                self.modules[module] = (elapsed, elapsed - frame[0])
+
+    def report(self, size: int = REPORT_SIZE) -> dict:
+        """Returns the slowest modules and packages.
+
+        Args:
+            size (int): The number of modules and of packages to list.
+
+        Returns:
+            dict: `modules` maps the modules with the highest own import time to their own and
+                cumulative time in milliseconds, `packages` the top level packages to the sum of
+                the own times of their modules.
+        """
+        packages: dict[str, float] = {}
+        for module, (_, own) in self.modules.items():
+            package = module.partition(".")[0]
+            packages[package] = packages.get(package, 0.0) + own
+        slowest = sorted(self.modules.items(), key=lambda item: item[1][1], reverse=True)[:size]
+        return {
+            "modules": {
+                module: {"self_ms": round(own * 1000, 1), "cumulative_ms": round(cumulative * 1000, 1)}
+                for module, (cumulative, own) in slowest
+            },
+            "packages": {
+                package: round(own * 1000, 1)
+                for package, own in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:size]
+            },
+        }
+
+
+class StartupProfiler():
+    """
+    Records the time the steps of the startup took and the time until the app was ready.
+    """
+    def __init__(self, profile_imports: bool = STARTUP_PROFILE):
+        self.started = time.perf_counter()
+        self.steps: dict[str, float] = {}
+        self.ready_seconds: float | None = None
+        self.imports = ImportTimer() if profile_imports else None
+        self._last = self.started
+        if self.imports is not None:
+            self.imports.install()
+
+    def lap(self, name: str):
+        """Records the time since the end of the previous step as step `name`."""
+        now = time.perf_counter()
+        self.steps[name] = self.steps.get(name, 0.0) + now - self._last
+        self._last = now
+
+    @contextmanager
+    def step(self, name: str):
+        """Records the time the body of the `with` statement takes as step `name`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._last = time.perf_counter()
+            self.steps[name] = self.steps.get(name, 0.0) + self._last - started
+
+    def ready(self):
+        """Marks the app as ready, stops timing imports and logs the report. Only the first
+        call counts, e.g. if the lifespan of several app instances is run in one process."""
+        if self.ready_seconds is not None:
+            return
+        self.ready_seconds = time.perf_counter() - self.started
+        if self.imports is not None:
+            self.imports.uninstall()
+        logger.info("Ready in %.0f ms", self.ready_seconds * 1000, extra=self.stats())
+
+    def stats(self) -> dict:
+        """Returns the time to ready and the time of each step in milliseconds, and the import
+        report with `STARTUP_PROFILE`."""
+        stats = {
+            "ready_ms": None if self.ready_seconds is None else round(self.ready_seconds * 1000, 1),
+            "steps_ms": {name: round(seconds * 1000, 1) for name, seconds in self.steps.items()},
+        }
+        if self.imports is not None:
+            stats["imports"] = self.imports.report()
+        return stats
+
+
+STARTUP = StartupProfiler()
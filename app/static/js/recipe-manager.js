@@ -22,3 +22,30 @@ async function deleteRecipe(recipeId) {
     }
 }
 
+
+async function loadMoreRecipes(sentinel, observer) {
+    observer.unobserve(sentinel);
+    const cursor = encodeURIComponent(sentinel.dataset.nextCursor);
+    const response = await fetch(`/api/recipes/feed?cursor=${cursor}`);
+    if (!response.ok) {
+        return;
+    }
+    document.getElementById('recipe-feed').insertAdjacentHTML('beforeend', await response.text());
+    const nextCursor = response.headers.get('X-Next-Cursor');
+    if (nextCursor) {
+        sentinel.dataset.nextCursor = nextCursor;
+        observer.observe(sentinel);
+    } else {
+        sentinel.remove();
+    }
+}
+
+const feedSentinel = document.getElementById('feed-sentinel');
+if (feedSentinel) {
+    const feedObserver = new IntersectionObserver((entries, observer) => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadMoreRecipes(feedSentinel, observer);
+        }
+    }, {rootMargin: '200px'});
+    feedObserver.observe(feedSentinel);
+}
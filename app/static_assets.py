@@ -0,0 +1,208 @@
+"""
+This module fingerprints the static files and serves them with long-lived cache headers.
+
+At startup `AssetManifest.build` hashes every file in the static directory except the uploaded
+recipe images, and precompresses the text files with gzip and, if the optional `brotli`
+package is installed, brotli. Templates link static files through the `static_url` global,
+which returns the fingerprinted URL, e.g. `/static/style.3f2a9c1e.css`. Because that URL
+changes with the content, `StaticAssets` serves it as immutable. Recipe images are served from
+the image storage by the `/images` route instead, see `image_storage`; their former URLs below
+`/static/recipe_images` redirect there.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from urllib.parse import quote
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, RedirectResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+from compression import accepted_encodings
+from image_storage import legacy_image_key
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_CACHE_DIR = os.environ.get("ASSET_CACHE_DIR", "data/assets")
+IMMUTABLE = "public, max-age=31536000, immutable"
+# directory below the static directory that holds the local image storage, neither fingerprinted nor served
+IMAGE_DIR = "recipe_images"
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS_SIZE = 256
+
+
+class Asset():
+    """
+    A fingerprinted static file.
+
+    Attributes:
+        path (str): The path of the original file.
+        url_path (str): The fingerprinted path relative to the static directory.
+        media_type (str): The media type of the file.
+        stat_result (os.stat_result): The stat result of the original file.
+        encodings (dict[str, tuple[str, os.stat_result]]): Precompressed variants, maps the
+            content coding ("br", "gzip") to the path and stat result of the compressed file.
+    """
+    def __init__(self, path: str, url_path: str, media_type: str, stat_result: os.stat_result,
+                 encodings: dict[str, tuple[str, os.stat_result]]):
+        self.path = path
+        self.url_path = url_path
+        self.media_type = media_type
+        self.stat_result = stat_result
+        self.encodings = encodings
+
+    def negotiate(self, accept_encoding: str) -> tuple[str | None, str, os.stat_result]:
+        """Picks the smallest variant the client accepts.
+
+        Args:
+            accept_encoding (str): The value of the client's `Accept-Encoding` header.
+
+        Returns:
+            tuple[str | None, str, os.stat_result]: The content coding (None for the original
+                file), the path and the stat result of the file to send.
+        """
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.encodings and (coding in accepted or "*" in accepted):
+                return coding, *self.encodings[coding]
+        return None, self.path, self.stat_result
+
+
+def _compress(source: bytes, target: str, coding: str) -> tuple[str, os.stat_result] | None:
+    """Writes a compressed copy of `source` to `target` unless it exists already.
+
+    Returns:
+        tuple[str, os.stat_result] | None: The path and stat result of the compressed file, or
+            None if compressing does not make the file smaller.
+    """
+    if not os.path.exists(target):
+        data = brotli.compress(source) if coding == "br" else gzip.compress(source, compresslevel=9, mtime=0)
+        if len(data) >= len(source):
+            return None
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        temporary = f"{target}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(data)
+        os.replace(temporary, target)
+    return target, os.stat(target)
+
+
+class AssetManifest():
+    """
+    Maps static files to their fingerprinted URLs.
+
+    Attributes:
+        directory (str): The static directory.
+        url_prefix (str): The URL path the static directory is mounted at.
+        version (str): A hash over all fingerprints, changes whenever any asset changes.
+    """
+    def __init__(self, directory: str = "static", url_prefix: str = "/static"):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.version = ""
+        self._assets: dict[str, Asset] = {}
+        self._fingerprinted: dict[str, Asset] = {}
+
+    def build(self):
+        """Fingerprints and precompresses all static files. Compressed files are reused across
+        restarts, as their names contain the fingerprint."""
+        assets = {}
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                dirs[:] = [name for name in dirs if name != IMAGE_DIR]
+            for name in files:
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                assets[relative] = self._fingerprint(path, relative)
+        self._assets = assets
+        self._fingerprinted = {asset.url_path: asset for asset in assets.values()}
+        self.version = hashlib.sha256(" ".join(sorted(self._fingerprinted)).encode()).hexdigest()[:8]
+
+    def _fingerprint(self, path: str, relative: str) -> Asset:
+        """Hashes one file and creates its compressed variants."""
+        with open(path, "rb") as file:
+            content = file.read()
+        digest = hashlib.sha256(content).hexdigest()[:10]
+        stem, suffix = os.path.splitext(relative)
+        url_path = f"{stem}.{digest}{suffix}"
+        media_type = mimetypes.guess_type(relative)[0] or "application/octet-stream"
+        encodings = {}
+        if media_type.startswith(COMPRESSIBLE_TYPES) and len(content) >= MIN_COMPRESS_SIZE:
+            codings = {"gzip": ".gz"} if brotli is None else {"br": ".br", "gzip": ".gz"}
+            for coding, extension in codings.items():
+                variant = _compress(content, os.path.join(ASSET_CACHE_DIR, url_path + extension), coding)
+                if variant is not None:
+                    encodings[coding] = variant
+        return Asset(path, url_path, media_type, os.stat(path), encodings)
+
+    def url(self, path: str) -> str:
+        """Returns the URL of a static file, fingerprinted if the file is known.
+
+        Args:
+            path (str): The path relative to the static directory, e.g. "icons/upload.svg".
+
+        Returns:
+            str: The absolute URL path of the file.
+        """
+        path = path.lstrip("/")
+        asset = self._assets.get(path)
+        return f"{self.url_prefix}/{asset.url_path if asset else path}"
+
+    def resolve(self, url_path: str) -> Asset | None:
+        """Returns the asset served under a fingerprinted path, or None if there is none."""
+        return self._fingerprinted.get(url_path.replace(os.sep, "/"))
+
+    def stats(self) -> dict:
+        """Returns the number of assets and their precompressed variants."""
+        return {
+            "version": self.version,
+            "assets": len(self._assets),
+            "precompressed": {
+                coding: sum(coding in asset.encodings for asset in self._assets.values()) for coding in ("br", "gzip")
+            },
+        }
+
+
+class StaticAssets(StaticFiles):
+    """
+    Serves the static directory, answering fingerprinted URLs from the manifest.
+
+    Fingerprinted files are sent with an immutable `Cache-Control` header in the best
+    precompressed variant the client accepts. Former recipe image URLs are redirected to the
+    `/images` route. All other paths are served like `StaticFiles` does.
+    """
+    def __init__(self, manifest: AssetManifest, **kwargs):
+        super().__init__(directory=manifest.directory, **kwargs)
+        self.manifest = manifest
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        parts = path.replace(os.sep, "/").split("/")
+        if parts[0] == IMAGE_DIR:
+            if len(parts) < 2 or not parts[-1]:
+                return Response(status_code=404)
+            return RedirectResponse(f"/images/{quote(legacy_image_key('/'.join(parts[1:])))}", status_code=301)
+        asset = self.manifest.resolve(path) if scope["method"] in ("GET", "HEAD") else None
+        if asset is None:
+            return await super().get_response(path, scope)
+        request_headers = Headers(scope=scope)
+        coding, file_path, stat_result = asset.negotiate(request_headers.get("accept-encoding", ""))
+        headers = {"Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"}
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        response = FileResponse(file_path, stat_result=stat_result, media_type=asset.media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+ASSETS = AssetManifest()
+
+
+def static_url(path: str) -> str:
+    """Jinja global returning the fingerprinted URL of a static file. See `AssetManifest.url`."""
+    return ASSETS.url(path)
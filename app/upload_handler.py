@@ -0,0 +1,264 @@
+"""
+This module parses recipe forms directly from the request stream.
+
+Form fields and part headers are collected in memory up to `MAX_FORM_SIZE` bytes for the whole
+request, each header up to `MAX_HEADER_SIZE` bytes. The image is written straight to
+the incoming directory of the image pipeline while it arrives; its format is sniffed from the
+first bytes and the upload is aborted as soon as it is not an image or exceeds
+`MAX_UPLOAD_SIZE`, so memory use per upload stays bounded however large the sent file is.
+"""
+import hashlib
+import os
+import uuid
+
+from fastapi import Request
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", str(10 * 1024 * 1024)))
+MAX_FORM_SIZE = int(os.environ.get("MAX_FORM_SIZE", str(256 * 1024)))
+MAX_HEADER_SIZE = 1024
+MAX_FIELDS = 200
+INCOMING_DIR = "static/recipe_images/incoming"
+
+# leading bytes -> image format, WebP is checked separately because of its RIFF header
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "jpeg",
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"GIF87a": "gif",
+    b"GIF89a": "gif",
+}
+SNIFF_SIZE = 12
+
+
+class UploadRejected(Exception):
+    """Raised when a form upload is refused.
+
+    Attributes:
+        status_code (int): The HTTP status code to answer with.
+        message (str): A message that can be shown to the user.
+    """
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class StoredUpload():
+    """
+    An uploaded image that was written to the incoming directory.
+
+    Attributes:
+        filename (str): The file name sent by the client.
+        path (str): The path the upload was stored at.
+        size (int): The size of the upload in bytes.
+        image_format (str): The sniffed image format, e.g. "png".
+        sha256 (str): The hex SHA-256 digest of the file content.
+    """
+    def __init__(self, filename: str, path: str, size: int, image_format: str, sha256: str):
+        self.filename = filename
+        self.path = path
+        self.size = size
+        self.image_format = image_format
+        self.sha256 = sha256
+
+    def discard(self):
+        """Removes the stored file."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def sniff_image_format(head: bytes) -> str | None:
+    """Detects the image format from the first bytes of a file.
+
+    Args:
+        head (bytes): At least the first `SNIFF_SIZE` bytes of the file.
+
+    Returns:
+        str | None: The image format, or None if the bytes do not belong to a supported image.
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for signature, image_format in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return image_format
+    return None
+
+
+class RecipeFormParser():
+    """
+    Streams a multipart request, keeping text fields and storing the image field on disk.
+    """
+    def __init__(self, request: Request, file_field: str):
+        self.request = request
+        self.file_field = file_field
+        self.fields: dict[str, str] = {}
+        self.upload: StoredUpload | None = None
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._field_name = ""
+        self._filename: str | None = None
+        self._data = bytearray()
+        self._head = bytearray()
+        self._file = None
+        self._image_format: str | None = None
+        self._size = 0
+        self._hash = hashlib.sha256()
+        self._to_write: list[bytes] = []
+        # bytes of text fields and part headers kept in memory so far, see MAX_FORM_SIZE
+        self._form_size = 0
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._field_name = ""
+        self._filename = None
+        self._data = bytearray()
+        self._head = bytearray()
+        self._size = 0
+        self._hash = hashlib.sha256()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+        self._count(end - start, len(self._header_name))
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+        self._count(end - start, len(self._header_value))
+
+    def _count(self, size: int, header_size: int = 0):
+        """Adds bytes kept in memory to the size of the form and rejects forms that are too large."""
+        if header_size > MAX_HEADER_SIZE:
+            raise UploadRejected(413, "Form header too large")
+        self._form_size += size
+        if self._form_size > MAX_FORM_SIZE:
+            raise UploadRejected(413, f"Form fields exceed {MAX_FORM_SIZE // 1024}KB")
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadRejected(400, "Malformed form data")
+        self._field_name = options[b"name"].decode("utf-8", errors="replace")
+        if b"filename" in options:
+            self._filename = options[b"filename"].decode("utf-8", errors="replace")
+        elif len(self.fields) >= MAX_FIELDS:
+            raise UploadRejected(413, "Too many form fields")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        chunk = data[start:end]
+        if self._filename is None:
+            self._count(len(chunk))
+            self._data.extend(chunk)
+            return
+        if self._field_name != self.file_field or self.upload is not None:
+            return
+        self._size += len(chunk)
+        if self._size > MAX_UPLOAD_SIZE:
+            raise UploadRejected(413, f"Image exceeds {MAX_UPLOAD_SIZE // (1024 * 1024)}MB")
+        if self._file is None:
+            self._head.extend(chunk)
+            if len(self._head) < SNIFF_SIZE:
+                return
+            self._open_file()
+            chunk = bytes(self._head)
+        self._hash.update(chunk)
+        self._to_write.append(chunk)
+
+    def on_part_end(self):
+        if self._filename is None:
+            self.fields[self._field_name] = self._data.decode("utf-8", errors="replace")
+            return
+        if self._field_name != self.file_field or self.upload is not None:
+            return
+        if self._file is None and self._head:
+            # files smaller than SNIFF_SIZE
+            self._open_file()
+            self._hash.update(self._head)
+            self._to_write.append(bytes(self._head))
+        if self._file is not None:
+            self.upload = StoredUpload(self._filename, self._file.name, self._size, self._image_format,
+                                       self._hash.hexdigest())
+
+    def _open_file(self):
+        """Sniffs the buffered head of the upload and opens the file it is stored in."""
+        self._image_format = sniff_image_format(bytes(self._head))
+        if self._image_format is None:
+            raise UploadRejected(415, "Invalid image file")
+        os.makedirs(INCOMING_DIR, exist_ok=True)
+        self._file = open(os.path.join(INCOMING_DIR, str(uuid.uuid4())), "wb")
+
+    def _discard_file(self):
+        """Closes and removes a partially written upload."""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._file.name)
+            self._file = None
+            self.upload = None
+
+    async def parse(self) -> tuple[dict[str, str], StoredUpload | None]:
+        """Reads the request body.
+
+        Returns:
+            tuple[dict[str, str], StoredUpload | None]: The text fields and the stored image,
+                or None if no image was sent.
+
+        Raises:
+            UploadRejected: If the body is not valid multipart form data, too large or the
+                image is not a supported image format.
+        """
+        content_type, params = parse_options_header(self.request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UploadRejected(400, "Expected multipart form data")
+        content_length = self.request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + MAX_FORM_SIZE:
+            raise UploadRejected(413, f"Image exceeds {MAX_UPLOAD_SIZE // (1024 * 1024)}MB")
+        parser = MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+                # write on a thread so disk I/O does not block the event loop
+                for data in self._to_write:
+                    await run_in_threadpool(self._file.write, data)
+                self._to_write.clear()
+            parser.finalize()
+        except MultipartParseError as e:
+            self._discard_file()
+            raise UploadRejected(400, "Malformed form data") from e
+        except BaseException:
+            self._discard_file()
+            raise
+        if self._file is not None:
+            self._file.close()
+        return self.fields, self.upload
+
+
+async def parse_recipe_form(request: Request, file_field: str = "img_path") -> tuple[dict[str, str], StoredUpload | None]:
+    """Parses a recipe form from the request stream. See `RecipeFormParser`.
+
+    Args:
+        request (Request): The incoming HTTP request.
+        file_field (str): The name of the form field holding the image.
+
+    Returns:
+        tuple[dict[str, str], StoredUpload | None]: The text fields and the stored image, or None
+            if no image was sent.
+
+    Raises:
+        UploadRejected: If the upload is refused.
+    """
+    return await RecipeFormParser(request, file_field).parse()
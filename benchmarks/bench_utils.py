@@ -0,0 +1,96 @@
+"""
+Shared helpers for the benchmark scripts.
+
+The app resolves `static`, `templates` and `data` relative to the working directory, so the
+benchmarks run inside a throw-away directory that links the real assets and holds its own
+SQLite database.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+
+
+def prepare_workdir(copy_static: bool = False) -> Path:
+    """Creates a temporary working directory for the app and makes its modules importable.
+
+    Args:
+        copy_static (bool): Copy the static folder instead of linking it, for benchmarks that
+            upload images, so they are not written into the repository.
+
+    Returns:
+        Path: The working directory the benchmark is running in.
+    """
+    workdir = Path(tempfile.mkdtemp(prefix="recipe-bench-"))
+    for name in ("static", "templates"):
+        if name == "static" and copy_static:
+            shutil.copytree(APP_DIR / name, workdir / name)
+        else:
+            os.symlink(APP_DIR / name, workdir / name)
+    os.chdir(workdir)
+    if str(APP_DIR) not in sys.path:
+        sys.path.insert(0, str(APP_DIR))
+    return workdir
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    """Returns the given percentile of the samples using nearest-rank.
+
+    Args:
+        samples (list[float]): The measured values.
+        pct (float): The percentile between 0 and 100.
+
+    Returns:
+        float: The percentile value, 0.0 for an empty sample list.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def seed_user(username: str = "bench") -> int:
+    """Creates a user to send the benchmark requests as, the password is not used.
+
+    Args:
+        username (str): The name of the user.
+
+    Returns:
+        int: The id of the user, for the `user_id` claim of its access token.
+    """
+    import database_handler
+    from models import User
+
+    database_handler.create_user(User(username=username, password="!"))
+    return database_handler.get_user_id(username)
+
+
+def seed_recipes(amount: int, author: str = "bench", author_id: int = 1) -> None:
+    """Inserts `amount` public recipes written by `author` into the database.
+
+    Args:
+        amount (int): The number of recipes to create.
+        author (str): The username stored as author.
+        author_id (int): The user id stored as author id.
+    """
+    import database_handler
+    from models import Recipe
+
+    for i in range(amount):
+        database_handler.create_recipe(Recipe(
+            title=f"Recipe {i}",
+            portions=2,
+            prep_time=10,
+            cook_time=20,
+            img_path="static/forbidden.jpg",
+            tags=["bench", f"tag{i % 10}"],
+            ingredients=[{"name": "salt", "amount": "1g"}, {"name": "water", "amount": "1l"}],
+            text="<p>" + "Stir well. " * 50 + "</p>",
+            author=author,
+            author_id=author_id,
+            is_public=True,
+        ))
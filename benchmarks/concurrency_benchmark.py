@@ -0,0 +1,88 @@
+"""
+Measures request latency of `/api/recipe/get/{id}` for a growing number of parallel clients.
+
+Run from the repository root:
+
+    python benchmarks/concurrency_benchmark.py --clients 1 4 16 64 --query-delay 0.02
+
+`--query-delay` adds an artificial sleep to every SQL statement to simulate a slow database.
+`--blocking` runs the database calls directly on the event loop, which is how the handlers
+behaved before the async data-access layer, for comparison.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench_utils import percentile, prepare_workdir, seed_recipes, seed_user
+
+
+async def run_level(client, clients: int, waves: int, recipe_ids: list[int]) -> dict:
+    """Runs one load level and returns its latency statistics in milliseconds.
+
+    All clients of a wave send their request at the same moment and latency is measured from
+    that moment, so requests that queue behind a blocked event loop are accounted for.
+    """
+    latencies = []
+
+    async def fetch(recipe_id: int, wave_started: float):
+        response = await client.get(f"/api/recipe/get/{recipe_id}")
+        latencies.append((time.perf_counter() - wave_started) * 1000)
+        assert response.status_code == 200, response.text
+
+    started = time.perf_counter()
+    for wave in range(waves):
+        wave_started = time.perf_counter()
+        await asyncio.gather(*(
+            fetch(recipe_ids[(wave * clients + c) % len(recipe_ids)], wave_started) for c in range(clients)
+        ))
+    elapsed = time.perf_counter() - started
+    return {
+        "clients": clients,
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+    }
+
+
+async def main(args):
+    prepare_workdir()
+    import httpx
+    from sqlalchemy import event
+
+    import async_database_handler
+    import database_handler
+    from app import app
+    from auth_handler import create_access_token
+
+    async_database_handler.startup()
+    user_id = seed_user()
+    seed_recipes(args.recipes, author_id=user_id)
+    if args.query_delay:
+        @event.listens_for(database_handler.ENGINE, "before_cursor_execute")
+        def slow_query(*_):
+            time.sleep(args.query_delay)
+    if args.blocking:
+        async def run_inline(func, *f_args, **f_kwargs):
+            return func(*f_args, **f_kwargs)
+        async_database_handler._run = run_inline
+
+    cookies = {"access_token": create_access_token({"sub": "bench", "user_id": user_id})}
+    transport = httpx.ASGITransport(app=app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies=cookies) as client:
+        for clients in args.clients:
+            results.append(await run_level(client, clients, args.waves, list(range(1, args.recipes + 1))))
+    async_database_handler.shutdown()
+    print(json.dumps({"blocking": args.blocking, "query_delay": args.query_delay, "levels": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--waves", type=int, default=20, help="simultaneous request waves per level")
+    parser.add_argument("--recipes", type=int, default=50)
+    parser.add_argument("--query-delay", type=float, default=0.0, help="seconds added to every SQL statement")
+    parser.add_argument("--blocking", action="store_true", help="call the database on the event loop")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,85 @@
+"""
+Measures `/api/recipe/get-partial/{id}` with the fragment cache disabled, enabled and when the
+client revalidates its copy with `If-None-Match`.
+
+Besides the end-to-end latency, the time spent in `fragment_cache.render_recipe` is reported,
+which is the part of the request the cache saves.
+
+Run from the repository root:
+
+    python benchmarks/fragment_cache_benchmark.py --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench_utils import percentile, prepare_workdir, seed_recipes, seed_user
+
+
+async def run_case(client, recipe_ids: list[int], requests: int, revalidate: bool, render_times: list[float]) -> dict:
+    """Requests the partials of `recipe_ids` round-robin and returns latency statistics in ms."""
+    etags = {}
+    for recipe_id in recipe_ids:
+        etags[recipe_id] = (await client.get(f"/api/recipe/get-partial/{recipe_id}")).headers["etag"]
+    latencies = []
+    render_times.clear()
+    started = time.perf_counter()
+    for i in range(requests):
+        recipe_id = recipe_ids[i % len(recipe_ids)]
+        headers = {"If-None-Match": etags[recipe_id]} if revalidate else {}
+        request_started = time.perf_counter()
+        response = await client.get(f"/api/recipe/get-partial/{recipe_id}", headers=headers)
+        latencies.append((time.perf_counter() - request_started) * 1000)
+        assert response.status_code == (304 if revalidate else 200), response.status_code
+    elapsed = time.perf_counter() - started
+    return {
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "render_p50_us": round(percentile(render_times, 50) * 1e6, 1),
+    }
+
+
+async def main(args):
+    prepare_workdir()
+    import httpx
+
+    import app as app_module
+    import async_database_handler
+    import fragment_cache
+    from auth_handler import create_access_token
+    from cache import LRUCache
+
+    app_module.limiter.enabled = False
+    render_times = []
+
+    def timed_render_recipe(*render_args, **render_kwargs):
+        render_started = time.perf_counter()
+        response = fragment_cache.render_recipe(*render_args, **render_kwargs)
+        render_times.append(time.perf_counter() - render_started)
+        return response
+
+    app_module.render_recipe = timed_render_recipe
+    async_database_handler.startup()
+    user_id = seed_user()
+    seed_recipes(args.recipes, author_id=user_id)
+    recipe_ids = list(range(1, args.recipes + 1))
+    cookies = {"access_token": create_access_token({"sub": "bench", "user_id": user_id})}
+    transport = httpx.ASGITransport(app=app_module.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies=cookies) as client:
+        fragment_cache.set_fragment_cache(LRUCache(maxsize=0))
+        results["render"] = await run_case(client, recipe_ids, args.requests, revalidate=False, render_times=render_times)
+        fragment_cache.set_fragment_cache(LRUCache(maxsize=args.recipes))
+        results["cached"] = await run_case(client, recipe_ids, args.requests, revalidate=False, render_times=render_times)
+        results["not_modified"] = await run_case(client, recipe_ids, args.requests, revalidate=True, render_times=render_times)
+    async_database_handler.shutdown()
+    print(json.dumps({"recipes": args.recipes, "requests": args.requests, "cases": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipes", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,301 @@
+"""
+Load test of the hot endpoints against a seeded SQLite database, with regression check.
+
+The database is filled with `--users` users and `--recipes` recipes with random ingredients,
+tags and texts, whose images are rendered by the image pipeline from `--images` generated
+photos. The seed is fixed, so two runs with the same arguments use the same data.
+
+Every endpoint is then loaded by `--clients` concurrent clients for `--duration` seconds, each
+client being logged in as another user:
+
+    GET  /                              home feed
+    POST /login                         password verification
+    GET  /api/recipe/get/{id}
+    GET  /api/recipe/get-partial/{id}
+    POST /recipe/add                    multipart form with an image
+    POST /recipe/edit/{id}              multipart form, keeping the image
+
+The requests go through the whole app in-process, rate limits disabled, so the numbers are
+comparable between runs on the same machine but not between machines. The result is printed
+as JSON and written to `--output`. With `--baseline` the throughput and the p95 latency of
+every endpoint are compared to a previous result, and the script exits with status 1 if one of
+them got worse by more than `--threshold` percent.
+
+Run from the repository root:
+
+    python benchmarks/load_benchmark.py --output before.json
+    python benchmarks/load_benchmark.py --baseline before.json --threshold 15
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+
+from bench_utils import percentile, prepare_workdir
+
+PASSWORD = "bench-password"
+ENDPOINTS = ["home", "login", "get_recipe", "get_partial", "add_recipe", "edit_recipe"]
+INGREDIENTS = [
+    "flour", "sugar", "salt", "butter", "milk", "eggs", "olive oil", "garlic", "onion", "tomatoes",
+    "basil", "parsley", "rice", "pasta", "potatoes", "carrots", "chicken breast", "beef", "lentils",
+    "chickpeas", "lemon", "honey", "yeast", "cream", "parmesan", "pepper", "paprika", "cumin",
+]
+AMOUNTS = ["1 tsp", "2 tbsp", "100 g", "250 g", "500 g", "1", "2", "3 cloves", "200 ml", "1 l", "a pinch"]
+TAGS = [
+    "vegan", "vegetarian", "quick", "dessert", "breakfast", "dinner", "soup", "salad", "baking",
+    "italian", "indian", "mexican", "gluten-free", "low-carb", "spicy", "summer", "winter",
+]
+WORDS = ["stir", "the", "mixture", "until", "golden", "add", "slowly", "and", "season", "to", "taste",
+         "simmer", "for", "minutes", "then", "serve", "warm", "with", "fresh", "herbs"]
+
+
+def make_image(rng: random.Random, size: tuple[int, int] = (1200, 900)) -> bytes:
+    """Generates a JPEG photo stand-in of gradients and noise, which compresses like a photo."""
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize(size).rotate(rng.randrange(360))
+    noise = Image.effect_noise(size, rng.uniform(20, 60))
+    tint = Image.new("L", size, rng.randrange(256))
+    image = Image.merge("RGB", (gradient, noise, tint))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_recipe_fields(rng: random.Random, number: int) -> dict:
+    """Returns the title, text, ingredients, tags and times of a random recipe."""
+    ingredients = [{"name": name, "amount": rng.choice(AMOUNTS)} for name in rng.sample(INGREDIENTS, rng.randint(3, 12))]
+    paragraphs = ["<p>" + " ".join(rng.choices(WORDS, k=rng.randint(20, 60))).capitalize() + ".</p>" for _ in range(rng.randint(2, 6))]
+    return {
+        "title": f"{ingredients[0]['name'].capitalize()} with {ingredients[1]['name']} {number}",
+        "text": "".join(paragraphs),
+        "ingredients": ingredients,
+        "tags": rng.sample(TAGS, rng.randint(1, 4)),
+        "portions": rng.randint(1, 8),
+        "prep_time": rng.randint(5, 60),
+        "cook_time": rng.randint(0, 120),
+    }
+
+
+def recipe_form(fields: dict) -> dict:
+    """Turns recipe fields into the form sent by the recipe editor."""
+    form = {"title": fields["title"], "description": fields["text"], "portions": fields["portions"],
+            "prep_time": fields["prep_time"], "cook_time": fields["cook_time"], "is_public": "public"}
+    for i, ingredient in enumerate(fields["ingredients"]):
+        form[f"ingredientName[{i}]"] = ingredient["name"]
+        form[f"ingredientAmount[{i}]"] = ingredient["amount"]
+    for i, tag in enumerate(fields["tags"]):
+        form[f"tags[{i}]"] = tag
+    return form
+
+
+def seed(args, rng: random.Random) -> dict:
+    """Fills the database and returns the users, the recipe ids per user and unseeded images."""
+    import database_handler
+    from image_pipeline import IMAGE_VARIANTS, render_variants
+    from image_storage import image_path
+    from upload_handler import INCOMING_DIR
+    from models import Recipe, User
+    from password_validator import Hasher
+
+    password_hash = Hasher.get_password_hash(PASSWORD)
+    users = []
+    for i in range(args.users):
+        database_handler.create_user(User(username=f"bench{i}", password=password_hash))
+        users.append((f"bench{i}", database_handler.get_user_id(f"bench{i}")))
+
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    images = []
+    for _ in range(args.images):
+        data = make_image(rng)
+        name = hashlib.sha256(data).hexdigest()[:32]
+        keys = {variant: f"{name}-{variant}.webp" for variant in IMAGE_VARIANTS}
+        source = os.path.join(INCOMING_DIR, f"{name}.jpg")
+        with open(source, "wb") as file:
+            file.write(data)
+        render_variants(source, keys)
+        images.append({variant: image_path(key) for variant, key in keys.items()})
+
+    recipes = {username: [] for username, _ in users}
+    for i in range(args.recipes):
+        username, user_id = users[i % len(users)]
+        fields = make_recipe_fields(rng, i)
+        variants = rng.choice(images)
+        recipe = Recipe(img_path=variants["full"], img_variants=variants, author=username, author_id=user_id,
+                        is_public=rng.random() < 0.8, **fields)
+        database_handler.create_recipe(recipe)
+        recipes[username].append(i + 1)
+    # images the database does not know yet, so the first uploads of each are processed
+    uploads = [make_image(rng) for _ in range(args.images)]
+    return {"users": users, "recipes": recipes, "uploads": uploads}
+
+
+def make_request(endpoint: str, data: dict, rng: random.Random, client_number: int, request_number: int) -> dict:
+    """Returns the method, url and body of the next request a client sends to an endpoint."""
+    username, _ = data["users"][client_number % len(data["users"])]
+    if endpoint == "home":
+        return {"method": "GET", "url": "/"}
+    if endpoint == "login":
+        return {"method": "POST", "url": "/login", "data": {"username": username, "password": PASSWORD}}
+    if endpoint in ("get_recipe", "get_partial"):
+        # only the clients' own recipes, the others may be private
+        recipe_id = rng.choice(data["recipes"][username])
+        prefix = "/api/recipe/get/" if endpoint == "get_recipe" else "/api/recipe/get-partial/"
+        return {"method": "GET", "url": f"{prefix}{recipe_id}"}
+    form = recipe_form(make_recipe_fields(rng, request_number))
+    if endpoint == "add_recipe":
+        image = data["uploads"][request_number % len(data["uploads"])]
+        return {"method": "POST", "url": "/recipe/add", "data": form,
+                "files": {"img_path": ("photo.jpg", image, "image/jpeg")}}
+    recipe_id = rng.choice(data["recipes"][username])
+    return {"method": "POST", "url": f"/recipe/edit/{recipe_id}", "data": form,
+            "files": {"img_path": ("", b"", "application/octet-stream")}}
+
+
+async def run_endpoint(app, endpoint: str, data: dict, tokens: list[str], args, seed_value: int) -> dict:
+    """Loads one endpoint with the concurrent clients and returns its statistics."""
+    import httpx
+
+    latencies = []
+    errors = {}
+    counter = iter(range(sys.maxsize))
+
+    async def client_loop(client_number: int, deadline: float):
+        rng = random.Random(seed_value * 1000 + client_number)
+        cookies = {"access_token": tokens[client_number % len(tokens)]}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies=cookies) as client:
+            while time.perf_counter() < deadline:
+                request = make_request(endpoint, data, rng, client_number, next(counter))
+                started = time.perf_counter()
+                response = await client.request(**request)
+                elapsed = (time.perf_counter() - started) * 1000
+                if response.status_code >= 400 or response.headers.get("location", "").endswith("/forbidden"):
+                    errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+                else:
+                    latencies.append(elapsed)
+
+    if args.warmup:
+        deadline = time.perf_counter() + args.warmup
+        await asyncio.gather(*(client_loop(number, deadline) for number in range(args.clients)))
+        latencies.clear()
+        errors.clear()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(client_loop(number, deadline) for number in range(args.clients)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+    }
+
+
+def compare(result: dict, baseline: dict, threshold: float) -> dict:
+    """Compares the endpoints of two results.
+
+    Args:
+        result (dict): The result of this run.
+        baseline (dict): A previous result.
+        threshold (float): Allowed loss of throughput and growth of the p95 latency in percent.
+
+    Returns:
+        dict: The relative changes per endpoint and whether they exceed the threshold.
+    """
+    comparison = {}
+    for endpoint, current in result["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if not previous or not previous["throughput_rps"] or not previous["p95_ms"]:
+            continue
+        throughput_change = (current["throughput_rps"] / previous["throughput_rps"] - 1) * 100
+        p95_change = (current["p95_ms"] / previous["p95_ms"] - 1) * 100
+        comparison[endpoint] = {
+            "throughput_change_pct": round(throughput_change, 1),
+            "p95_change_pct": round(p95_change, 1),
+            "regression": throughput_change < -threshold or p95_change > threshold or bool(current["errors"]),
+        }
+    return comparison
+
+
+async def main(args) -> int:
+    prepare_workdir(copy_static=True)
+    # the app logs every request of the in-process clients otherwise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    import app as app_module
+    import database_handler
+    from auth_handler import create_access_token
+
+    app_module.limiter.enabled = False
+    rng = random.Random(args.seed)
+    database_handler.startup()
+    seed_started = time.perf_counter()
+    data = seed(args, rng)
+    seed_seconds = time.perf_counter() - seed_started
+    database_handler.ENGINE.dispose()
+    tokens = [create_access_token({"sub": username, "user_id": user_id}) for username, user_id in data["users"]]
+
+    endpoints = {}
+    async with app_module.lifespan(app_module.app):
+        for number, endpoint in enumerate(args.endpoints):
+            endpoints[endpoint] = await run_endpoint(app_module.app, endpoint, data, tokens, args, args.seed + number)
+
+    result = {
+        "config": {
+            "users": args.users,
+            "recipes": args.recipes,
+            "images": args.images,
+            "clients": args.clients,
+            "duration": args.duration,
+            "seed": args.seed,
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+            "database_url": database_handler.DATABASE_URL,
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "endpoints": endpoints,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as file:
+            result["comparison"] = compare(result, json.load(file), args.threshold)
+        regressions = [endpoint for endpoint, change in result["comparison"].items() if change["regression"]]
+        if regressions:
+            print(f"Regression of more than {args.threshold}% in: {', '.join(regressions)}", file=sys.stderr)
+            status = 1
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--recipes", type=int, default=500)
+    parser.add_argument("--images", type=int, default=10, help="generated photos, each is shared by several recipes")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients per endpoint")
+    parser.add_argument("--duration", type=float, default=5, help="seconds each endpoint is loaded")
+    parser.add_argument("--warmup", type=float, default=1, help="seconds of unmeasured load before each endpoint")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the result to this file")
+    parser.add_argument("--baseline", help="result of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=20, help="allowed regression in percent")
+    arguments = parser.parse_args()
+    # absolute paths, the benchmark changes into its working directory
+    arguments.output = arguments.output and os.path.abspath(arguments.output)
+    arguments.baseline = arguments.baseline and os.path.abspath(arguments.baseline)
+    sys.exit(asyncio.run(main(arguments)))
@@ -0,0 +1,95 @@
+"""
+Compares the latency of feed pages at different depths for keyset and offset pagination.
+
+Run from the repository root:
+
+    python benchmarks/pagination_benchmark.py --rows 1000000
+"""
+import argparse
+import datetime
+import json
+import time
+
+from bench_utils import percentile, prepare_workdir
+
+
+def seed(rows: int, authors: int):
+    """Bulk inserts `rows` recipes, every fifth of them private."""
+    from sqlalchemy import insert
+
+    import database_handler
+    from models import Recipe
+
+    started = datetime.datetime(2020, 1, 1)
+    batch = []
+    with database_handler.ENGINE.begin() as connection:
+        for i in range(rows):
+            batch.append({
+                "title": f"Recipe {i}", "portions": 2, "prep_time": 10, "cook_time": 20,
+                "img_path": "static/forbidden.jpg", "tags": ["bench"], "ingredients": [],
+                "text": "<p>bench</p>", "author": f"user{i % authors}", "author_id": i % authors + 1,
+                "is_public": i % 5 != 0, "created": started + datetime.timedelta(seconds=i),
+            })
+            if len(batch) == 10000:
+                connection.execute(insert(Recipe), batch)
+                batch = []
+        if batch:
+            connection.execute(insert(Recipe), batch)
+
+
+def time_calls(func, repeat: int) -> dict:
+    """Calls `func` `repeat` times and returns latency percentiles in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": round(percentile(samples, 50), 3), "p99_ms": round(percentile(samples, 99), 3)}
+
+
+def main(args):
+    prepare_workdir()
+    from sqlalchemy import select
+    from sqlmodel import Session
+
+    import database_handler
+    from models import Recipe
+
+    database_handler.startup()
+    seed(args.rows, args.authors)
+    viewer = "user1"
+    results = []
+    for depth in args.depths:
+        offset = int(args.rows * depth)
+        with Session(database_handler.ENGINE) as session:
+            boundary = session.scalars(
+                select(Recipe).order_by(Recipe.created.desc(), Recipe.id.desc()).offset(offset).limit(1)
+            ).first()
+        cursor = database_handler.encode_cursor(boundary) if offset else None
+
+        def keyset():
+            database_handler.get_recipes(viewer, cursor, args.page_size)
+
+        def offset_page():
+            with Session(database_handler.ENGINE) as session:
+                session.scalars(
+                    select(Recipe).order_by(Recipe.created.desc(), Recipe.id.desc()).offset(offset).limit(args.page_size)
+                ).all()
+
+        results.append({
+            "depth": depth,
+            "offset": offset,
+            "keyset": time_calls(keyset, args.repeat),
+            "offset_limit": time_calls(offset_page, args.repeat),
+        })
+    print(json.dumps({"rows": args.rows, "page_size": args.page_size, "pages": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--authors", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--depths", type=float, nargs="+", default=[0, 0.1, 0.5, 0.9, 0.99])
+    main(parser.parse_args())
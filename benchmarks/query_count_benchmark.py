@@ -0,0 +1,61 @@
+"""
+Counts the SQL statements the database runs for the user-facing write requests.
+
+Every request is sent `--repeat` times through the app and the statements seen by the
+engine are counted per request, so both the first (cold cache) and the following calls show up.
+
+Run from the repository root:
+
+    python benchmarks/query_count_benchmark.py --repeat 3
+"""
+import argparse
+import io
+import json
+
+from bench_utils import prepare_workdir
+
+
+def main(args):
+    prepare_workdir(copy_static=True)
+    from fastapi.testclient import TestClient
+    from PIL import Image
+    from sqlalchemy import event
+
+    import app as app_module
+    import database_handler
+
+    app_module.limiter.enabled = False
+    image = io.BytesIO()
+    Image.new("RGB", (64, 64), "red").save(image, "PNG")
+    form = {"title": "Soup", "portions": 2, "prep_time": 5, "cook_time": 10, "description": "<p>Stir.</p>",
+            "is_public": "public", "ingredientName[0]": "salt", "ingredientAmount[0]": "1g", "tags[0]": "soup"}
+    statements = []
+
+    def count(client, method: str, url: str, **kwargs) -> int:
+        statements.clear()
+        response = client.request(method, url, follow_redirects=False, **kwargs)
+        assert response.status_code < 400, (url, response.status_code, response.text[:200])
+        return len(statements)
+
+    results = {"register": [], "login": [], "add_recipe": [], "edit_recipe": []}
+    with TestClient(app_module.app) as client:
+        event.listen(database_handler.ENGINE, "before_cursor_execute", lambda *_: statements.append(1))
+        for i in range(args.repeat):
+            credentials = {"username": f"bench{i}", "password": "secret"}
+            results["register"].append(count(client, "POST", "/register", data=dict(credentials, confirm_password="secret")))
+            results["login"].append(count(client, "POST", "/login", data=credentials))
+        client.cookies.set("access_token", client.post("/login", data={"username": "bench0", "password": "secret"},
+                                                       follow_redirects=False).cookies.get("access_token"))
+        for _ in range(args.repeat):
+            files = {"img_path": ("a.png", image.getvalue(), "image/png")}
+            results["add_recipe"].append(count(client, "POST", "/recipe/add", data=form, files=files))
+        for _ in range(args.repeat):
+            files = {"img_path": ("", b"", "application/octet-stream")}
+            results["edit_recipe"].append(count(client, "POST", "/recipe/edit/1", data=form, files=files))
+    print(json.dumps({"statements_per_request": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,88 @@
+"""
+Measures the overhead of the rate limiter per request for several limiter storages.
+
+Every storage runs in its own process, configured through `RATE_LIMIT_STORAGE_URL` like the
+app in production. The requests go to `/api/recipe/get-partial/{id}` (10/minute) from enough
+distinct client addresses that none of them is rejected. Besides the end-to-end latency the
+time spent in the limiter check is reported, as measured by `TimedLimiter`, and for batched
+storages the number of calls made to the shared storage.
+
+Run from the repository root:
+
+    python benchmarks/rate_limit_benchmark.py --requests 2000
+    python benchmarks/rate_limit_benchmark.py --storage-url redis://localhost:6379 batched+redis://localhost:6379
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bench_utils import percentile, prepare_workdir, seed_recipes
+
+REQUESTS_PER_CLIENT = 10
+
+
+async def run_case(args) -> dict:
+    """Sends the requests through the app configured by the environment and returns the statistics."""
+    prepare_workdir()
+    import httpx
+
+    import app as app_module
+    import async_database_handler
+    from auth_handler import create_access_token
+
+    async_database_handler.startup()
+    seed_recipes(1)
+    cookies = {"access_token": create_access_token({"sub": "bench", "user_id": 1})}
+    latencies = []
+    clients = -(-args.requests // REQUESTS_PER_CLIENT)
+    started = time.perf_counter()
+    for client_number in range(clients):
+        address = f"10.{client_number // 65536 % 256}.{client_number // 256 % 256}.{client_number % 256}"
+        transport = httpx.ASGITransport(app=app_module.app, client=(address, 4000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies=cookies) as client:
+            for _ in range(min(REQUESTS_PER_CLIENT, args.requests - client_number * REQUESTS_PER_CLIENT)):
+                request_started = time.perf_counter()
+                response = await client.get("/api/recipe/get-partial/1")
+                latencies.append((time.perf_counter() - request_started) * 1000)
+                assert response.status_code == 200, response.status_code
+    elapsed = time.perf_counter() - started
+    app_module.limiter.flush()
+    async_database_handler.shutdown()
+    return {
+        "throughput_rps": round(args.requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "limiter": app_module.limiter.stats(),
+    }
+
+
+def main(args):
+    cases = {}
+    for storage_url in ["disabled", *args.storage_url]:
+        env = dict(os.environ, RATE_LIMIT_STRATEGY=args.strategy)
+        if storage_url == "disabled":
+            env["RATE_LIMIT_ENABLED"] = "false"
+        else:
+            env["RATE_LIMIT_STORAGE_URL"] = storage_url
+        output = subprocess.run([sys.executable, __file__, "--case", "--requests", str(args.requests)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        # the app prints while starting, the result is the last line
+        cases[storage_url] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps({"requests": args.requests, "strategy": args.strategy, "cases": cases}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--strategy", default="sliding-window-counter")
+    parser.add_argument("--storage-url", nargs="+", default=["memory://", "batched+memory://"])
+    parser.add_argument("--case", action="store_true", help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+    if parsed.case:
+        print(json.dumps(asyncio.run(run_case(parsed))))
+    else:
+        main(parsed)
@@ -0,0 +1,82 @@
+"""
+Measures the latency of `database_handler.search_recipes` on a large recipe table.
+
+Run from the repository root:
+
+    python benchmarks/search_benchmark.py --rows 100000
+"""
+import argparse
+import datetime
+import json
+import random
+import time
+
+from bench_utils import percentile, prepare_workdir
+
+TAGS = ["vegan", "vegetarian", "quick", "dessert", "breakfast", "spicy", "soup", "pasta", "baking", "grill"]
+INGREDIENTS = ["salt", "pepper", "flour", "sugar", "butter", "egg", "milk", "tomato", "onion", "garlic",
+               "rice", "basil", "lemon", "chicken", "tofu", "cheese", "potato", "carrot", "honey", "chili"]
+WORDS = ["stir", "bake", "simmer", "chop", "whisk", "fold", "roast", "season", "serve", "garnish",
+         "creamy", "crispy", "golden", "tender", "fresh", "smoky", "zesty", "hearty", "light", "rich"]
+
+
+def seed(rows: int, seed_value: int = 42):
+    """Bulk inserts `rows` recipes with random tags, ingredients and text plus their index rows."""
+    from sqlalchemy import insert
+
+    import database_handler
+    from models import Recipe, RecipeIngredient, RecipeTag
+
+    rng = random.Random(seed_value)
+    started = datetime.datetime(2020, 1, 1)
+    with database_handler.ENGINE.begin() as connection:
+        for offset in range(0, rows, 5000):
+            recipes, tags, ingredients = [], [], []
+            for recipe_id in range(offset + 1, min(rows, offset + 5000) + 1):
+                recipe_tags = rng.sample(TAGS, 2)
+                recipe_ingredients = rng.sample(INGREDIENTS, 5)
+                recipes.append({
+                    "id": recipe_id, "title": " ".join(rng.sample(WORDS, 3)), "portions": 2, "prep_time": 10,
+                    "cook_time": 20, "img_path": "static/forbidden.jpg", "tags": recipe_tags,
+                    "ingredients": [{"name": name, "amount": "1"} for name in recipe_ingredients],
+                    "text": "<p>" + " ".join(rng.choices(WORDS, k=40)) + "</p>", "author": f"user{recipe_id % 100}",
+                    "author_id": recipe_id % 100 + 1, "is_public": recipe_id % 5 != 0,
+                    "created": started + datetime.timedelta(seconds=recipe_id),
+                })
+                tags.extend({"recipe_id": recipe_id, "tag": tag} for tag in recipe_tags)
+                ingredients.extend({"recipe_id": recipe_id, "name": name} for name in recipe_ingredients)
+            connection.execute(insert(Recipe), recipes)
+            connection.execute(insert(RecipeTag), tags)
+            connection.execute(insert(RecipeIngredient), ingredients)
+
+
+def main(args):
+    prepare_workdir()
+    import database_handler
+
+    database_handler.startup()
+    seed(args.rows)
+    cases = {
+        "tag": {"tags": ["vegan"]},
+        "tag_and_ingredient": {"tags": ["vegan"], "ingredients": ["tofu"]},
+        "two_ingredients": {"ingredients": ["honey", "chili"]},
+        "fulltext": {"query": "smoky garnish"},
+        "fulltext_and_tag": {"query": "crispy", "tags": ["dessert"]},
+        "rare_ingredient": {"ingredients": ["saffron"]},
+    }
+    results = {}
+    for name, criteria in cases.items():
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            database_handler.search_recipes("user1", **criteria)
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = {"p50_ms": round(percentile(samples, 50), 3), "p99_ms": round(percentile(samples, 99), 3)}
+    print(json.dumps({"rows": args.rows, "searches": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=30)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+"""
+Compares mixed read/write throughput of the SQLite engine profiles.
+
+Every profile gets a fresh database. Worker threads then run a mix of recipe reads and
+writes through `database_handler` for a fixed duration, with the recipe cache disabled.
+
+Run from the repository root:
+
+    python benchmarks/sqlite_profile_benchmark.py --threads 8 --write-ratio 0.2
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from bench_utils import percentile, prepare_workdir, seed_recipes
+
+
+def run_profile(profile: str, args) -> dict:
+    """Runs the workload against a fresh database using `profile`."""
+    from cache import LRUCache
+    import database_handler
+    from models import Recipe
+
+    database_handler.DATABASE_URL = f"sqlite:///data/{profile}.sqlite"
+    database_handler.DB_PROFILE = profile
+    database_handler.set_recipe_cache(LRUCache(maxsize=0))
+    database_handler.startup()
+    seed_recipes(args.recipes)
+
+    reads, writes, errors = [], [], []
+    deadline = time.perf_counter() + args.duration
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                if rng.random() < args.write_ratio:
+                    recipe = Recipe(**database_handler.get_recipe(rng.randint(1, args.recipes)).model_dump())
+                    recipe.portions = rng.randint(1, 8)
+                    if not database_handler.update_recipe(recipe):
+                        errors.append("update failed")
+                    writes.append(time.perf_counter() - started)
+                else:
+                    database_handler.get_recipe(rng.randint(1, args.recipes))
+                    reads.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    database_handler.ENGINE.dispose()
+    return {
+        "profile": profile,
+        "ops_per_second": round((len(reads) + len(writes)) / args.duration, 1),
+        "reads": len(reads),
+        "writes": len(writes),
+        "errors": len(errors),
+        "read_p99_ms": round(percentile(reads, 99) * 1000, 3),
+        "write_p99_ms": round(percentile(writes, 99) * 1000, 3),
+    }
+
+
+def main(args):
+    prepare_workdir()
+    os.makedirs("data", exist_ok=True)
+    results = [run_profile(profile, args) for profile in args.profiles]
+    print(json.dumps({"threads": args.threads, "write_ratio": args.write_ratio, "profiles": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=["default", "tuned"])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per profile")
+    parser.add_argument("--recipes", type=int, default=200)
+    main(parser.parse_args())
@@ -0,0 +1,123 @@
+"""
+Measures the time a new worker needs until it is ready to accept requests, with a budget check.
+
+Every run starts a fresh interpreter that imports the app, creates it and runs the lifespan
+startup, as a restarted worker or a new replica does. The time to ready is taken from starting
+the process until the lifespan startup is complete, so it includes the interpreter startup.
+The first run creates the database and the template cache and is reported separately; the
+following `--runs` runs start with both in place, as a worker does after a deployment.
+
+The result lists the median time of each startup step. With `--profile` the runs set
+`STARTUP_PROFILE`, and the result also lists the slowest imported modules and packages of the
+last run, see `app/startup_profiler.py`. The result is printed as JSON and written to `--output`. The script exits with status 1 if the median time
+to ready exceeds `--budget` milliseconds; the budget depends on the machine it runs on.
+
+Run from the repository root:
+
+    python benchmarks/startup_benchmark.py --runs 10 --budget 1500
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_utils import APP_DIR, percentile, prepare_workdir
+
+# imports the app and prints the startup report once the lifespan startup is complete
+CHILD = """
+import asyncio, json
+import app
+from startup_profiler import STARTUP
+
+async def main():
+    application = app.app
+    async with application.router.lifespan_context(application):
+        print(json.dumps(STARTUP.stats()), flush=True)
+
+asyncio.run(main())
+"""
+
+
+def run_worker(profile: bool) -> dict:
+    """Starts a process that imports the app and runs its lifespan startup.
+
+    Args:
+        profile (bool): Time the imports of the process, which makes them slightly slower.
+
+    Returns:
+        dict: The time to ready in milliseconds as seen from the outside and the startup report
+            of the process.
+    """
+    env = dict(os.environ, PYTHONPATH=str(APP_DIR), STARTUP_PROFILE=str(profile).lower(), LOG_LEVEL="WARNING")
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", CHILD], env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    ready_ms = (time.perf_counter() - started) * 1000
+    _, errors = process.communicate()
+    if process.returncode != 0 or not line:
+        raise RuntimeError(f"The worker failed to start:\n{errors}")
+    return {"ready_ms": ready_ms, "startup": json.loads(line)}
+
+
+def summarize(samples: list[float]) -> dict:
+    """Returns the median, p90 and extremes of `samples` in milliseconds."""
+    return {
+        "p50": round(statistics.median(samples), 1),
+        "p90": round(percentile(samples, 90), 1),
+        "min": round(min(samples), 1),
+        "max": round(max(samples), 1),
+    }
+
+
+def main(args) -> int:
+    prepare_workdir(copy_static=True)
+    first = run_worker(args.profile)
+    runs = [run_worker(args.profile) for _ in range(args.runs)]
+    steps = {}
+    for run in runs:
+        for step, milliseconds in run["startup"]["steps_ms"].items():
+            steps.setdefault(step, []).append(milliseconds)
+
+    time_to_ready = summarize([run["ready_ms"] for run in runs])
+    result = {
+        "config": {
+            "runs": args.runs,
+            "budget_ms": args.budget,
+            "profile": args.profile,
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "first_run_ms": round(first["ready_ms"], 1),
+        "time_to_ready_ms": time_to_ready,
+        "in_process_ready_ms": summarize([run["startup"]["ready_ms"] for run in runs]),
+        "steps_ms": {step: round(statistics.median(samples), 1) for step, samples in steps.items()},
+        "imports": runs[-1]["startup"].get("imports"),
+    }
+    status = 0
+    if time_to_ready["p50"] > args.budget:
+        print(f"Median time to ready of {time_to_ready['p50']} ms exceeds the budget of {args.budget} ms",
+              file=sys.stderr)
+        status = 1
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="measured worker starts after the first one")
+    parser.add_argument("--budget", type=float, default=1500, help="allowed median time to ready in milliseconds")
+    parser.add_argument("--profile", action="store_true", help="list the slowest imports, adds some overhead")
+    parser.add_argument("--output", help="also write the result to this file")
+    arguments = parser.parse_args()
+    # absolute path, the benchmark changes into its working directory
+    arguments.output = arguments.output and os.path.abspath(arguments.output)
+    sys.exit(main(arguments))
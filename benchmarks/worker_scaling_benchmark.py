@@ -0,0 +1,159 @@
+"""
+Load test of the gunicorn server mode with an increasing number of workers.
+
+For every worker count the app is started with `app/gunicorn.conf.py` on a local port and
+loaded over HTTP by several client processes for a fixed duration. The throughput should grow
+with the workers until the CPUs of the machine are used up; the client processes need CPU as
+well, so the scaling is best observed with the server and the clients on separate cores.
+
+After the last run the server is sent SIGTERM while requests are in flight. The requests that
+were already accepted must complete. Connections refused after the listener was closed are
+counted as "refused"; a request written to an idle keep-alive connection just as the worker
+closes it fails with a ReadError and would be retried by a real client.
+
+Run from the repository root:
+
+    python benchmarks/worker_scaling_benchmark.py --workers 1 2 4 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from bench_utils import APP_DIR, percentile, prepare_workdir, seed_recipes
+
+RECIPES = 50
+
+
+async def load(url: str, cookies: dict, connections: int, duration: float) -> dict:
+    """Sends requests over `connections` concurrent connections for `duration` seconds."""
+    import httpx
+
+    latencies = []
+    errors = {}
+    deadline = time.perf_counter() + duration
+
+    async def connection_loop(client, number: int):
+        i = number
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = await client.get(f"{url}/api/recipe/get-partial/{i % RECIPES + 1}")
+                if response.status_code == 200:
+                    latencies.append((time.perf_counter() - started) * 1000)
+                else:
+                    errors[str(response.status_code)] = errors.get(str(response.status_code), 0) + 1
+            except httpx.ConnectError:
+                errors["refused"] = errors.get("refused", 0) + 1
+                await asyncio.sleep(0.01)
+            except httpx.HTTPError as error:
+                errors[type(error).__name__] = errors.get(type(error).__name__, 0) + 1
+            i += connections
+
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(cookies=cookies, limits=limits, timeout=30) as client:
+        await asyncio.gather(*(connection_loop(client, number) for number in range(connections)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def load_process(args: tuple) -> dict:
+    """Entry point of a client process."""
+    return asyncio.run(load(*args))
+
+
+def run_load(url: str, cookies: dict, clients: int, connections: int, duration: float) -> dict:
+    """Loads the server from `clients` processes and returns the combined statistics."""
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.map(load_process, [(url, cookies, connections, duration)] * clients)
+    latencies = [latency for result in results for latency in result["latencies"]]
+    errors = {}
+    for result in results:
+        for kind, count in result["errors"].items():
+            errors[kind] = errors.get(kind, 0) + count
+    return {
+        "throughput_rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "errors": errors,
+    }
+
+
+def start_server(workers: int, port: int) -> subprocess.Popen:
+    """Starts gunicorn and waits until it accepts connections."""
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), RATE_LIMIT_ENABLED="false")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", str(APP_DIR / "gunicorn.conf.py"), "--pythonpath", str(APP_DIR),
+         "--bind", f"127.0.0.1:{port}", "--access-logfile", "/dev/null", "app:app"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+def stop_server(server: subprocess.Popen) -> float:
+    """Sends SIGTERM and returns the seconds until gunicorn exited."""
+    started = time.perf_counter()
+    server.send_signal(signal.SIGTERM)
+    server.wait(timeout=120)
+    return time.perf_counter() - started
+
+
+def main(args):
+    prepare_workdir()
+    import database_handler
+    from auth_handler import create_access_token
+
+    database_handler.startup()
+    seed_recipes(RECIPES)
+    database_handler.ENGINE.dispose()
+    cookies = {"access_token": create_access_token({"sub": "bench", "user_id": 1})}
+    url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    for workers in args.workers:
+        server = start_server(workers, args.port)
+        # a few seconds until every worker has warmed up and the client connections are open
+        run_load(url, cookies, args.clients, args.connections, 2)
+        results[workers] = run_load(url, cookies, args.clients, args.connections, args.duration)
+        stop_server(server)
+
+    server = start_server(args.workers[-1], args.port)
+    with multiprocessing.Pool(1) as pool:
+        pending = pool.apply_async(load_process, ((url, cookies, args.connections, 4),))
+        time.sleep(2)
+        shutdown_seconds = stop_server(server)
+        drain = pending.get()
+    print(json.dumps({
+        "cpus": os.cpu_count(),
+        "duration": args.duration,
+        "clients": args.clients,
+        "connections_per_client": args.connections,
+        "workers": results,
+        "drain": {
+            "shutdown_seconds": round(shutdown_seconds, 2),
+            "completed": len(drain["latencies"]),
+            "errors": drain["errors"],
+        },
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=2, help="client processes generating the load")
+    parser.add_argument("--connections", type=int, default=16, help="concurrent connections per client process")
+    parser.add_argument("--port", type=int, default=8765)
+    main(parser.parse_args())